@@ -0,0 +1,69 @@
+import base64
+import numpy as np
+
+CORRELATION_DTYPE = np.dtype("<f2")
+
+
+def get_packed_index(n, i, j):
+    """
+    Index of the pair (i, j) (1-based idx_neuron, i != j) in the packed upper triangle of an n x n
+    matrix, i.e. the order of np.triu_indices(n, k=1): (1,2), (1,3), ..., (1,n), (2,3), ...
+    """
+    if i > j:
+        i, j = j, i
+    a, b = i - 1, j - 1
+
+    return a * n - a * (a + 1) // 2 + (b - a - 1)
+
+
+def pack_correlation_matrix(corr_matrix):
+    """
+    Pack the upper triangle (excluding the diagonal) of a symmetric correlation matrix as float16.
+
+    Returns:
+    - dict: {"n": n, "dtype": "float16", "packed": base64 of the little-endian float16 array}
+    """
+    corr_matrix = np.asarray(corr_matrix)
+    n = corr_matrix.shape[0]
+    packed = corr_matrix[np.triu_indices(n, k=1)].astype(CORRELATION_DTYPE)
+
+    return {"n": n, "dtype": "float16", "packed": base64.b64encode(packed.tobytes()).decode("ascii")}
+
+
+def unpack_correlation(cor_neuron, n_neuron):
+    """
+    Return the packed upper triangle (see get_packed_index) as a float16 array.
+    Datasets imported before the packed format store a dict with "i,j" keys, which is packed here.
+    """
+    if "packed" in cor_neuron:
+        return np.frombuffer(base64.b64decode(cor_neuron["packed"]), dtype=CORRELATION_DTYPE)
+
+    packed = np.full(n_neuron * (n_neuron - 1) // 2, np.nan, dtype=CORRELATION_DTYPE)
+    for key, value in cor_neuron.items():
+        i, j = map(int, key.split(","))
+        if value is not None:
+            packed[get_packed_index(n_neuron, i, j)] = value
+
+    return packed
+
+
+def get_correlation_rows(packed, n_neuron, list_idx_neuron):
+    """
+    Full rows of the correlation matrix for list_idx_neuron (1-based) from the packed upper triangle.
+
+    Returns:
+    - np.ndarray: (len(list_idx_neuron), n_neuron), 1 on the diagonal
+    """
+    a = np.asarray(list_idx_neuron, dtype=np.intp)[:, None] - 1
+    b = np.arange(n_neuron, dtype=np.intp)[None, :]
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    idx = lo * n_neuron - lo * (lo + 1) // 2 + (hi - lo - 1)
+
+    diagonal = a == b
+    packed = np.asarray(packed)
+    if packed.size == 0:
+        return np.ones(diagonal.shape, dtype=packed.dtype)
+    rows = packed[np.where(diagonal, 0, idx)]
+    rows[diagonal] = 1
+
+    return rows
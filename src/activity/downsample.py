@@ -0,0 +1,132 @@
+import numpy as np
+
+MIN_POINTS = 3
+DOWNSAMPLE_METHODS = ["auto", "lttb"]
+
+
+def parse_downsample_params(request):
+    """
+    Read the optional window/downsampling GET parameters.
+    - t_start, t_end: time point indices of the window (0-based, t_end exclusive)
+    - max_points: maximum number of samples per trace in the response
+    Returns a dict with the given parameters (empty if none). Raises ValueError if invalid.
+    """
+    params = {}
+    for key in ("t_start", "t_end", "max_points"):
+        value = request.GET.get(key)
+        if value is not None:
+            params[key] = int(value)
+            if params[key] < 0:
+                raise ValueError(f"{key} must be non-negative")
+
+    if "max_points" in params and params["max_points"] < MIN_POINTS:
+        raise ValueError(f"max_points must be at least {MIN_POINTS}")
+    if params.get("t_end", np.inf) < params.get("t_start", 0):
+        raise ValueError("t_end must not be smaller than t_start")
+
+    return params
+
+
+def parse_downsample_method(request):
+    """
+    "auto" (default) uses the precomputed pyramids when available and LTTB otherwise.
+    "lttb" always downsamples the full resolution data with LTTB.
+    """
+    method = request.GET.get("method", "auto")
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Unknown method: {method}")
+
+    return method
+
+
+def lttb_indices(y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of each row of y (x is the sample index).
+    The first and last samples are always kept. The remaining samples are split into n_out-2
+    buckets and the sample forming the largest triangle with the previously selected sample and
+    the average of the next bucket is selected from each bucket.
+    The bucket recursion is inherently sequential, so the loop runs over buckets while all rows
+    and all samples within a bucket are processed at once.
+    NaN samples are left out of the bucket averages and are only selected if their whole bucket is NaN.
+
+    Parameters:
+    - y (np.ndarray): 2D array (n_row, n)
+    - n_out (int): number of samples to keep per row, at least MIN_POINTS
+
+    Returns:
+    - np.ndarray: (n_row, min(n_out, n)) sorted indices of the selected samples
+    """
+    if n_out < MIN_POINTS:
+        raise ValueError(f"n_out must be at least {MIN_POINTS}")
+    y = np.asarray(y, dtype=np.float64)
+    n_row, n = y.shape
+    if n_out >= n:
+        return np.tile(np.arange(n), (n_row, 1))
+
+    # bucket i covers [edges[i], edges[i+1])
+    edges = (np.floor(np.arange(n_out - 1) * (n - 2) / (n_out - 2)) + 1).astype(np.intp)
+    edges[-1] = n - 1
+
+    # average point of every bucket (of its non-NaN samples), computed at once with cumulative sums
+    finite = ~np.isnan(y)
+    y_cumsum = np.concatenate([np.zeros((n_row, 1)), np.cumsum(np.where(finite, y, 0), axis=1)], axis=1)
+    n_cumsum = np.concatenate([np.zeros((n_row, 1)), np.cumsum(finite, axis=1)], axis=1)
+    with np.errstate(invalid="ignore"):
+        bucket_avg_y = (
+            (y_cumsum[:, edges[1:]] - y_cumsum[:, edges[:-1]]) / (n_cumsum[:, edges[1:]] - n_cumsum[:, edges[:-1]])
+        )
+    bucket_avg_x = (edges[:-1] + edges[1:] - 1) / 2
+
+    # the anchor of the last bucket is the last sample
+    next_avg_y = np.concatenate([bucket_avg_y[:, 1:], y[:, -1:]], axis=1)
+    next_avg_x = np.concatenate([bucket_avg_x[1:], [n - 1]])
+
+    indices = np.empty((n_row, n_out), dtype=np.intp)
+    indices[:, 0] = 0
+    indices[:, -1] = n - 1
+
+    rows = np.arange(n_row)
+    a = np.zeros(n_row, dtype=np.intp)
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        x_a = a[:, None].astype(np.float64)
+        y_a = y[rows, a][:, None]
+        x_b = np.arange(lo, hi, dtype=np.float64)[None, :]
+        y_b = y[:, lo:hi]
+        x_c = next_avg_x[i]
+        y_c = next_avg_y[:, i:i + 1]
+        # a NaN anchor or average (whole bucket NaN) is replaced by the other one (or 0)
+        y_a = np.where(np.isnan(y_a), y_c, y_a)
+        y_c = np.where(np.isnan(y_c), y_a, y_c)
+        y_a = np.nan_to_num(y_a)
+        y_c = np.nan_to_num(y_c)
+
+        area = np.abs((x_a - x_c) * (y_b - y_a) - (x_a - x_b) * (y_c - y_a))
+        a = lo + np.argmax(np.where(np.isnan(area), -np.inf, area), axis=1)
+        indices[:, i + 1] = a
+
+    return indices
+
+
+def slice_and_downsample(y, t_start=None, t_end=None, max_points=None):
+    """
+    Slice the window [t_start, t_end) out of each row of y and downsample it to at most
+    max_points samples with LTTB.
+
+    Returns:
+    - (np.ndarray, np.ndarray): (t, values) both (n_row, m). t holds the absolute time point
+      indices of the returned samples.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    n = y.shape[1]
+    t_start = 0 if t_start is None else min(t_start, n)
+    t_end = n if t_end is None else max(min(t_end, n), t_start)
+
+    y_window = y[:, t_start:t_end]
+    if max_points is None or max_points >= y_window.shape[1]:
+        t = np.tile(np.arange(t_start, t_end), (y.shape[0], 1))
+        return t, y_window
+
+    idx = lttb_indices(y_window, max_points)
+
+    return idx + t_start, np.take_along_axis(y_window, idx, axis=1)
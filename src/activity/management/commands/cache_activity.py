@@ -1,33 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
-from activity.views import get_dataset_encoding, get_neural_trace_data, get_behavior_data, get_encoding_data
-from activity.models import GCaMPDataset
+from django.db import connection
+from activity.views import (
+    get_dataset_cache_key, get_behavior_json, get_encoding_json, get_correlation_json, get_all_dataset_json,
+    get_json_cache_json
+)
+from activity.models import GCaMPDataset, GCaMPNeuron
+from activity.trace_store import load_trace_store, row_to_list
+from core.models import JSONCache
+from core.caching import CONTENT_ENCODINGS, get_json_bytes_items
 import time
 
-def cache_datasets(self):
-    t1 = time.time_ns()
-    datasets = GCaMPDataset.objects.all()
-
-    for dataset in datasets:
-        dataset_id = dataset.dataset_id
-        n_neuron = dataset.n_neuron
-        n_labeled = dataset.n_labeled
-        
-        # behavior
-        get_behavior_data(dataset_id)
-
-        # encoding
-        if dataset.encoding:
-            get_encoding_data(dataset_id)
-
-        # neural traces
-        for idx_neuron in range(1, n_neuron+1):
-            get_neural_trace_data(dataset_id, idx_neuron)
-    
-    t2 = time.time_ns()
-    self.stdout.write(self.style.SUCCESS(f"Neural/behavior datacached for {len(datasets)} datasets. Time: {(t2-t1)/1e9} s"))
+# identity and the compressed variants of the JSON bodies
+JSON_ENCODINGS = [None] + CONTENT_ENCODINGS
+
+def iter_neural_traces(dataset_id):
+    """
+    Yield (idx_neuron, trace data, from_db) for all neurons of a dataset (same data as get_neural_trace_data),
+    from the trace store or one streaming query.
+    """
+    store = load_trace_store(dataset_id)
+    if store is not None:
+        for i in range(store.shape[0]):
+            yield i + 1, {"trace": row_to_list(store[i]), "idx_neuron": i + 1, "dataset_id": dataset_id}, False
+        return
+
+    neurons = (
+        GCaMPNeuron.objects
+        .filter(dataset__dataset_id=dataset_id)
+        .order_by("idx_neuron")
+        .values_list("idx_neuron", "trace")
+        .iterator(chunk_size=100)
+    )
+    for idx_neuron, trace in neurons:
+        yield idx_neuron, {"trace": trace, "idx_neuron": idx_neuron, "dataset_id": dataset_id}, True
+
+def cache_dataset(dataset_id, has_encoding, batch_size):
+    """Warm the cache of a dataset. Returns (number of keys, bytes) written by set_many."""
+    n_key = 0
+    n_byte = 0
+    items = {}
+
+    def flush():
+        nonlocal n_key, n_byte, items
+        cache.set_many(items, timeout=None)
+        n_key += len(items)
+        n_byte += sum(len(value) for value in items.values() if isinstance(value, bytes))
+        items = {}
+
+    # behavior, encoding, correlation (one entry each)
+    for encoding in JSON_ENCODINGS:
+        get_behavior_json(dataset_id, encoding)
+        if has_encoding:
+            get_encoding_json(dataset_id, encoding)
+        get_correlation_json(dataset_id, encoding)
+
+    # neural traces, in batches of set_many
+    for idx_neuron, neuron, from_db in iter_neural_traces(dataset_id):
+        key = get_dataset_cache_key(dataset_id, idx_neuron)
+        if from_db:
+            items[key] = neuron
+        items.update(get_json_bytes_items(key, neuron))
+        if len(items) >= batch_size:
+            flush()
+    flush()
+
+    # done, for --resume
+    cache.set(get_dataset_cache_key(dataset_id, "warm"), True, timeout=None)
+
+    return n_key, n_byte
+
+def cache_datasets(self, workers=1, batch_size=500, resume=False):
+    t1 = time.time()
+    datasets = list(GCaMPDataset.objects.order_by("dataset_id").values_list("dataset_id", flat=True))
+    with_encoding = set(GCaMPDataset.objects.exclude(encoding={}).values_list("dataset_id", flat=True))
+
+    if resume:
+        warm = cache.get_many([get_dataset_cache_key(dataset_id, "warm") for dataset_id in datasets])
+        datasets_todo = [dataset_id for dataset_id in datasets if get_dataset_cache_key(dataset_id, "warm") not in warm]
+        self.stdout.write(f"Resuming: {len(datasets) - len(datasets_todo)} of {len(datasets)} datasets already cached")
+    else:
+        datasets_todo = datasets
+
+    lock = Lock()
+    total = {"n_done": 0, "n_key": 0, "n_byte": 0}
+
+    def run(dataset_id):
+        t_start = time.time()
+        n_key, n_byte = cache_dataset(dataset_id, dataset_id in with_encoding, batch_size)
+        with lock:
+            total["n_done"] += 1
+            total["n_key"] += n_key
+            total["n_byte"] += n_byte
+            self.stdout.write(f"[{total['n_done']}/{len(datasets_todo)}] {dataset_id}: {n_key} keys, "
+                              f"{n_byte / 1e6:.1f} MB, {time.time() - t_start:.2f} s")
+
+    def run_in_thread(dataset_id):
+        try:
+            run(dataset_id)
+        finally:
+            connection.close()  # the connection of the pool thread
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run_in_thread, datasets_todo))
+    else:
+        for dataset_id in datasets_todo:
+            run(dataset_id)
+
+    # catalog and precomputed JSON
+    for encoding in JSON_ENCODINGS:
+        get_all_dataset_json(encoding)
+    for name in ("neuropal_match", "atanas_kim_2023_all_encoding_dict"):
+        if JSONCache.objects.filter(name=name).exists():
+            for encoding in JSON_ENCODINGS:
+                get_json_cache_json(name, encoding)
+
+    t = time.time() - t1
+    self.stdout.write(self.style.SUCCESS(
+        f"Neural/behavior data cached for {len(datasets_todo)} datasets: {total['n_key']} keys, "
+        f"{total['n_byte'] / 1e6:.1f} MB. Time: {t:.2f} s ({total['n_key'] / max(t, 1e-9):.0f} keys/s, "
+        f"{total['n_byte'] / 1e6 / max(t, 1e-9):.1f} MB/s)"))
+    if hasattr(cache, "get_stats"):
+        self.stdout.write(f"Cache: {cache.get_stats()}")
 
 class Command(BaseCommand):
     help = 'Cache activity module data'
 
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="number of datasets cached in parallel (threads)")
+        parser.add_argument("--batch-size", type=int, default=500, help="number of cache keys per set_many")
+        parser.add_argument("--resume", action="store_true",
+                            help="skip the datasets cached by a previous (e.g. interrupted) run with the same data")
+
     def handle(self, *args, **options):
-        cache_datasets(self)
\ No newline at end of file
+        cache_datasets(self, workers=options["workers"], batch_size=options["batch_size"], resume=options["resume"])
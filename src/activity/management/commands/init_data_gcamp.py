@@ -1,19 +1,27 @@
+import django
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from connectome.models import NeuronClass
 from activity.models import GCaMPDataset, GCaMPNeuron, GCaMPPaper, GCaMPDatasetType
 import numpy as np
-from scipy.stats import pearsonr
 import time
 import json
-import math
 import os
-from core.utility import sha256
+import tempfile
+from django.conf import settings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from core.utility import sha256, JSONStreamReader
+from activity.trace_store import stage_trace_store, stage_pyramid
+from activity.correlation import pack_correlation_matrix
 
 PATH_CONFIG_GCAMP_NEURON_MAP = ["config", "gcamp_neuron_name_map_manual.json"]
 PATH_CONFIG_GCAMP_CLASS_MAP = ["config", "gcamp_neuron_class_name_map_manual.json"]
 PATH_PAPER = ["activity", "papers.json"]
 PATH_TYPE = ["activity", "dataset_types.json"]
 PATH_CHECKSUM = ["config", "data_checksum.json"]
+STREAM_TRACE_KEYS = ["trace_array", "trace_original"]
+NEURON_BATCH_SIZE = 100
 
 '''
 
@@ -32,6 +40,71 @@ def load_json(self, path_json):
     with open(path_json, 'r') as file:
         return json.load(file)
 
+def load_json_stream(self, path_json, trace_writers):
+    """
+    Same as load_json for a GCaMP dataset, but the file is decoded incrementally and each trace of
+    STREAM_TRACE_KEYS is appended to the TraceFileWriters of trace_writers[key] as soon as it is
+    parsed, so the peak memory is one trace instead of all of them. The returned data has no
+    STREAM_TRACE_KEYS.
+    """
+    if not os.path.exists(path_json):
+        self.stdout.write(self.style.ERROR(f"{path_json} does not exists"))
+    data = {}
+    with open(path_json, 'r') as file:
+        reader = JSONStreamReader(file)
+        for key in reader.iter_object():
+            if key in STREAM_TRACE_KEYS:
+                for trace in reader.iter_array():
+                    for writer in trace_writers[key]:
+                        writer.append(trace)
+            else:
+                data[key] = reader.decode_value()
+
+    return data
+
+class TraceFileWriter:
+    """
+    Write traces of equal length one row at a time to a raw float64 work file under
+    settings.TRACE_STORE_DIR (truncated by truncate_floats if truncate), so that a dataset is
+    processed without holding all of its traces in memory. Read it back with open_trace_file.
+    """
+    def __init__(self, name, truncate=False):
+        os.makedirs(settings.TRACE_STORE_DIR, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(suffix=f".{name}.work", dir=settings.TRACE_STORE_DIR)
+        self.file = os.fdopen(fd, "wb")
+        self.name = name
+        self.truncate = truncate
+        self.n_row = 0
+        self.length = None
+
+    def append(self, trace):
+        row = truncate_floats(trace) if self.truncate else np.asarray(trace, dtype=np.float64)
+        if row.ndim != 1:
+            raise ValueError(f"Inner list at index {self.n_row} in {self.name} is not a list of numbers.")
+        if self.length is None:
+            self.length = len(row)
+        elif len(row) != self.length:
+            raise ValueError(
+                f"Inner list at index {self.n_row} in {self.name} has length {len(row)}, "
+                f"expected {self.length}."
+            )
+        self.file.write(row.tobytes())
+        self.n_row += 1
+
+    def close(self):
+        self.file.close()
+        return {"path": self.path, "shape": (self.n_row, self.length or 0)}
+
+def open_trace_file(info):
+    """Read-only memory-mapped (n_row, length) array of a file written by TraceFileWriter."""
+    if info["shape"][0] == 0 or info["shape"][1] == 0:
+        return np.empty(info["shape"])
+    return np.memmap(info["path"], dtype=np.float64, mode="r", shape=info["shape"])
+
+def remove_trace_file(info):
+    if os.path.exists(info["path"]):
+        os.remove(info["path"])
+
 '''
 
 Math functions
@@ -43,96 +116,103 @@ class NumpyEncoder(json.JSONEncoder):
             return obj.tolist()
         return super().default(obj)
 
-def truncate_floats_in_list(numbers, n=6):
+def truncate_floats(numbers, n=6):
     """
-    Truncates each float in a list to n decimal places using float operations.
+    Truncates each float in a list to n decimal places using float operations (vectorized).
 
     Parameters:
-    - numbers (list): A list of numbers (int or float).
+    - numbers (list or np.ndarray): A list of numbers (int or float), or a list of such lists of equal length.
     - n (int): Number of decimal places to truncate to.
 
     Returns:
-    - list: A new list with each number truncated to n decimal places.
+    - np.ndarray: float64 array with each number truncated to n decimal places.
     """
-    if not isinstance(numbers, list):
+    if not isinstance(numbers, (list, np.ndarray)):
         raise TypeError("Input data must be a list.")
-    
-    truncated_numbers = []
-    factor = 10.0 ** n  # Factor to shift decimal places
 
-    for idx, num in enumerate(numbers):
-        if not isinstance(num, (int, float)):
-            raise ValueError(f"All items in the list must be numbers. Invalid item at index {idx}: {num}")
-        
-        # Truncate the number to n decimal places
-        truncated = math.trunc(num * factor) / factor
-        truncated_numbers.append(truncated)
-    
-    return truncated_numbers
+    array = np.asarray(numbers)
+    if array.dtype.kind not in "biuf":
+        raise ValueError(f"All items in the list must be numbers. Got items of type {array.dtype}.")
+    if not np.all(np.isfinite(array)):
+        raise ValueError("All items in the list must be finite numbers.")
+
+    factor = 10.0 ** n  # Factor to shift decimal places
+    # + 0.0 turns the -0.0 of truncated small negative numbers into 0.0 (same as math.trunc)
+    return np.trunc(array.astype(np.float64) * factor) / factor + 0.0
 
-def correlation_matrix_to_dict(corr_matrix):
+def truncate_floats_in_list(numbers, n=6):
+    """Same as truncate_floats, returned as a (nested) list."""
+    return truncate_floats(numbers, n).tolist()
+
+def normalize(array):
+    # same steps as scipy.stats.pearsonr: center, then divide by the norm (scaled by the max abs)
+    centered = array - array.mean(axis=-1, keepdims=True)
+    scale = np.abs(centered).max(axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        norm = scale * np.linalg.norm(centered / scale, axis=-1, keepdims=True)
+        return centered / norm
+
+def calculate_cor_neuron(trace_array, block_size=NEURON_BATCH_SIZE):
     """
-    Converts a 2D NumPy correlation matrix into a dictionary with keys as "i,j"
-    and values as the correlation coefficients, excluding self-correlations and duplicates.
-    
-    Parameters:
-    - corr_matrix (np.ndarray): 2D NumPy array representing the correlation matrix.
-    
+    Same as np.corrcoef(trace_array), computed block_size rows at a time so that a memory-mapped
+    trace_array is never loaded whole (NaN for the constant traces).
+
     Returns:
-    - dict: Dictionary with keys in "i,j" format and correlation coefficients as values.
+    - np.ndarray: (n_trace, n_trace) correlation matrix
     """
-    correlation_dict = {}
-    num_traces = corr_matrix.shape[0]
-    
-    for i in range(num_traces):
-        for j in range(i + 1, num_traces):
-            key = f"{i+1},{j+1}"
-            correlation_dict[key] = corr_matrix[i][j]
-    
-    return correlation_dict
-
-def calculate_cor_behavior(list_trace_array, data):
+    n_trace = len(trace_array)
+    cor = np.empty((n_trace, n_trace))
+    for i in range(0, n_trace, block_size):
+        a = normalize(np.asarray(trace_array[i:i + block_size], dtype=np.float64))
+        for j in range(i, n_trace, block_size):
+            b = a if j == i else normalize(np.asarray(trace_array[j:j + block_size], dtype=np.float64))
+            block = np.clip(a @ b.T, -1., 1.)
+            cor[i:i + block_size, j:j + block_size] = block
+            cor[j:j + block_size, i:i + block_size] = block.T
+
+    return cor
+
+def calculate_cor_behavior(list_trace_array, data, block_size=NEURON_BATCH_SIZE):
     """
     Calculate Pearson correlation coefficients between each trace array and selected data variables.
+    The neurons are correlated with a variable block_size at a time: the z-normalized traces times
+    the z-normalized variable.
     
     Parameters:
-    list_trace_array (list): List of 1D numeric arrays
+    list_trace_array (list or np.ndarray): List of 1D numeric arrays of equal length, or a (memory-mapped) 2D array
     data (dict): Dictionary containing variables to correlate with (velocity, head_curvature, pumping)
     
     Returns:
     dict: Nested dictionary where result[i][variable] gives correlation coefficient
           between i-th trace array and the variable
     """
-    # If no keys specified, use all keys from data
-
     keys = ["velocity", "head_curvature", "pumping", "angular_velocity"]
     key_conversion = {"velocity": "v", "head_curvature": "hc", "pumping": "f", "angular_velocity": "av"}
 
-    # Validate that all requested keys exist in data
-    # invalid_keys = [k for k in keys if k not in data]
-    # if invalid_keys:
-    #     raise KeyError(f"Keys not found in data: {invalid_keys}")
+    trace_array = list_trace_array
+    if not isinstance(trace_array, np.ndarray):
+        trace_array = np.asarray(list_trace_array, dtype=np.float64)
+    n_trace = trace_array.shape[0]
+
+    cor = {}
+    for variable_name in keys:
+        variable_data = data.get(variable_name)
+        if variable_data is None:
+            continue
+        key_save = key_conversion[variable_name]
+        if np.sum(variable_data) == 0.:
+            cor[key_save] = np.zeros(n_trace)
+        else:
+            # Ensure lengths match by taking the minimum length
+            min_length = min(trace_array.shape[1], len(variable_data))
+            y = normalize(np.asarray(variable_data[:min_length], dtype=np.float64))
+            cor[key_save] = np.zeros(n_trace)
+            for i in range(0, n_trace, block_size):
+                x = normalize(np.asarray(trace_array[i:i + block_size, :min_length], dtype=np.float64))
+                cor[key_save][i:i + block_size] = np.around(np.clip(x @ y, -1., 1.), 6)
 
-    result = {}
-    
-    # Iterate through each trace array
-    for i, trace in enumerate(list_trace_array, 1):  # Start indexing at 1
-        result[i] = {}
-        
-        # Calculate correlation with each selected variable in data
-        for variable_name in keys:
-            if variable_name in data:
-                variable_data = data[variable_name]
-                if np.sum(variable_data) == 0.:
-                    result[i][key_save] = 0.
-                else:
-                    # Ensure lengths match by taking the minimum length
-                    min_length = min(len(trace), len(variable_data))
-                    correlation, _ = pearsonr(trace[:min_length], variable_data[:min_length])
-                    key_save = key_conversion[variable_name]
-                    result[i][key_save] = np.around(correlation, 6)
-
-    return result
+    # Start indexing at 1
+    return {i + 1: {key: float(values[i]) for key, values in cor.items()} for i in range(n_trace)}
 
 '''
 
@@ -171,7 +251,7 @@ Import functions
 
 '''
 def check_list_lengths(self, list_trace_array, list_trace_original, pumping, head_curvature, body_curvature, angular_velocity, velocity):
-    if not list_trace_array:
+    if len(list_trace_array) == 0:
         raise ValueError("list_trace_array is empty.")
 
     # Get the expected length from the first inner list
@@ -218,14 +298,43 @@ def check_list_lengths(self, list_trace_array, list_trace_original, pumping, hea
 
     return expected_length
 
-def import_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map=None, neuron_name_map=None):
-    neuron_class_cache = {nc.name: nc for nc in NeuronClass.objects.all()}
-
-    data = load_json(self, path_json)
-    # import neurons
-    list_trace_array = data["trace_array"]
-    list_trace_original = data["trace_original"]
-    
+def prepare_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map=None, neuron_name_map=None, stream=False):
+    """
+    Parse, validate and process a GCaMP dataset JSON without touching the DB (runs in the worker processes).
+    Returns the dataset fields, neurons and the work files of the truncated traces (see TraceFileWriter)
+    for save_gcamp_data. The correlations are computed from the memory-mapped traces.
+    """
+    trace_writers = {
+        "trace_array": [TraceFileWriter("trace_array"), TraceFileWriter("trace_array", truncate=True)],
+        "trace_original": [TraceFileWriter("trace_original", truncate=True)],
+    }
+    list_writer = [writer for key in STREAM_TRACE_KEYS for writer in trace_writers[key]]
+    try:
+        if stream:
+            data = load_json_stream(self, path_json, trace_writers)
+        else:
+            data = load_json(self, path_json)
+            for key in STREAM_TRACE_KEYS:
+                for trace in data.pop(key):
+                    for writer in trace_writers[key]:
+                        writer.append(trace)
+        info_array, info_trace, info_trace_original = [writer.close() for writer in list_writer]
+
+        prepared = prepare_gcamp_fields(self, data, checksum, paper_id, neuron_class_name_map, neuron_name_map,
+                                        open_trace_file(info_array), open_trace_file(info_trace_original))
+    except BaseException:
+        for writer in list_writer:
+            writer.file.close()
+            remove_trace_file({"path": writer.path})
+        raise
+    # only the truncated traces are saved
+    remove_trace_file(info_array)
+
+    prepared["trace"] = info_trace
+    prepared["trace_original"] = info_trace_original
+    return prepared
+
+def prepare_gcamp_fields(self, data, checksum, paper_id, neuron_class_name_map, neuron_name_map, list_trace_array, list_trace_original):
     pumping = data.get("pumping", None)
     head_curvature = data["head_curvature"]
     body_curvature = data["body_curvature"]
@@ -240,7 +349,7 @@ def import_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map
         data["max_t"] = expected_length
 
     cor_trace = {
-        "neuron": correlation_matrix_to_dict(np.around(np.corrcoef(list_trace_array), 3)),
+        "neuron": pack_correlation_matrix(np.around(calculate_cor_neuron(list_trace_array), 3)),
         "behavior": calculate_cor_behavior(list_trace_array, data)
     }
 
@@ -309,10 +418,8 @@ def import_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map
     # feedingness = truncate_floats_in_list(data["feedingness"]) if "feedingness" in data else [],
     # tau_vals = truncate_floats_in_list(data["tau_vals"]) if "tau_vals" in data else [],
 
-    paper, q_created = GCaMPPaper.objects.get_or_create(paper_id=paper_id)
-    dataset = GCaMPDataset.objects.create(
-        paper=paper,
-        dataset_id=paper.paper_id + "-" + data["uid"],
+    dataset_fields = dict(
+        dataset_id=paper_id + "-" + data["uid"],
         dataset_name=data["uid"],
         dataset_meta=data["meta"] if "meta" in data else {},
         
@@ -334,8 +441,60 @@ def import_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map
         dataset_sha256=checksum
     )
 
+    neurons = []
+    for i in range(0,len(list_trace_array)):
+        idx_neuron = i + 1
+        idx_neuron_str = str(idx_neuron)
+        if "labeled" in data and idx_neuron_str in data["labeled"]:
+            label_ = data["labeled"][idx_neuron_str]
+            neuron_name = map_neuron_name(label_["label"], neuron_name_map)
+            neuron_class_name = map_neuron_name(label_["neuron_class"], neuron_class_name_map)
+            lr = process_lr(label_["LR"])
+            dv = process_dv(label_["DV"])
+        else:
+            neuron_name = ""
+            neuron_class_name = None
+            lr = "n"
+            dv = "n"
+
+        neurons.append({
+            "idx_neuron": idx_neuron,
+            "neuron_name": neuron_name,
+            "neuron_class_name": neuron_class_name,
+            "lr": lr,
+            "dv": dv,
+        })
+
+    return {
+        "paper_id": paper_id,
+        "uid": data["uid"],
+        "dataset": dataset_fields,
+        "dataset_type": data["dataset_type"],
+        "neurons": neurons,
+        # behavior channels, one row per channel in the order of "i"
+        "behavior_store": [trace["data"] for trace in data_behavior_truncated["traces"].values()],
+    }
+
+def prepare_gcamp_data_worker(args):
+    # worker processes write their output through their own command instance
+    return prepare_gcamp_data(Command(), *args)
+
+def save_gcamp_data(self, prepared, neuron_class_cache):
+    """
+    Create the dataset and its neurons from prepare_gcamp_data, and write its trace stores.
+    An existing dataset with the same dataset_id (i.e. a changed file) is replaced.
+    The trace stores are written to temporary paths and renamed into place when the transaction
+    commits, so that a rolled back batch leaves the stores of the DB rows in place.
+    The traces are read from the memory-mapped work files one batch of neurons at a time.
+    """
+    paper, q_created = GCaMPPaper.objects.get_or_create(paper_id=prepared["paper_id"])
+    n_deleted, _ = GCaMPDataset.objects.filter(dataset_id=prepared["dataset"]["dataset_id"]).delete()
+    if n_deleted > 0:
+        self.stdout.write(self.style.NOTICE(f"Replacing dataset {prepared['dataset']['dataset_id']}"))
+    dataset = GCaMPDataset.objects.create(paper=paper, **prepared["dataset"])
+
     # add dataset type
-    for type in data["dataset_type"]:
+    for type in prepared["dataset_type"]:
         # Construct the type_id
         type_id = f"{paper.paper_id}-{type}"
 
@@ -349,43 +508,61 @@ def import_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map
         # Add the dataset_type to the dataset
         dataset.dataset_type.add(dataset_type)
 
-    # create neuron objects
-    new_neurons = []
-    for i in range(0,len(list_trace_array)):
-        idx_neuron = i + 1
-        idx_neuron_str = str(idx_neuron)
-        if "labeled" in data and idx_neuron_str in data["labeled"]:
-            label_ = data["labeled"][idx_neuron_str]
-            neuron_name = map_neuron_name(label_["label"], neuron_name_map)
-            neuron_class_name = map_neuron_name(label_["neuron_class"], neuron_class_name_map)
-            if neuron_class_name not in neuron_class_cache:
-                self.stdout.write(self.style.WARNING(f"Neuron class {neuron_class_name} does not exist. dataset: {data["uid"]} idx_neuron: {idx_neuron}"))
-                
-            neuron_class = neuron_class_cache[neuron_class_name]
-            lr = process_lr(label_["LR"])
-            dv = process_dv(label_["DV"])
-        else:
-            neuron_name = ""
+    # create neuron objects, converting the traces to lists one batch at a time
+    neurons = prepared["neurons"]
+    trace = open_trace_file(prepared["trace"])
+    trace_original = open_trace_file(prepared["trace_original"])
+    for i_start in range(0, len(neurons), NEURON_BATCH_SIZE):
+        new_neurons = []
+        for i in range(i_start, min(i_start + NEURON_BATCH_SIZE, len(neurons))):
+            neuron = neurons[i]
+            neuron_class_name = neuron["neuron_class_name"]
             neuron_class = None
-            lr = "n"
-            dv = "n"
-        
-        trace = truncate_floats_in_list(list_trace_array[i])
-        trace_original = truncate_floats_in_list(list_trace_original[i])
-            
-        new_neurons.append(
-            GCaMPNeuron(
-                dataset=dataset,
-                neuron_name=neuron_name,
-                neuron_class=neuron_class,
-                idx_neuron=idx_neuron,
-                lr=lr,
-                dv=dv,
-                trace=trace,
-                trace_original=trace_original,
+            if neuron_class_name is not None:
+                if neuron_class_name not in neuron_class_cache:
+                    self.stdout.write(self.style.WARNING(f"Neuron class {neuron_class_name} does not exist. dataset: {prepared['uid']} idx_neuron: {neuron['idx_neuron']}"))
+                neuron_class = neuron_class_cache[neuron_class_name]
+
+            new_neurons.append(
+                GCaMPNeuron(
+                    dataset=dataset,
+                    neuron_name=neuron["neuron_name"],
+                    neuron_class=neuron_class,
+                    idx_neuron=neuron["idx_neuron"],
+                    lr=neuron["lr"],
+                    dv=neuron["dv"],
+                    trace=trace[i].tolist(),
+                    trace_original=trace_original[i].tolist(),
+                )
             )
-        )
-    GCaMPNeuron.objects.bulk_create(new_neurons)
+        GCaMPNeuron.objects.bulk_create(new_neurons)
+
+    # binary trace store (memory-mapped by the workers) and min/max/mean pyramids
+    list_publish = [
+        stage_trace_store(dataset.dataset_id, trace),
+        stage_pyramid(dataset.dataset_id, trace),
+    ]
+
+    list_behavior_store = prepared["behavior_store"]
+    if list_behavior_store:
+        list_publish.append(stage_trace_store(dataset.dataset_id, list_behavior_store, name="behavior"))
+        list_publish.append(stage_pyramid(dataset.dataset_id, list_behavior_store, name="behavior"))
+
+    for publish in list_publish:
+        transaction.on_commit(publish)
+
+def import_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map=None, neuron_name_map=None):
+    neuron_class_cache = {nc.name: nc for nc in NeuronClass.objects.all()}
+    prepared = prepare_gcamp_data(self, path_json, checksum, paper_id, neuron_class_name_map, neuron_name_map)
+    try:
+        save_gcamp_data(self, prepared, neuron_class_cache)
+    finally:
+        remove_trace_files(prepared)
+
+def remove_trace_files(prepared):
+    """Remove the work files of prepare_gcamp_data (the trace stores are staged by then)."""
+    remove_trace_file(prepared["trace"])
+    remove_trace_file(prepared["trace_original"])
 
 def import_all_paper(self):
     path_paper_json = get_dataset_path(PATH_PAPER)
@@ -395,7 +572,10 @@ def import_all_paper(self):
     n_fail = 0
     for paper in papers:
         try:
-            GCaMPPaper.objects.create(paper_id=paper["paper_id"], title_short=paper["title_short"], title_full=paper["title_full"])
+            GCaMPPaper.objects.update_or_create(
+                paper_id=paper["paper_id"],
+                defaults={"title_short": paper["title_short"], "title_full": paper["title_full"]}
+            )
             n += 1
         except Exception as e:
             self.stdout.write(self.style.WARNING(f"Error importing paper: {e}"))
@@ -412,14 +592,21 @@ def import_all_type(self):
     for paper_id in types.keys():
         paper = GCaMPPaper.objects.get(paper_id=paper_id) if paper_id != "common" else None
         for type_ in types[paper_id]:
-            if paper:
-                GCaMPDatasetType.objects.create(type_id=paper_id+"-"+type_["id"], name=type_["name"], description=type_["description"], color_background=type_["color_background"], paper=paper)
-            else:
-                GCaMPDatasetType.objects.create(type_id=paper_id+"-"+type_["id"], name=type_["name"], description=type_["description"], color_background=type_["color_background"])
+            GCaMPDatasetType.objects.update_or_create(
+                type_id=paper_id+"-"+type_["id"],
+                defaults={"name": type_["name"], "description": type_["description"], "color_background": type_["color_background"], "paper": paper}
+            )
             n += 1
     self.stdout.write(self.style.SUCCESS(f"Successfully imported {n} dataset types"))
 
-def import_all_gcamp(self):
+def import_all_gcamp(self, incremental=False, workers=1, batch_size=10, stream=False):
+    """
+    Import all GCaMP datasets. The files are parsed and processed in a pool of worker processes
+    and saved by this process in transactions of batch_size datasets.
+    With incremental, files whose checksum is already in the DB are skipped (changed files are re-imported).
+    With stream, the files are decoded incrementally (see load_json_stream), so a worker holds one
+    trace of a dataset in memory instead of the whole file.
+    """
     t1 = time.time_ns()
     papers = GCaMPPaper.objects.values_list("paper_id")
 
@@ -432,7 +619,10 @@ def import_all_gcamp(self):
     with open(path_checksumn, 'r') as file:
         dict_checksum = json.load(file)
 
-    n = 0
+    set_checksum_db = set(GCaMPDataset.objects.values_list("dataset_sha256", flat=True)) if incremental else set()
+
+    list_task = []
+    n_skip = 0
     for paper_ in papers:
         paper_id = paper_[0]
         dir_datasets = get_dataset_path(["activity", "data", paper_id])
@@ -440,24 +630,70 @@ def import_all_gcamp(self):
         json_files = [f for f in os.listdir(dir_datasets) if f.endswith('.json')]
         
         for filename in json_files:
-            # try:
             filepath = get_dataset_path(["activity", "data", paper_id, filename])
             checksum = sha256(filepath)
             assert checksum == dict_checksum[paper_id][filename], f"GCaMP checksum error for {paper_id} {filename}"
 
-            import_gcamp_data(self, filepath, checksum, paper_id, neuron_class_name_map, neuron_name_map)
-            n = n + 1
-            # except Exception as e:
-            #     self.stdout.write(self.style.WARNING(f"Error importing GCaMP dataset: {filename} error: {e}"))
-            self.stdout.write(self.style.NOTICE(f"Processed {filename}"))
+            if checksum in set_checksum_db:
+                n_skip += 1
+                continue
+            list_task.append((filepath, checksum, paper_id, neuron_class_name_map, neuron_name_map, stream))
+
+    neuron_class_cache = {nc.name: nc for nc in NeuronClass.objects.all()}
+
+    def save_batch(batch):
+        try:
+            with transaction.atomic():
+                for prepared in batch:
+                    save_gcamp_data(self, prepared, neuron_class_cache)
+        finally:
+            for prepared in batch:
+                remove_trace_files(prepared)
+        for prepared in batch:
+            self.stdout.write(self.style.NOTICE(f"Processed {prepared['dataset']['dataset_id']}"))
+
+    n = 0
+    batch = []
+    with ExitStack() as stack:
+        if workers > 1 and len(list_task) > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=django.setup))
+            results = executor.map(prepare_gcamp_data_worker, list_task)
+        else:
+            results = (prepare_gcamp_data(self, *task) for task in list_task)
+        # work files of the datasets not saved when an import fails
+        stack.callback(lambda: [remove_trace_files(prepared) for prepared in batch])
+
+        for prepared in results:
+            batch.append(prepared)
+            if len(batch) >= batch_size:
+                save_batch(batch)
+                n += len(batch)
+                batch.clear()
+        if batch:
+            save_batch(batch)
+            n += len(batch)
+            batch.clear()
 
     t2 = time.time_ns()
+    if n_skip > 0:
+        self.stdout.write(self.style.NOTICE(f"Skipped {n_skip} unchanged GCaMP datasets"))
     self.stdout.write(self.style.SUCCESS(f"Successfully imported {n} GCaMP datasets. Time: {(t2-t1)/1e9} s"))
 
 class Command(BaseCommand):
     help = 'Import and initialize all GCaMP datasets'
 
+    def add_arguments(self, parser):
+        parser.add_argument("--incremental", action="store_true",
+                            help="Skip the datasets whose checksum is already imported and re-import the changed ones")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of worker processes parsing and processing the dataset files")
+        parser.add_argument("--batch-size", type=int, default=10,
+                            help="Number of datasets saved per transaction")
+        parser.add_argument("--stream", action="store_true",
+                            help="Decode the dataset files incrementally, one trace at a time, to bound the memory usage")
+
     def handle(self, *args, **options):
         import_all_paper(self)
         import_all_type(self)
-        import_all_gcamp(self)
\ No newline at end of file
+        import_all_gcamp(self, incremental=options["incremental"], workers=options["workers"],
+                         batch_size=options["batch_size"], stream=options["stream"])
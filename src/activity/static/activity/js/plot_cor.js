@@ -0,0 +1,100 @@
+import { fetchBinary } from './plot_data.js';
+
+/**
+ * Index of the pair (i, j) (1-based idx_neuron, i != j) in the packed upper triangle of an n x n matrix.
+ * Same order as activity/correlation.py: (1,2), (1,3), ..., (1,n), (2,3), ...
+ */
+export function getPackedIndex(n, i, j) {
+    const a = Math.min(i, j) - 1;
+    const b = Math.max(i, j) - 1;
+    return a * n - a * (a + 1) / 2 + (b - a - 1);
+}
+
+/*
+    Neuron-pair and neuron-behavior correlation of a dataset, fetched lazily from the correlation API
+    one set of matrix rows (neurons) at a time.
+ */
+export class CorrelationData {
+    constructor(datasetId) {
+        this.datasetId = datasetId;
+        this.nNeuron = 0;
+        this.rows = {}; // idx_neuron -> full matrix row (Float32Array)
+        this.behavior = {};
+        this.rowPromise = {}; // idx_neuron -> pending request
+    }
+
+    /**
+     * Fetches the rows of the neurons that are not loaded or pending yet in one request.
+     * @param {Array<number|string>} listIdxNeuron
+     * @returns {Promise<CorrelationData>}
+     */
+    loadRows(listIdxNeuron) {
+        const listIdx = [...new Set(listIdxNeuron.map(idx => parseInt(idx)))].filter(idx => !isNaN(idx));
+        const listMissing = listIdx.filter(idx => !(idx in this.rows) && !(idx in this.rowPromise));
+
+        if (listMissing.length > 0) {
+            const promise = fetchBinary(`/activity/api/data/${this.datasetId}/correlation/?n=${listMissing.join('-')}&dtype=f16`)
+                .then(({ header, rows }) => {
+                    this.nNeuron = header.n_neuron;
+                    header.idx_neuron.forEach((idx, i) => {
+                        this.rows[idx] = rows[i];
+                    });
+                    Object.assign(this.behavior, header.behavior);
+                })
+                .finally(() => {
+                    listMissing.forEach(idx => delete this.rowPromise[idx]);
+                });
+            listMissing.forEach(idx => { this.rowPromise[idx] = promise; });
+        }
+
+        const listPending = [...new Set(listIdx.filter(idx => idx in this.rowPromise).map(idx => this.rowPromise[idx]))];
+        return Promise.all(listPending).then(() => this);
+    }
+
+    /**
+     * Returns the correlation between two neurons, or null if not available (neither row loaded, same neuron or NaN).
+     */
+    getNeuron(idxNeuron1, idxNeuron2) {
+        const i = parseInt(idxNeuron1);
+        const j = parseInt(idxNeuron2);
+        if (i === j) {
+            return null;
+        }
+
+        let value;
+        if (i in this.rows && j >= 1 && j <= this.nNeuron) {
+            value = this.rows[i][j - 1];
+        } else if (j in this.rows && i >= 1 && i <= this.nNeuron) {
+            value = this.rows[j][i - 1];
+        } else {
+            return null;
+        }
+        // the values are stored with 3 decimals, round off the float16 representation error
+        return isNaN(value) ? null : Math.round(value * 1000) / 1000;
+    }
+
+    /**
+     * Returns the correlations of a (loaded) neuron with all other neurons as [{idx_neuron_other, correlation}].
+     */
+    getNeuronRow(idxNeuron) {
+        const listCorPair = [];
+        for (let idxOther = 1; idxOther <= this.nNeuron; idxOther++) {
+            const corValue = this.getNeuron(idxNeuron, idxOther);
+            if (corValue !== null) {
+                listCorPair.push({ idx_neuron_other: idxOther, correlation: corValue });
+            }
+        }
+        return listCorPair;
+    }
+
+    /**
+     * Returns the correlation between a (loaded) neuron and a behavior, or null if not available.
+     */
+    getBehavior(idxNeuron, behaviorCode) {
+        const corNeuron = this.behavior[idxNeuron];
+        if (corNeuron && typeof corNeuron[behaviorCode] === 'number') {
+            return corNeuron[behaviorCode];
+        }
+        return null;
+    }
+}
@@ -341,3 +341,84 @@ export function adjustWidth(containerId, plotId, targetWidth = null) {
     const newWidth = targetWidth || containerWidth * 0.925;
     Plotly.relayout(plotId, { width: newWidth });
 }
+
+/*
+*   Binary wire format (see activity/wire_format.py)
+*   magic "WWWB" | uint32 header length | JSON header | raw little-endian array
+*/
+const BINARY_MAGIC = "WWWB";
+
+function float16ToFloat32(h) {
+    const sign = (h & 0x8000) ? -1 : 1;
+    const exponent = (h >> 10) & 0x1f;
+    const fraction = h & 0x03ff;
+
+    if (exponent === 0) {
+        return sign * Math.pow(2, -14) * (fraction / 1024);
+    } else if (exponent === 0x1f) {
+        return fraction ? NaN : sign * Infinity;
+    }
+    return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+}
+
+/**
+ * Decodes a binary payload into its header and one typed array per row.
+ * @param {ArrayBuffer} buffer - The response body.
+ * @returns {{header: Object, rows: Float32Array[]}}
+ */
+export function decodeBinary(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== BINARY_MAGIC) {
+        throw new Error("Invalid binary payload");
+    }
+
+    const nHeader = view.getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, nHeader)));
+    const offset = 8 + nHeader;
+
+    // rows span the last axis, e.g. (n_neuron, n_t) or (stat, n_neuron, n_bin) for pyramid levels
+    const shape = header.shape;
+    const nCol = shape.length > 0 ? shape[shape.length - 1] : 0;
+    const nRow = shape.slice(0, -1).reduce((a, b) => a * b, 1);
+    const nValue = nRow * nCol;
+
+    // the header is padded so the array offset is aligned for typed array views
+    let values;
+    if (header.dtype === "float32") {
+        values = new Float32Array(buffer, offset, nValue);
+    } else if (header.dtype === "float16") {
+        values = Float32Array.from(new Uint16Array(buffer, offset, nValue), float16ToFloat32);
+    } else {
+        throw new Error(`Unsupported dtype: ${header.dtype}`);
+    }
+
+    const rows = [];
+    for (let i = 0; i < nRow && nCol > 0; i++) {
+        rows.push(values.subarray(i * nCol, (i + 1) * nCol));
+    }
+
+    return { header: header, rows: rows };
+}
+
+/**
+ * Fetches and decodes a binary payload.
+ * @param {string} url - The endpoint URL (the binary format is requested via the Accept header).
+ * @returns {Promise<{header: Object, rows: Float32Array[]}>}
+ */
+export async function fetchBinary(url) {
+    const response = await fetch(url, { headers: { "Accept": "application/octet-stream" } });
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+
+    return decodeBinary(await response.arrayBuffer());
+}
+
+/**
+ * Converts a decoded row to a plain array, rounding off the float32 representation error.
+ */
+export function rowToList(row, decimals = 6) {
+    const factor = Math.pow(10, decimals);
+    return Array.from(row, v => Math.round(v * factor) / factor);
+}
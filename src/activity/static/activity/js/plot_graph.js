@@ -7,10 +7,10 @@ import { PLOTLY_COLOR_SCALES, getNodeColor, updateColorBar } from '/static/core/
 import { CONNECTOME_DATASET_ID_TO_DATASET_NAME, URL_CONNECTOME_EDGE, cellTypeDict, ntTypeDict } from '/static/core/js/constants.js';
 
 export class PlotGraph {
-    constructor(graphId, data) {
+    constructor(graphId, data, cor) {
         this.element = document.getElementById(graphId);
         
-        this.corNeuron = data.cor.neuron // neuron-pair correlation
+        this.cor = cor // neuron-pair correlation (CorrelationData)
 
         this.neuronToIdxNeuron = {}
         this.availableNeurons = []
@@ -103,7 +103,7 @@ export class PlotGraph {
             //
             // node
             //
-            this.graph.on('select', 'node', (event) => {
+            this.graph.on('select', 'node', async (event) => {
                 const selectedNode = event.target; // The selected node
                 const connectedEdges = selectedNode.connectedEdges(); // Get edges connected to the selected node
                 const connectedNodes = connectedEdges.connectedNodes(); // Get nodes connected via these edges
@@ -133,6 +133,15 @@ export class PlotGraph {
 
                 const colormapName = "PiYG"
                 const idxSelected = this.neuronToIdxNeuron[selectedNodeId]
+                if (idxSelected !== undefined) {
+                    try {
+                        await this.cor.loadRows([idxSelected]);
+                    } catch (error) {
+                        console.error("Failed to load the correlation data:", error);
+                    }
+                    // the selection may have changed while loading
+                    if (!selectedNode.selected()) return;
+                }
                 const vmin = -1;
                 const vmax = 1;
 
@@ -146,8 +155,7 @@ export class PlotGraph {
     
                     if (nodeId in this.neuronToIdxNeuron && nodeId !== selectedNodeData.id) {
                         const idxTarget = this.neuronToIdxNeuron[nodeId]                            
-                        const value = this.corNeuron[`${idxSelected},${idxTarget}`] ??
-                            this.corNeuron[`${idxTarget},${idxSelected}`] ?? null;
+                        const value = this.cor.getNeuron(idxSelected, idxTarget);
 
                         const color = value ? getNodeColor(value, vmin, vmax, colormapName) : "rgb(221,221,221)"
                         if (["u", "b"].includes(cellType)) {
@@ -272,7 +280,7 @@ export class PlotGraph {
         }
     
         // this.corNeuron
-        renderInfoPanel(node) {
+        async renderInfoPanel(node) {
             if (document.fullscreenElement) {
                 document.getElementById("info-panel").remove()
                 this.infoPanel.injectInfoPanelHTML("info-panel", document.fullscreenElement)
@@ -283,6 +291,7 @@ export class PlotGraph {
 
             const nodeData = node.data();
             const nodeId = nodeData.id;
+            this.infoPanelNodeId = nodeId;
             const cellClass = nodeData.neuron_class;
             const cellType = nodeData.cell_type;
             const cellTypeDesc = nodeData.cell_type_desc;
@@ -398,6 +407,13 @@ export class PlotGraph {
         if (Object.prototype.hasOwnProperty.call(this.neuronToIdxNeuron, nodeId)) {
             const corList = [];
             const thisIdx = this.neuronToIdxNeuron[nodeId];
+            try {
+                await this.cor.loadRows([thisIdx]);
+            } catch (error) {
+                console.error("Failed to load the correlation data:", error);
+            }
+            // another node may have been opened while loading
+            if (this.infoPanelNodeId !== nodeId) return;
           
             this.jsonData.synapses.forEach((synapse) => {
               // Only proceed if it's a valid, non-self synapse
@@ -417,10 +433,7 @@ export class PlotGraph {
                     : this.neuronToIdxNeuron[synapse.post];
           
                   // retrieve correlation (fallback to 0 if undefined)
-                  const corVal =
-                    this.corNeuron[`${idxPre},${idxPost}`] ??
-                    this.corNeuron[`${idxPost},${idxPre}`] ??
-                    0;
+                  const corVal = this.cor.getNeuron(idxPre, idxPost) ?? 0;
           
                   corList.push({
                     pre: synapse.pre,
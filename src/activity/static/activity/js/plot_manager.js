@@ -5,8 +5,11 @@ import {
     initEvent,
     toggleEvent,
     initReversal,
-    toggleReversal
+    toggleReversal,
+    fetchBinary,
+    rowToList
 } from './plot_data.js';
+import { CorrelationData } from './plot_cor.js';
 
 import { removeFromList, minArray, maxArray, initSwitch, getLocalBool } from '/static/core/js/utility.js';
 
@@ -22,6 +25,9 @@ export class NeuronBehaviorPlot {
         }
 
         this.data = data;
+
+        // correlation data (rows fetched from the correlation API when needed)
+        this.cor = new CorrelationData(data.dataset_id);
         
         // collapse for cor
         this.collapseCorElement = document.getElementById('collapseCor');
@@ -38,6 +44,8 @@ export class NeuronBehaviorPlot {
 
         // Neuron trace cache
         this.trace = {};
+        // Time point indices of the traces that were sliced/downsampled on the server (see t_start, t_end, max_points)
+        this.traceT = {};
 
         // Style configurations
         this.colorReversal = 'rgba(255, 0, 0, 0.15)';
@@ -163,40 +171,72 @@ export class NeuronBehaviorPlot {
 
     /**
      * Retrieves the trace data for a given neuron index.
+     * Traces requested in the same tick are fetched together with one batch request.
      * @param {number|string} idxNeuron - The index of the neuron.
      * @returns {Promise<Array>} A promise that resolves to the trace data.
      */
-    async getTrace(idxNeuron) {
+    getTrace(idxNeuron) {
         if (idxNeuron in this.trace) {
             // Loading from cache
-            return this.trace[idxNeuron];
-        } else {
-            const fullUrl = `/activity/api/data/${this.data["dataset_id"]}/${idxNeuron}/`;
-            try {
-                const response = await fetch(fullUrl);
-                if (!response.ok) {
-                    throw new Error(`HTTP error! status: ${response.status}`);
-                }
-                const data = await response.json();
-                this.trace[idxNeuron] = data["trace"];
-                return data["trace"];
-            } catch (error) {
-                console.error("Error fetching data:", error);
-                throw error;
+            return Promise.resolve(this.trace[idxNeuron]);
+        }
+
+        if (!this.traceBatch) {
+            const batch = { listIdxNeuron: [] };
+            batch.promise = new Promise(resolve => setTimeout(resolve, 0))
+                .then(() => {
+                    // close the batch so later requests start a new one
+                    this.traceBatch = null;
+                    return this.fetchTraces(batch.listIdxNeuron);
+                });
+            this.traceBatch = batch;
+        }
+        if (!this.traceBatch.listIdxNeuron.includes(idxNeuron)) {
+            this.traceBatch.listIdxNeuron.push(idxNeuron);
+        }
+
+        return this.traceBatch.promise.then(() => {
+            if (!(idxNeuron in this.trace)) {
+                throw new Error(`Trace of neuron ${idxNeuron} not found.`);
             }
+            return this.trace[idxNeuron];
+        });
+    }
+
+    /**
+     * Fetches the traces of multiple neurons with the batch endpoint and stores them in the trace cache.
+     * @param {Array<number|string>} listIdxNeuron - The indices of the neurons.
+     * @returns {Promise<void>}
+     */
+    async fetchTraces(listIdxNeuron) {
+        // float32 binary payload: ~2.5x smaller than JSON and no float parsing
+        const fullUrl = `/activity/api/data/${this.data["dataset_id"]}/traces/?n=${listIdxNeuron.join('-')}&format=bin`;
+        try {
+            const { header, rows } = await fetchBinary(fullUrl);
+            header["idx_neuron"].forEach((idxNeuron, i) => {
+                this.trace[idxNeuron] = rowToList(rows[i]);
+            });
+        } catch (error) {
+            console.error("Error fetching data:", error);
+            throw error;
         }
     }
 
     /**
      * Plots a neuron on the graph, ensuring sequential execution.
+     * The trace is requested right away so that neurons added together share one batch request.
      * @param {number|string} idxNeuron - The index of the neuron to plot.
      * @param {string} label - The label for the neuron trace.
      * @returns {Promise<void>}
      */
     plotNeuronSequential(idxNeuron, label) {
+        const tracePromise = this.getTrace(idxNeuron);
+        // errors are handled when the trace is awaited in plotNeuron
+        tracePromise.catch(() => {});
+
         // Chain the plotNeuron calls to ensure sequential execution
         this.lastPlotPromise = this.lastPlotPromise
-            .then(() => this.plotNeuron(idxNeuron, label))
+            .then(() => this.plotNeuron(idxNeuron, label, tracePromise))
             .catch(error => {
                 // Handle individual plot errors without stopping the chain
                 console.error(`Error plotting neuron ${idxNeuron}:`, error);
@@ -209,16 +249,17 @@ export class NeuronBehaviorPlot {
      * @private
      * @param {number|string} idxNeuron - The index of the neuron to plot.
      * @param {string} label - The label for the neuron trace.
+     * @param {Promise<Array>} [tracePromise] - Pending trace request, if already started.
      * @returns {Promise<void>}
      */
-    async plotNeuron(idxNeuron, label) {
+    async plotNeuron(idxNeuron, label, tracePromise = null) {
         try {
             // Show spinner if available
             if (this.spinner) {
                 this.spinner.style.display = "block";
             }
 
-            const trace = await this.getTrace(idxNeuron);
+            const trace = await (tracePromise || this.getTrace(idxNeuron));
             const traceId = `n_${idxNeuron}`;
 
             // Get color index and assign color
@@ -227,9 +268,11 @@ export class NeuronBehaviorPlot {
             const color = getCycleColor(colorIndex);
 
             // Plot the neuron using the imported plotNeuron function
+            const listT = idxNeuron in this.traceT ?
+                this.traceT[idxNeuron].map(n => n * this.avgTimestep) : this.listTMinute;
             plotNeuronFunction(
                 this.plotElementId,
-                this.listTMinute,
+                listT,
                 trace,
                 label,
                 traceId,
@@ -553,7 +596,17 @@ export class NeuronBehaviorPlot {
         }
     }
 
-    renderCor() {
+    async renderCor() {
+        // rendered when the correlation collapse is shown
+        if (!this.collapseCorElement.classList.contains("show")) {
+            return;
+        }
+        try {
+            await this.cor.loadRows(this.listIdxPlot);
+        } catch (error) {
+            console.error("Failed to load the correlation data:", error);
+            return;
+        }
         this.renderCorNeuron();
         this.renderCorBehavior();
         this.renderCorOthers();
@@ -570,9 +623,9 @@ export class NeuronBehaviorPlot {
 
             // Extract correlation values for each plotted neuron
             this.listIdxPlot.forEach((idxNeuron, iNeuron) => {
-                if (data.cor.behavior[idxNeuron] && typeof data.cor.behavior[idxNeuron][behaviorCode] === 'number') {
-                    const corValue = data.cor.behavior[idxNeuron][behaviorCode];
-                    const neuronName = data.neuron[idxNeuron] ? data.neuron[idxNeuron].name : `Neuron ${idxNeuron}`;
+                const corValue = this.cor.getBehavior(idxNeuron, behaviorCode);
+                if (corValue !== null) {
+                    const neuronName = this.data.neuron[idxNeuron] ? this.data.neuron[idxNeuron].name : `Neuron ${idxNeuron}`;
 
                     behaviorPairs.push({
                         name: neuronName,
@@ -652,20 +705,10 @@ export class NeuronBehaviorPlot {
                 for (let j = 0; j < i; j++) { // j < i ensures unique pairs and skips self-correlation
                     const idxNeuron1 = this.listIdxPlot[j];
                     const idxNeuron2 = this.listIdxPlot[i];
-                    const corNeuralKey = `${idxNeuron1},${idxNeuron2}`;
-                    let cor_;
-
-                    // Attempt to retrieve the correlation using the original key
-                    if (corNeuralKey in this.data.cor.neuron) {
-                        cor_ = this.data.cor.neuron[corNeuralKey];
-                    } else {
-                        // If not found, try the reversed key
-                        const reverseKey = `${idxNeuron2},${idxNeuron1}`;
-                        cor_ = this.data.cor.neuron[reverseKey] !== undefined ? this.data.cor.neuron[reverseKey] : null;
-                    }
+                    const cor_ = this.cor.getNeuron(idxNeuron1, idxNeuron2);
 
                     // Proceed only if a valid correlation coefficient is found
-                    if (cor_ !== null && !isNaN(cor_)) {
+                    if (cor_ !== null) {
                         const neuron1 = this.data.neuron[idxNeuron1];
                         const neuron2 = this.data.neuron[idxNeuron2];
 
@@ -744,20 +787,8 @@ export class NeuronBehaviorPlot {
         this.listIdxPlot.forEach((idxNeuron, iNeuron) => {
             const neuronName = this.data.neuron[idxNeuron].name
             const neuronColor = getCycleColor(iNeuron);
-            const listCorPair = [];
-
             // Extract correlation values for each neuron
-            Object.keys(this.data.cor.neuron).forEach(key => {
-                const [neuron1, neuron2] = key.split(',').map(str => parseInt(str));
-                if (neuron1 == idxNeuron || neuron2 == idxNeuron) {
-                    const otherNeuron = neuron1 == idxNeuron ? neuron2 : neuron1;
-                    const corValue = this.data.cor.neuron[key];
-                    listCorPair.push({
-                        idx_neuron_other: otherNeuron,
-                        correlation: corValue,
-                    });
-                }
-            });
+            const listCorPair = this.cor.getNeuronRow(idxNeuron);
 
             // Sort by descending absolute correlation values and take top 3
             listCorPair.sort((a, b) => Math.abs(b.correlation) - Math.abs(a.correlation));
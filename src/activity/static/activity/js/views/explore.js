@@ -23,6 +23,9 @@ function initPlotManager(data) {
         if (initNeuronData) {
             Object.keys(initNeuronData).forEach((idxNeuron) => {
                 plotManager.trace[idxNeuron] = initNeuronData[idxNeuron]["trace"];
+                if (initNeuronData[idxNeuron]["t"]) {
+                    plotManager.traceT[idxNeuron] = initNeuronData[idxNeuron]["t"];
+                }
             });
         }
 
@@ -70,7 +73,7 @@ document.addEventListener('DOMContentLoaded', async () => {
         setLocalStr("activity_connectome_layout", "grid")
     }      
     const isNeuroPAL = "common-neuropal" in data.dataset_type;
-    const plotGraph = isNeuroPAL ? new PlotGraph("connectome-graph", data) : null;
+    const plotGraph = isNeuroPAL ? new PlotGraph("connectome-graph", data, plotManager.cor) : null;
     const datasetSelector = isNeuroPAL ? new DatasetSelector("select-dataset", plotGraph) : null;
 
     /*
@@ -1,3 +1,458 @@
-from django.test import TestCase
+import json
+import math
+import os
+import struct
+import tempfile
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from scipy.stats import pearsonr
+
+from activity.correlation import pack_correlation_matrix, unpack_correlation, get_packed_index
+from activity.models import GCaMPDataset, GCaMPNeuron, GCaMPPaper
+from activity.views import MAX_BATCH_NEURON, parse_list_idx_neuron
+from activity.management.commands.init_data_gcamp import truncate_floats_in_list, calculate_cor_behavior, calculate_cor_neuron
+from activity.downsample import lttb_indices, slice_and_downsample
+from activity.trace_store import (
+    TRACE_STORE_DTYPE, _TRACE_STORES, get_trace_store_path, stage_trace_store, write_trace_store, load_trace_store,
+    row_to_list, get_trace_row, get_trace_rows, get_trace_array, PYRAMID_MIN_POINTS, PYRAMID_STATS, build_pyramid,
+    write_pyramid, load_pyramid, get_pyramid_window
+)
+from activity.wire_format import BINARY_MAGIC, BINARY_DTYPES, get_binary_dtype, encode_binary, decode_binary
+from core.caching import reset_dataset_versions
+
+
+'''
+
+Reference (per-element) implementations of the import math
+
+'''
+def truncate_floats_in_list_reference(numbers, n=6):
+    factor = 10.0 ** n
+    return [math.trunc(num * factor) / factor for num in numbers]
+
+def calculate_cor_behavior_reference(list_trace_array, data):
+    keys = ["velocity", "head_curvature", "pumping", "angular_velocity"]
+    key_conversion = {"velocity": "v", "head_curvature": "hc", "pumping": "f", "angular_velocity": "av"}
+
+    result = {}
+    for i, trace in enumerate(list_trace_array, 1):
+        result[i] = {}
+        for variable_name in keys:
+            if variable_name in data:
+                variable_data = data[variable_name]
+                key_save = key_conversion[variable_name]
+                if np.sum(variable_data) == 0.:
+                    result[i][key_save] = 0.
+                else:
+                    min_length = min(len(trace), len(variable_data))
+                    correlation, _ = pearsonr(trace[:min_length], variable_data[:min_length])
+                    result[i][key_save] = np.around(correlation, 6)
+
+    return result
+
+def correlation_matrix_to_dict_reference(corr_matrix):
+    correlation_dict = {}
+    num_traces = corr_matrix.shape[0]
+    for i in range(num_traces):
+        for j in range(i + 1, num_traces):
+            correlation_dict[f"{i+1},{j+1}"] = corr_matrix[i][j]
+
+    return correlation_dict
+
+def lttb_indices_reference(y, n_out):
+    # one row at a time, as in the original LTTB algorithm (Steinarsson 2013), with the bucket edges
+    # floor(i * (n - 2) / (n_out - 2)) + 1 in integers
+    n = len(y)
+    def edge(i):
+        return i * (n - 2) // (n_out - 2) + 1
+
+    a = 0
+    indices = [0]
+    for i in range(n_out - 2):
+        avg_start = edge(i + 1)
+        avg_end = min(edge(i + 2), n)
+        avg_x = sum(range(avg_start, avg_end)) / (avg_end - avg_start)
+        avg_y = sum(y[avg_start:avg_end]) / (avg_end - avg_start)
+
+        max_area = -1
+        for j in range(edge(i), edge(i + 1)):
+            area = abs((a - avg_x) * (y[j] - y[a]) - (a - j) * (avg_y - y[a])) * 0.5
+            if area > max_area:
+                max_area = area
+                next_a = j
+        a = next_a
+        indices.append(a)
+    indices.append(n - 1)
+
+    return indices
+
+def reduce_bins_reference(row, size_bin, bin_start, bin_end):
+    # {stat: [value of each bin]} of the bins [bin_start, bin_end) of size_bin samples
+    bins = [row[j * size_bin:(j + 1) * size_bin] for j in range(bin_start, bin_end)]
+    return {"mean": [np.mean(b) for b in bins], "min": [np.min(b) for b in bins], "max": [np.max(b) for b in bins]}
+
+def build_pyramid_reference(array):
+    n = array.shape[1]
+    levels = []
+    k = 1
+    while math.ceil(n / 2**k) >= PYRAMID_MIN_POINTS:
+        stats = [reduce_bins_reference(row, 2**k, 0, math.ceil(n / 2**k)) for row in array]
+        levels.append(np.array([[row_stats[stat] for row_stats in stats] for stat in PYRAMID_STATS]))
+        k += 1
+
+    return levels
+
+
+class ImportMathTest(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.list_trace_array = rng.normal(size=(30, 500)).tolist()
+        self.data = {
+            "velocity": rng.normal(size=500).tolist(),
+            "head_curvature": rng.normal(size=500).tolist(),
+            "angular_velocity": rng.normal(size=510).tolist(),  # longer than the traces
+        }
+
+    def test_truncate_floats_in_list(self):
+        for numbers in (self.list_trace_array[0], [-1e-9, -0.0, 0.0, 1, -2, 3.999999999, -3.9999999], [7, 8, 9]):
+            for n in (5, 6):
+                self.assertEqual(truncate_floats_in_list(numbers, n), truncate_floats_in_list_reference(numbers, n))
+        # -0.0 is truncated to 0.0, not -0.0
+        self.assertEqual(str(truncate_floats_in_list([-1e-9])), str(truncate_floats_in_list_reference([-1e-9])))
+
+        with self.assertRaises(TypeError):
+            truncate_floats_in_list((1.0, 2.0))
+        with self.assertRaises(ValueError):
+            truncate_floats_in_list([1.0, "a"])
+
+    def test_calculate_cor_behavior(self):
+        list_trace_array = self.list_trace_array + [[1.0] * 500]  # constant trace
+        result = calculate_cor_behavior(list_trace_array, self.data)
+        reference = calculate_cor_behavior_reference(list_trace_array, self.data)
+
+        self.assertEqual(list(result.keys()), list(reference.keys()))
+        for i in reference:
+            self.assertEqual(list(result[i].keys()), list(reference[i].keys()))
+            for key in reference[i]:
+                if np.isnan(reference[i][key]):
+                    self.assertTrue(np.isnan(result[i][key]))
+                else:
+                    # at most one unit of the 6th decimal apart (summation order)
+                    self.assertAlmostEqual(result[i][key], reference[i][key], delta=1.01e-6)
+
+    def test_calculate_cor_behavior_blocks(self):
+        # memory-mapped traces are read block_size neurons at a time
+        trace_array = np.asarray(self.list_trace_array)
+        self.assertEqual(calculate_cor_behavior(trace_array, self.data, block_size=7),
+                         calculate_cor_behavior(self.list_trace_array, self.data))
+
+    def test_calculate_cor_neuron(self):
+        list_trace_array = self.list_trace_array + [[1.0] * 500]  # constant trace
+        with np.errstate(invalid="ignore", divide="ignore"):
+            reference = np.corrcoef(list_trace_array)
+        for block_size in (7, 100):
+            result = calculate_cor_neuron(np.asarray(list_trace_array), block_size=block_size)
+            np.testing.assert_allclose(result, reference, rtol=0, atol=1e-12)
+
+    def test_calculate_cor_behavior_zero_variable(self):
+        data = {"velocity": [0.] * 500, "head_curvature": self.data["head_curvature"]}
+        result = calculate_cor_behavior(self.list_trace_array, data)
+        self.assertEqual(result[1]["v"], 0.)
+
+    def test_pack_correlation_matrix(self):
+        corr_matrix = np.around(np.corrcoef(self.list_trace_array), 3)
+        n = corr_matrix.shape[0]
+        packed = unpack_correlation(pack_correlation_matrix(corr_matrix), n)
+        reference = correlation_matrix_to_dict_reference(corr_matrix)
+
+        self.assertEqual(len(packed), len(reference))
+        for key, value in reference.items():
+            i, j = map(int, key.split(","))
+            self.assertEqual(packed[get_packed_index(n, i, j)], np.float16(value))
+            self.assertEqual(get_packed_index(n, i, j), get_packed_index(n, j, i))
+
+        # datasets imported with the "i,j" dict format
+        np.testing.assert_array_equal(unpack_correlation(reference, n), packed)
+
+
+class TraceStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.enterContext(override_settings(TRACE_STORE_DIR=self.enterContext(tempfile.TemporaryDirectory())))
+        _TRACE_STORES.clear()
+        self.addCleanup(_TRACE_STORES.clear)
+
+        rng = np.random.default_rng(0)
+        # more rows than TRACE_STORE_BLOCK, truncated to 6 decimals like the DB values
+        self.array = np.array(truncate_floats_in_list(rng.normal(scale=3, size=250 * 40).tolist())).reshape(250, 40)
+
+    def test_stage_publish(self):
+        publish = stage_trace_store("d", self.array)
+        # not visible before publish
+        self.assertIsNone(load_trace_store("d"))
+        self.assertIsNone(get_trace_row("d", 1))
+        self.assertEqual(publish(), get_trace_store_path("d"))
+        np.testing.assert_array_equal(load_trace_store("d"), self.array.astype(np.float32))
+        self.assertFalse(os.path.exists(get_trace_store_path("d") + ".tmp"))
+
+    def test_registry(self):
+        write_trace_store("d", self.array)
+        store = load_trace_store("d")
+        self.assertIs(load_trace_store("d"), store)
+        # a republished store replaces the memory-mapped one
+        write_trace_store("d", self.array[:10] + 1)
+        self.assertIsNot(load_trace_store("d"), store)
+        self.assertEqual(load_trace_store("d").shape, (10, 40))
+        self.assertEqual(get_trace_row("d", 1), row_to_list(self.array[0].astype(np.float32) + 1))
+
+    def test_rows_bounds(self):
+        write_trace_store("d", self.array)
+        for idx in (0, -1, 251):
+            self.assertIsNone(get_trace_row("d", idx))
+            self.assertIsNone(get_trace_rows("d", [1, idx]))
+            self.assertIsNone(get_trace_array("d", [1, idx]))
+        self.assertIsNone(get_trace_rows("x", [1]))
+        self.assertIsNone(get_trace_array("x", [1]))
+
+        self.assertEqual(get_trace_row("d", 250), self.array[249].tolist())
+        self.assertEqual(get_trace_rows("d", [3, 1]), {3: self.array[2].tolist(), 1: self.array[0].tolist()})
+        np.testing.assert_array_equal(get_trace_array("d", [3, 1]), self.array[[2, 0]].astype(np.float32))
+
+    def test_row_to_list_tolerance(self):
+        rng = np.random.default_rng(1)
+        x = np.array(truncate_floats_in_list((rng.uniform(-1, 1, 20000) * np.logspace(-3, 4, 20000)).tolist()))
+        values = np.array(row_to_list(x.astype(TRACE_STORE_DTYPE)))
+        # same values as the DB below 16, within half a float32 ulp (and the rounding) above
+        small = np.abs(x) < 16
+        np.testing.assert_array_equal(values[small], x[small])
+        self.assertTrue(np.all(np.abs(values - x) <= np.abs(x) * 2**-24 + 0.5e-6))
+        self.assertTrue(np.any(values[~small] != x[~small]))
+
+
+class DownsampleTest(SimpleTestCase):
+    def test_lttb_indices(self):
+        rng = np.random.default_rng(0)
+        # integers: the bucket sums are exact and the ties are broken the same way
+        for y in (rng.normal(size=(4, 1000)), rng.integers(-3, 4, size=(4, 1000)).astype(float), rng.normal(size=(2, 7))):
+            for n_out in sorted({3, 4, 5, 6, 10, 99, 500, y.shape[1] - 1} & set(range(y.shape[1]))):
+                indices = lttb_indices(y, n_out)
+                self.assertEqual(indices.shape, (len(y), n_out))
+                for row, row_indices in zip(y, indices):
+                    self.assertEqual(row_indices.tolist(), lttb_indices_reference(row.tolist(), n_out))
+
+    def test_lttb_indices_n_out(self):
+        y = np.arange(10.)[None, :]
+        for n_out in (10, 11, 100):
+            self.assertEqual(lttb_indices(y, n_out).tolist(), [list(range(10))])
+        for n_out in (2, 1, 0):
+            with self.assertRaises(ValueError):
+                lttb_indices(y, n_out)
+
+    def test_lttb_indices_nan(self):
+        rng = np.random.default_rng(1)
+        y = rng.normal(size=(3, 200))
+        y[0, 50] = np.nan
+        y[1, 100:150] = np.nan
+        y[2, :] = np.nan
+        indices = lttb_indices(y, 20)
+        self.assertEqual(indices.shape, (3, 20))
+        self.assertTrue(np.all(np.diff(indices, axis=1) > 0))
+        # a NaN sample is only selected if its whole bucket is NaN (buckets of ~10.5 samples)
+        self.assertFalse(np.isnan(y[0, indices[0]]).any())
+        self.assertEqual(np.isnan(y[1, indices[1]]).sum(), 4)
+        self.assertEqual(indices[2].tolist(), lttb_indices(np.zeros((1, 200)), 20)[0].tolist())
+        # the samples before the NaN are selected as without it
+        y_finite = y[:1].copy()
+        y_finite[0, 50:] = 0
+        self.assertEqual(indices[0, :4].tolist(), lttb_indices(y_finite, 20)[0, :4].tolist())
+
+    def test_slice_and_downsample(self):
+        y = np.random.default_rng(2).normal(size=(2, 100))
+        t, values = slice_and_downsample(y, 10, 60, 10)
+        np.testing.assert_array_equal(t, lttb_indices(y[:, 10:60], 10) + 10)
+        np.testing.assert_array_equal(values, np.take_along_axis(y, t, axis=1))
+        t, values = slice_and_downsample(y, 90, 200, 50)
+        np.testing.assert_array_equal(t, np.tile(np.arange(90, 100), (2, 1)))
+        np.testing.assert_array_equal(values, y[:, 90:])
+
+
+class PyramidTest(SimpleTestCase):
+    def setUp(self):
+        self.enterContext(override_settings(TRACE_STORE_DIR=self.enterContext(tempfile.TemporaryDirectory())))
+        _TRACE_STORES.clear()
+        self.addCleanup(_TRACE_STORES.clear)
+        # more rows than TRACE_STORE_BLOCK, n not a power of 2: the last bins are partial
+        self.array = np.random.default_rng(0).normal(size=(120, 1000))
+        write_trace_store("d", self.array)
+        write_pyramid("d", self.array)
+
+    def test_build_pyramid(self):
+        for n in (15, 16, 31, 32, 33, 100, 1000):
+            levels = build_pyramid(self.array[:3, :n])
+            reference = build_pyramid_reference(self.array[:3, :n])
+            self.assertEqual(len(levels), len(reference))
+            for level, level_reference in zip(levels, reference):
+                np.testing.assert_allclose(level, level_reference, rtol=1e-12, atol=1e-12)
+
+    def test_stored_pyramid(self):
+        # written TRACE_STORE_BLOCK rows at a time
+        levels = load_pyramid("d")
+        self.assertEqual(len(levels), 6)
+        for level, level_reference in zip(levels, build_pyramid(self.array)):
+            np.testing.assert_array_equal(level, level_reference.astype(np.float32))
+
+        # a shorter recording removes the extra levels
+        write_pyramid("d", self.array[:, :100])
+        self.assertEqual(len(load_pyramid("d")), 2)
+        self.assertFalse(os.path.exists(get_trace_store_path("d", "trace_pyramid3")))
+
+    def test_window(self):
+        rows = [5, 0, 119]
+        for t_start, t_end, max_points in [
+            (0, 1000, 500), (0, 1000, 499), (0, 1000, 250), (0, 1000, 16),
+            (3, 1000, 499), (1, 999, 499), (100, 357, 129), (100, 357, 128), (101, 357, 128),
+            (None, None, 100), (990, None, 3), (512, 1000, 61), (0, 2000, 63),
+        ]:
+            window = get_pyramid_window("d", rows, t_start, t_end, max_points)
+            t_start_ = t_start or 0
+            t_end_ = min(t_end or 1000, 1000)
+            # the finest level whose bins covering the window fit in max_points
+            k = next(k for k in range(1, 7) if -(-t_end_ // 2**k) - (t_start_ // 2**k) <= max_points)
+            bin_start, bin_end = t_start_ // 2**k, -(-t_end_ // 2**k)
+            self.assertEqual(window["level"], k)
+            self.assertEqual(window["t"].tolist(), [j * 2**k for j in range(bin_start, bin_end)])
+            for stat in PYRAMID_STATS:
+                reference = [reduce_bins_reference(self.array[row], 2**k, bin_start, bin_end)[stat] for row in rows]
+                np.testing.assert_allclose(window[stat], reference, rtol=1e-6, atol=1e-6)
+                self.assertEqual(window[stat].shape, (len(rows), bin_end - bin_start))
+
+    def test_window_none(self):
+        # no max_points, the full resolution window fits, too coarse for the pyramid, unknown row or dataset
+        self.assertIsNone(get_pyramid_window("d", [0], 0, 1000))
+        self.assertIsNone(get_pyramid_window("d", [0], 0, 1000, 1000))
+        self.assertIsNone(get_pyramid_window("d", [0], 100, 200, 100))
+        self.assertIsNone(get_pyramid_window("d", [0], 0, 1000, 15))
+        self.assertIsNone(get_pyramid_window("d", [120], 0, 1000, 100))
+        self.assertIsNone(get_pyramid_window("x", [0], 0, 1000, 100))
+
+
+class WireFormatTest(SimpleTestCase):
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for dtype_name, dtype in BINARY_DTYPES.items():
+            for shape in [(3, 7), (1, 1), (0, 5), (4,)]:
+                # big-endian float64 input, header lengths with every padding
+                array = rng.normal(size=shape).astype(">f8")
+                for n_pad in range(8):
+                    header = {"dataset_id": "d" * n_pad, "idx": [1, 2, 3]}
+                    content = encode_binary(header, array, dtype)
+
+                    self.assertEqual(content[:4], BINARY_MAGIC)
+                    (n_header,) = struct.unpack("<I", content[4:8])
+                    self.assertEqual((8 + n_header) % 8, 0)
+                    header_decoded = json.loads(content[8:8 + n_header])
+                    self.assertEqual(header_decoded, dict(header, dtype=dtype.name, shape=list(shape)))
+                    self.assertEqual(content[8 + n_header:], array.astype(dtype).tobytes())
+                    self.assertEqual(len(content) - 8 - n_header, array.size * dtype.itemsize)
+
+                    header_decoded, array_decoded = decode_binary(content)
+                    self.assertEqual(header_decoded["dtype"], {"f32": "float32", "f16": "float16"}[dtype_name])
+                    self.assertEqual(array_decoded.dtype, dtype)
+                    np.testing.assert_array_equal(array_decoded, array.astype(dtype))
+
+        with self.assertRaises(ValueError):
+            decode_binary(b"JSON" + encode_binary({}, np.zeros(2), BINARY_DTYPES["f32"])[4:])
+
+    def test_get_binary_dtype(self):
+        factory = RequestFactory()
+        self.assertIsNone(get_binary_dtype(factory.get("/")))
+        self.assertIsNone(get_binary_dtype(factory.get("/", {"format": "json"}, HTTP_ACCEPT="application/octet-stream")))
+        self.assertEqual(get_binary_dtype(factory.get("/", HTTP_ACCEPT="application/octet-stream")), np.dtype("<f4"))
+        self.assertEqual(get_binary_dtype(factory.get("/", {"format": "bin", "dtype": "f16"})), np.dtype("<f2"))
+        for query in ({"format": "csv"}, {"format": "bin", "dtype": "f64"}):
+            with self.assertRaises(ValueError):
+                get_binary_dtype(factory.get("/", query))
+
+
+class DataViewsTest(TestCase):
+    n_neuron = 6
+
+    def setUp(self):
+        self.enterContext(override_settings(TRACE_STORE_DIR=self.enterContext(tempfile.TemporaryDirectory())))
+        _TRACE_STORES.clear()
+        self.addCleanup(_TRACE_STORES.clear)
+        cache.clear()
+        reset_dataset_versions()
+        self.addCleanup(reset_dataset_versions)
+
+        rng = np.random.default_rng(0)
+        self.traces = np.array(truncate_floats_in_list(rng.normal(size=self.n_neuron * 40).tolist())).reshape(self.n_neuron, 40)
+        self.cor = np.corrcoef(rng.normal(size=(self.n_neuron, 10)))
+        self.cor_behavior = {str(i): {"v": round(0.1 * i, 6)} for i in range(1, self.n_neuron + 1)}
+        dataset = GCaMPDataset.objects.create(
+            paper=GCaMPPaper.objects.create(paper_id="p"), dataset_id="p-1", dataset_name="1", max_t=40,
+            n_neuron=self.n_neuron, dataset_sha256="ab" * 32,
+            neuron_cor={"neuron": pack_correlation_matrix(self.cor), "behavior": self.cor_behavior},
+        )
+        GCaMPNeuron.objects.bulk_create(
+            GCaMPNeuron(dataset=dataset, idx_neuron=i, trace=trace.tolist()) for i, trace in enumerate(self.traces, 1)
+        )
+
+    def get(self, path, **query):
+        return self.client.get(f"/activity/api/data/p-1/{path}/", query)
+
+    def test_parse_list_idx_neuron(self):
+        self.assertEqual(parse_list_idx_neuron("1-5-12"), [1, 5, 12])
+        self.assertEqual(parse_list_idx_neuron("1:3-7-3:3"), [1, 2, 3, 7, 3])
+        self.assertEqual(len(parse_list_idx_neuron(f"1:{MAX_BATCH_NEURON}")), MAX_BATCH_NEURON)
+        for neuron_str in ["", "a", "1--2", "1-", "3:1", "1:2:3", ":4", f"1:{MAX_BATCH_NEURON + 1}",
+                           f"1:{MAX_BATCH_NEURON}-1", "-".join(map(str, range(MAX_BATCH_NEURON + 1)))]:
+            with self.assertRaises(ValueError, msg=neuron_str):
+                parse_list_idx_neuron(neuron_str)
+
+    def test_traces(self):
+        response = self.get("traces", n="3-1:2")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertCountEqual(data["traces"], ["3", "1", "2"])
+        for idx, trace in data["traces"].items():
+            self.assertEqual(trace["trace"], self.traces[int(idx) - 1].tolist())
+        self.assertEqual(data["missing"], [])
+
+    def test_traces_missing(self):
+        for store in (False, True):
+            if store:
+                write_trace_store("p-1", self.traces)
+            data = self.get("traces", n="7-2-0-99-1").json()
+            self.assertCountEqual(data["traces"], ["2", "1"], msg=store)
+            self.assertEqual(data["missing"], [7, 0, 99])
+            header, array = decode_binary(self.get("traces", n="7-2", format="bin").content)
+            self.assertEqual((header["idx_neuron"], header["missing"]), ([2], [7]))
+            np.testing.assert_array_equal(array, self.traces[[1]].astype(np.float32))
+            # none of them exists
+            self.assertEqual(self.get("traces", n="7-8").status_code, 404)
+
+    def test_traces_bad_request(self):
+        for query in [{}, {"n": ""}, {"n": "1-x"}, {"n": "5:1"}, {"n": f"1:{MAX_BATCH_NEURON + 1}"},
+                      {"n": "1", "max_points": "2"}, {"n": "1", "format": "csv"}]:
+            self.assertEqual(self.get("traces", **query).status_code, 400, msg=query)
+
+    def test_correlation_rows(self):
+        rows = self.cor.astype(np.float16).astype(np.float64)
+        np.fill_diagonal(rows, 1)
+        data = self.get("correlation", n="4-1:2").json()
+        self.assertEqual(data["idx_neuron"], [4, 1, 2])
+        self.assertEqual(data["neuron"], np.round(rows[[3, 0, 1]], 3).tolist())
+        self.assertEqual(data["behavior"], {key: self.cor_behavior[key] for key in ("4", "1", "2")})
+
+        header, array = decode_binary(self.get("correlation", n="4-1", format="bin").content)
+        self.assertEqual(header["idx_neuron"], [4, 1])
+        np.testing.assert_array_equal(array, rows[[3, 0]].astype(np.float32))
+
+        # without n, the packed upper triangle
+        data = self.get("correlation").json()
+        self.assertEqual(data["neuron"], np.round(rows[np.triu_indices(self.n_neuron, k=1)], 3).tolist())
+
+        self.assertEqual(self.get("correlation", n="1-7").status_code, 404)
+        self.assertEqual(self.get("correlation", n="1-x").status_code, 400)
@@ -0,0 +1,266 @@
+import os
+import numpy as np
+from django.conf import settings
+
+TRACE_STORE_DTYPE = np.float32
+TRACE_STORE_DECIMALS = 6
+# rows converted at a time when writing a store, so that a memory-mapped input is never loaded whole
+TRACE_STORE_BLOCK = 100
+
+# per-process registry of memory-mapped stores, keyed by (dataset_id, name)
+_TRACE_STORES = {}
+
+
+def get_trace_store_path(dataset_id, name="trace"):
+    return os.path.join(settings.TRACE_STORE_DIR, f"{dataset_id}.{name}.npy")
+
+
+def stage_trace_store(dataset_id, list_trace, name="trace"):
+    """
+    Write the traces of a dataset as one contiguous (n_neuron, max_t) float32 array to a temporary
+    path, TRACE_STORE_BLOCK rows at a time (list_trace may be memory-mapped). Row i holds the trace
+    of idx_neuron i+1. Returns publish(), which renames the file into place (e.g. once the DB
+    transaction of the dataset is committed, see transaction.on_commit), so that readers never see
+    a partially written store.
+    """
+    os.makedirs(settings.TRACE_STORE_DIR, exist_ok=True)
+    path = get_trace_store_path(dataset_id, name)
+    path_tmp = path + ".tmp"
+
+    if not isinstance(list_trace, np.ndarray):
+        list_trace = np.asarray(list_trace, dtype=np.float64)
+    header = {
+        "descr": np.lib.format.dtype_to_descr(np.dtype(TRACE_STORE_DTYPE)),
+        "fortran_order": False,
+        "shape": list_trace.shape,
+    }
+    with open(path_tmp, "wb") as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        for i in range(0, len(list_trace), TRACE_STORE_BLOCK):
+            f.write(np.ascontiguousarray(list_trace[i:i + TRACE_STORE_BLOCK], dtype=TRACE_STORE_DTYPE).tobytes())
+
+    return get_publish(dataset_id, name)
+
+
+def get_publish(dataset_id, name):
+    """publish() of a store written to its temporary path."""
+    path = get_trace_store_path(dataset_id, name)
+    path_tmp = path + ".tmp"
+
+    def publish():
+        os.replace(path_tmp, path)
+        _TRACE_STORES.pop((dataset_id, name), None)
+        return path
+
+    return publish
+
+
+def write_trace_store(dataset_id, list_trace, name="trace"):
+    """Write the traces of a dataset (see stage_trace_store) and rename the file into place."""
+    return stage_trace_store(dataset_id, list_trace, name)()
+
+
+def load_trace_store(dataset_id, name="trace"):
+    """
+    Return the read-only memory-mapped array of a dataset, or None if the store does not exist.
+    The OS page cache shares the mapped pages across all workers on the host.
+    """
+    key = (dataset_id, name)
+    store = _TRACE_STORES.get(key)
+    if store is None:
+        path = get_trace_store_path(dataset_id, name)
+        if not os.path.exists(path):
+            return None
+        store = np.load(path, mmap_mode="r")
+        _TRACE_STORES[key] = store
+
+    return store
+
+
+def row_to_list(row):
+    # float32 -> float64 rounded to the decimals of the truncated floats in the DB. The values match
+    # the DB exactly for |x| < 16 (half a float32 ulp is below 0.5e-6), larger ones are within
+    # |x| * 2**-24 + 0.5e-6 of it (float32 keeps 24 significant bits)
+    return np.round(row.astype(np.float64), TRACE_STORE_DECIMALS).tolist()
+
+
+def get_trace_row(dataset_id, idx_neuron):
+    """Return the trace of idx_neuron (1-based) as a list, or None if not available."""
+    store = load_trace_store(dataset_id)
+    if store is None or not 1 <= idx_neuron <= store.shape[0]:
+        return None
+
+    return row_to_list(store[idx_neuron - 1])
+
+
+def get_trace_rows(dataset_id, list_idx_neuron):
+    """
+    Return {idx_neuron: trace} for all requested neurons, or None if the store does not
+    exist or any of the neurons is out of range.
+    """
+    store = load_trace_store(dataset_id)
+    if store is None:
+        return None
+    if any(not 1 <= idx <= store.shape[0] for idx in list_idx_neuron):
+        return None
+
+    return {idx: row_to_list(store[idx - 1]) for idx in list_idx_neuron}
+
+
+def get_trace_array(dataset_id, list_idx_neuron):
+    """
+    Return the rows of the requested neurons as a (len(list_idx_neuron), max_t) array, or None
+    if the store does not exist or any of the neurons is out of range.
+    """
+    store = load_trace_store(dataset_id)
+    if store is None:
+        return None
+    if any(not 1 <= idx <= store.shape[0] for idx in list_idx_neuron):
+        return None
+
+    return store[np.asarray(list_idx_neuron, dtype=np.intp) - 1]
+
+
+'''
+
+Multi-resolution pyramids
+
+'''
+PYRAMID_MIN_POINTS = 16
+PYRAMID_STATS = ["mean", "min", "max"]
+
+
+def build_pyramid(array):
+    """
+    Build the min/max/mean pyramid of each row of array, halving the resolution at each level.
+    Level k (1-based) has ceil(n / 2**k) bins of 2**k samples (the last bin may be partial).
+    Levels are built down to PYRAMID_MIN_POINTS bins.
+
+    Returns:
+    - list: level k at index k-1, each a (3, n_row, n_bin) array with the stats in PYRAMID_STATS order
+    """
+    array = np.asarray(array, dtype=np.float64)
+    n_row, n = array.shape
+
+    levels = []
+    k = 1
+    while -(-n // 2**k) >= PYRAMID_MIN_POINTS:
+        size_bin = 2**k
+        n_bin = -(-n // size_bin)
+        padded = np.full((n_row, n_bin * size_bin), np.nan)
+        padded[:, :n] = array
+        binned = padded.reshape(n_row, n_bin, size_bin)
+        levels.append(np.stack([
+            np.nanmean(binned, axis=2),
+            np.nanmin(binned, axis=2),
+            np.nanmax(binned, axis=2),
+        ]))
+        k += 1
+
+    return levels
+
+
+def stage_pyramid(dataset_id, array, name="trace"):
+    """
+    Write the pyramid levels of array to temporary paths (see stage_trace_store), built
+    TRACE_STORE_BLOCK rows at a time (array may be memory-mapped). Returns publish(), which renames
+    them into place, removes the levels left over from a previous, longer recording and returns the
+    number of levels.
+    """
+    os.makedirs(settings.TRACE_STORE_DIR, exist_ok=True)
+    n_row = len(array)
+    levels = []
+    for i in range(0, n_row, TRACE_STORE_BLOCK):
+        block_levels = build_pyramid(array[i:i + TRACE_STORE_BLOCK])
+        if not levels:
+            levels = [
+                np.lib.format.open_memmap(
+                    get_trace_store_path(dataset_id, f"{name}_pyramid{k}") + ".tmp", mode="w+",
+                    dtype=TRACE_STORE_DTYPE, shape=(len(PYRAMID_STATS), n_row, block_level.shape[2])
+                )
+                for k, block_level in enumerate(block_levels, 1)
+            ]
+        for level, block_level in zip(levels, block_levels):
+            level[:, i:i + TRACE_STORE_BLOCK] = block_level
+    for level in levels:
+        level.flush()
+    n_level = len(levels)
+    del levels
+    list_publish = [get_publish(dataset_id, f"{name}_pyramid{k}") for k in range(1, n_level + 1)]
+
+    def publish():
+        for publish_level in list_publish:
+            publish_level()
+
+        k = n_level + 1
+        while os.path.exists(get_trace_store_path(dataset_id, f"{name}_pyramid{k}")):
+            os.remove(get_trace_store_path(dataset_id, f"{name}_pyramid{k}"))
+            _TRACE_STORES.pop((dataset_id, f"{name}_pyramid{k}"), None)
+            k += 1
+        _TRACE_STORES.pop((dataset_id, f"{name}_pyramid"), None)
+
+        return n_level
+
+    return publish
+
+
+def write_pyramid(dataset_id, array, name="trace"):
+    """Write the pyramid levels of array (see stage_pyramid) and rename the files into place."""
+    return stage_pyramid(dataset_id, array, name)()
+
+
+def load_pyramid(dataset_id, name="trace"):
+    """Return the list of memory-mapped pyramid levels of a dataset, or None if there is none."""
+    key = (dataset_id, f"{name}_pyramid")
+    levels = _TRACE_STORES.get(key)
+    if levels is None:
+        levels = []
+        while True:
+            level = load_trace_store(dataset_id, f"{name}_pyramid{len(levels) + 1}")
+            if level is None:
+                break
+            levels.append(level)
+        if not levels:
+            return None
+        _TRACE_STORES[key] = levels
+
+    return levels
+
+
+def get_pyramid_window(dataset_id, rows, t_start=None, t_end=None, max_points=None, name="trace"):
+    """
+    Select the finest pyramid level whose bins covering [t_start, t_end) fit in max_points,
+    and slice the rows (0-based) out of it. The cost does not depend on the recording length.
+
+    Returns:
+    - dict: level, t (first time point index of each bin), and the mean/min/max arrays (n_row, n_bin)
+    - None: if max_points is not given, the full resolution window already fits, the pyramid
+      does not exist or does not go coarse enough, or a row is out of range
+    """
+    if max_points is None:
+        return None
+    store = load_trace_store(dataset_id, name)
+    levels = load_pyramid(dataset_id, name)
+    if store is None or levels is None:
+        return None
+    if any(not 0 <= row < store.shape[0] for row in rows):
+        return None
+
+    n = store.shape[1]
+    t_start = 0 if t_start is None else min(t_start, n)
+    t_end = n if t_end is None else max(min(t_end, n), t_start)
+    if t_end - t_start <= max_points:
+        return None
+
+    rows = np.asarray(rows, dtype=np.intp)
+    for k, level in enumerate(levels, 1):
+        bin_start = t_start >> k
+        bin_end = -(-t_end >> k)
+        if bin_end - bin_start <= max_points:
+            data = level[:, rows, bin_start:bin_end]
+            window = {stat: data[i] for i, stat in enumerate(PYRAMID_STATS)}
+            window["level"] = k
+            window["t"] = np.arange(bin_start, bin_end) << k
+            return window
+
+    return None
@@ -15,8 +15,10 @@ urlpatterns = [
     path('plot-multiple/', views.plot_multiple, name="activity-plot_multiple"),
 
     path('api/data/<str:dataset_id>/<int:idx_neuron>/', views.get_neural_trace, name="activity-get_neural_trace"),
+    path('api/data/<str:dataset_id>/traces/', views.get_neural_traces, name="activity-get_neural_traces"),
     path('api/data/<str:dataset_id>/behavior/', views.get_behavior, name="activity-get_behavior"),
     path('api/data/<str:dataset_id>/encoding/', views.get_encoding, name="activity-get_encoding"),
+    path('api/data/<str:dataset_id>/correlation/', views.get_correlation, name="activity-get_correlation"),
     path('api/data/atanas_kim_2023_encoding/', views.get_all_dataset_encoding, name="activity-get_all_dataset_encoding"),
     path('api/data/datasets/', views.get_all_dataset, name="activity-datasets"),
     path('api/data/find_neuron/', views.get_find_neuron_data, name="activity-get_find_neuron_data"),
@@ -1,6 +1,6 @@
 import json
 import uuid
-from collections import defaultdict
+import numpy as np
 
 from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
@@ -8,49 +8,76 @@ from django.db.models import Prefetch
 from django.http import JsonResponse, HttpResponseBadRequest, Http404
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
-from django.views.decorators.cache import cache_page, cache_control
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django.views.decorators.vary import vary_on_headers
 
 from connectome.views import connectome_datasets
 from .models import GCaMPDataset, GCaMPNeuron, GCaMPPaper, GCaMPDatasetType
+from .trace_store import load_trace_store, get_trace_row, get_trace_rows, get_trace_array, get_pyramid_window, row_to_list, PYRAMID_STATS
+from .wire_format import get_binary_dtype, BinaryResponse
+from .downsample import parse_downsample_params, parse_downsample_method, slice_and_downsample
+from .correlation import unpack_correlation, get_correlation_rows
 from connectome.models import Dataset
 from core.models import JSONCache
+from core.caching import (
+    get_json_bytes, get_or_fill, get_content_encoding, JSONBytesResponse, dataset_key, catalog_key,
+    dataset_etag, catalog_etag, cache_page_swr
+)
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def index(request):
     context = {}
     
     return render(request, "activity/index.html", context)
 
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def index_encoding(request):
     context = {}
 
     return render(request, "activity/index_encoding.html", context)    
 
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def encoding_table(request):
     context = {}
 
     return render(request, "activity/encoding.html", context)    
 
 
+# cache keys (without version) of data built from all datasets, see core.caching.catalog_key
+CATALOG_CACHE_KEYS = [
+    "encoding_connectome_data", "dataset_data", "all_dataset", "neuropal_match", "atanas_kim_2023_all_encoding_dict"
+]
+
+
+def get_dataset_cache_key(dataset_id, name):
+    """Versioned cache key of the data name (e.g. "behavior" or idx_neuron for a trace) of a dataset."""
+    return dataset_key(GCaMPDataset, dataset_id, f"{dataset_id}_{name}")
+
+
+def get_dataset_cache_keys(dataset_id, n_neuron):
+    """All cache keys (without version) of the data of a dataset, see get_dataset_cache_key."""
+    names = ["behavior", "encoding", "correlation", "dataset_neuron_data", "warm", *range(1, n_neuron + 1)]
+
+    return [f"{dataset_id}_{name}" for name in names]
+
+
 def encoding_connectome(request):
     """
     Render the encoding connectome page using cached connectome dataset data.
     If the data is not in cache, fetch it and store it.
     """
-    encoding_data = cache.get("encoding_connectome_data")
-    if encoding_data is None:
+    def build():
         datasets_json = connectome_datasets()
         match_data = get_object_or_404(
             JSONCache, name="atanas_kim_2023_all_encoding_dict_match"
         ).json
-        encoding_data = {"datasets_json": datasets_json, "match_data": match_data}
-        cache.set("encoding_connectome_data", encoding_data, timeout=None)
+        return {"datasets_json": datasets_json, "match_data": match_data}
+
+    encoding_data = get_or_fill(catalog_key("encoding_connectome_data"), build)
 
     return render(request, "activity/encoding_connectome.html", encoding_data)
 
@@ -61,8 +88,7 @@ def dataset(request):
     Optimizes queries by fetching papers and dataset types in bulk,
     and caches the resulting JSON structures.
     """
-    context = cache.get("dataset_data")
-    if context is None:
+    def build():
         # Build list of datasets with required fields.
         datasets = [
             {
@@ -110,33 +136,46 @@ def dataset(request):
             "common": [dt.type_id for dt in GCaMPDatasetType.objects.filter(paper=None)],
         }
 
-        context = {
+        return {
             "datasets": json.dumps(datasets),
             "dataset_types": json.dumps(dataset_types),
             "dataset_type_per_paper": json.dumps(dataset_type_per_paper),
             "papers": json.dumps(dataset_papers),
         }
-        cache.set("dataset_data", context, timeout=None)
+
+    context = get_or_fill(catalog_key("dataset_data"), build)
 
     return render(request, "activity/dataset.html", context)
 
 
-@cache_page(60*60*24)
+def get_all_dataset_json(encoding=None):
+    def build():
+        return list(GCaMPDataset.objects.all().values("dataset_id", "dataset_type", "n_neuron",
+                                                      "n_labeled", "max_t", "avg_timestep"))
+
+    return get_json_bytes(catalog_key("all_dataset"), build, encoding=encoding)
+
+
+@cache_control(public=True, max_age=60*60*24)
+@catalog_etag()
 def get_all_dataset(request):
-    datasets = GCaMPDataset.objects.all().values("dataset_id", "dataset_type", "n_neuron",
-                                                 "n_labeled", "max_t", "avg_timestep")
-    
-    return JsonResponse(list(datasets), safe=False)
+    encoding = get_content_encoding(request)
+    return JSONBytesResponse(get_all_dataset_json(encoding), encoding=encoding)
 
 
-@cache_page(60*60*24)
-def get_find_neuron_data(request):
-    data = get_object_or_404(JSONCache, name="neuropal_match").json
+def get_json_cache_json(name, encoding=None):
+    # JSONCache entries hold an already encoded JSON string, served as is
+    return get_json_bytes(catalog_key(name), lambda: get_object_or_404(JSONCache, name=name).json, encoding=encoding)
+
 
-    return JsonResponse(json.loads(data))
+@cache_control(public=True, max_age=60*60*24)
+@catalog_etag()
+def get_find_neuron_data(request):
+    encoding = get_content_encoding(request)
+    return JSONBytesResponse(get_json_cache_json("neuropal_match", encoding), encoding=encoding)
 
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def find_neuron(request):
     context = {}
 
@@ -144,7 +183,12 @@ def find_neuron(request):
 
 
 def get_neural_trace_data(dataset_id, idx_neuron):
-    neuron = cache.get(f"{dataset_id}_{idx_neuron}")
+    # memory-mapped trace store first. no parsing or cache round trip
+    trace = get_trace_row(dataset_id, idx_neuron)
+    if trace is not None:
+        return {"trace": trace, "idx_neuron": idx_neuron, "dataset_id": dataset_id}
+
+    neuron = cache.get(get_dataset_cache_key(dataset_id, idx_neuron))
     if neuron is None:
         neuron = (
             GCaMPNeuron.objects
@@ -154,27 +198,252 @@ def get_neural_trace_data(dataset_id, idx_neuron):
         )
         if neuron is None: return None
         neuron["dataset_id"] = dataset_id
-        cache.set(f"{dataset_id}_{idx_neuron}", neuron, timeout=None)
+        cache.set(get_dataset_cache_key(dataset_id, idx_neuron), neuron, timeout=None)
 
     return neuron
 
 
+def get_neural_trace_json(dataset_id, idx_neuron, encoding=None):
+    def build():
+        neuron = get_neural_trace_data(dataset_id, idx_neuron)
+        if neuron is None:
+            raise Http404
+        return neuron
+
+    return get_json_bytes(get_dataset_cache_key(dataset_id, idx_neuron), build, encoding=encoding)
+
+
+# max number of neurons of a batch request (?n=), larger requests get a 400
+MAX_BATCH_NEURON = 500
+
+
+def parse_list_idx_neuron(neuron_str):
+    """
+    Parse a list of neuron indices, e.g. "1-5-12" or with inclusive ranges "1:10-15".
+    Raises ValueError if the string is malformed or requests more than MAX_BATCH_NEURON neurons.
+    """
+    list_idx_neuron = []
+    for part in neuron_str.split('-'):
+        if ':' in part:
+            idx_start, idx_end = (int(x) for x in part.split(':'))
+            if idx_end < idx_start or idx_end - idx_start >= MAX_BATCH_NEURON:
+                raise ValueError(f"Invalid neuron range: {part}")
+            list_idx_neuron.extend(range(idx_start, idx_end + 1))
+        else:
+            list_idx_neuron.append(int(part))
+
+        if len(list_idx_neuron) > MAX_BATCH_NEURON:
+            raise ValueError(f"Too many neurons requested (max: {MAX_BATCH_NEURON})")
+
+    return list_idx_neuron
+
+
+def split_missing_neurons(dataset_id, list_idx_neuron):
+    """Return (found, missing) lists of the neurons of list_idx_neuron, by the trace store or the DB."""
+    store = load_trace_store(dataset_id)
+    if store is not None:
+        existing = set(range(1, store.shape[0] + 1))
+    else:
+        existing = set(
+            GCaMPNeuron.objects
+            .filter(dataset__dataset_id=dataset_id, idx_neuron__in=list_idx_neuron)
+            .values_list("idx_neuron", flat=True)
+        )
+
+    found = [idx for idx in list_idx_neuron if idx in existing]
+    missing = [idx for idx in list_idx_neuron if idx not in existing]
+    return found, missing
+
+
+def get_neural_trace_data_bulk(dataset_id, list_idx_neuron):
+    """
+    Bulk version of get_neural_trace_data.
+    Looks up the trace store, then the cache with one get_many, then the DB with one
+    idx_neuron__in query for the misses (cached with one set_many).
+    Returns {idx_neuron: trace data} for the neurons that exist. Missing neurons are omitted.
+    """
+    list_idx_neuron = list(dict.fromkeys(list_idx_neuron))
+
+    # Slice the traces out of the memory-mapped trace store if available.
+    store_traces = get_trace_rows(dataset_id, list_idx_neuron)
+    if store_traces is not None:
+        return {
+            idx: {"trace": trace, "idx_neuron": idx, "dataset_id": dataset_id}
+            for idx, trace in store_traces.items()
+        }
+
+    # Map each neuron index to its cache key.
+    cache_key_map = {get_dataset_cache_key(dataset_id, idx): idx for idx in list_idx_neuron}
+    cached_traces = cache.get_many(list(cache_key_map.keys()))
+    traces = {cache_key_map[key]: value for key, value in cached_traces.items()}
+
+    # Batch query to fetch missing neurons with only the needed fields.
+    missing_indices = [idx for idx in list_idx_neuron if idx not in traces]
+    if missing_indices:
+        neurons = (
+            GCaMPNeuron.objects
+            .filter(dataset__dataset_id=dataset_id, idx_neuron__in=missing_indices)
+            .values("trace", "idx_neuron")
+        )
+        new_traces = {}
+        for neuron in neurons:
+            neuron["dataset_id"] = dataset_id
+            new_traces[neuron["idx_neuron"]] = neuron
+
+        # Cache the new traces in bulk.
+        if new_traces:
+            cache.set_many({get_dataset_cache_key(dataset_id, idx): data for idx, data in new_traces.items()}, timeout=None)
+        traces.update(new_traces)
+
+    return traces
+
+
+def downsample_traces(traces, params):
+    """
+    Apply the window/downsampling parameters (see parse_downsample_params) to {idx_neuron: trace data}
+    with LTTB. The time point indices of the returned samples are added as "t".
+    """
+    if not params or not traces:
+        return traces
+
+    list_idx_neuron = list(traces.keys())
+    t, values = slice_and_downsample([traces[idx]["trace"] for idx in list_idx_neuron], **params)
+
+    return {
+        idx: dict(traces[idx], trace=values[i].tolist(), t=t[i].tolist())
+        for i, idx in enumerate(list_idx_neuron)
+    }
+
+
+def get_neural_trace_data_downsampled(dataset_id, list_idx_neuron, params, method="auto"):
+    """
+    Traces of list_idx_neuron sliced/downsampled according to params.
+    Uses the precomputed pyramid level (mean as "trace", plus "trace_min", "trace_max" and "level")
+    when available, otherwise LTTB on the full resolution traces.
+    Returns {idx_neuron: trace data}. Missing neurons are omitted.
+    """
+    window = None
+    if method == "auto":
+        window = get_pyramid_window(dataset_id, [idx - 1 for idx in list_idx_neuron], **params)
+    if window is None:
+        return downsample_traces(get_neural_trace_data_bulk(dataset_id, list_idx_neuron), params)
+
+    t = window["t"].tolist()
+    return {
+        idx: {
+            "trace": row_to_list(window["mean"][i]),
+            "trace_min": row_to_list(window["min"][i]),
+            "trace_max": row_to_list(window["max"][i]),
+            "t": t,
+            "level": window["level"],
+            "idx_neuron": idx,
+            "dataset_id": dataset_id
+        }
+        for i, idx in enumerate(list_idx_neuron)
+    }
+
+
+def neural_traces_binary_response(dataset_id, list_idx_neuron, dtype, params, method="auto", missing=None):
+    """
+    Binary (wire_format) response with one row per neuron in list_idx_neuron.
+    With a pyramid level the array is (3, n_neuron, n_bin) with the stats listed in the header.
+    missing (neurons of a batch request that don't exist) is listed in the header if given.
+    """
+    header = {"dataset_id": dataset_id, "idx_neuron": list_idx_neuron}
+    if missing is not None:
+        header["missing"] = missing
+
+    window = None
+    if params and method == "auto":
+        window = get_pyramid_window(dataset_id, [idx - 1 for idx in list_idx_neuron], **params)
+    if window is not None:
+        header.update(t=window["t"].tolist(), level=window["level"], stats=PYRAMID_STATS)
+        return BinaryResponse(header, [window[stat] for stat in PYRAMID_STATS], dtype)
+
+    array = get_trace_array(dataset_id, list_idx_neuron)
+    if array is None:
+        traces = get_neural_trace_data_bulk(dataset_id, list_idx_neuron)
+        if len(traces) != len(list_idx_neuron):
+            raise Http404
+        array = [traces[idx]["trace"] for idx in list_idx_neuron]
+
+    if params:
+        t, array = slice_and_downsample(array, **params)
+        header["t"] = t.tolist()
+
+    return BinaryResponse(header, array, dtype)
+
+
 @cache_control(public=True, max_age=1*24*3600)
+@vary_on_headers("Accept")
+@dataset_etag(GCaMPDataset)
 def get_neural_trace(request, dataset_id, idx_neuron):
-    neuron = get_neural_trace_data(dataset_id, idx_neuron)
+    """
+    Optional GET parameters: t_start, t_end, max_points, method (window and downsampling),
+    format/dtype (binary encoding, see wire_format)
+    """
+    try:
+        dtype = get_binary_dtype(request)
+        params = parse_downsample_params(request)
+        method = parse_downsample_method(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if dtype is not None:
+        return neural_traces_binary_response(dataset_id, [idx_neuron], dtype, params, method)
+
+    if not params:
+        encoding = get_content_encoding(request)
+        return JSONBytesResponse(get_neural_trace_json(dataset_id, idx_neuron, encoding), encoding=encoding)
+
+    neuron = get_neural_trace_data_downsampled(dataset_id, [idx_neuron], params, method).get(idx_neuron)
     if neuron is None:
         raise Http404
     return JsonResponse(neuron)
 
 
+@cache_control(public=True, max_age=1*24*3600)
+@vary_on_headers("Accept")
+@dataset_etag(GCaMPDataset)
+def get_neural_traces(request, dataset_id):
+    """
+    Return the traces of multiple neurons of a dataset in one response.
+    The neurons are given by the "n" GET parameter, e.g. ?n=1-5-12 or ?n=1:30 (at most MAX_BATCH_NEURON).
+    The neurons that don't exist are listed in "missing" (404 only if none of them exists).
+    Accepts the same optional parameters as get_neural_trace.
+    """
+    neuron_str = request.GET.get("n")
+    if not neuron_str:
+        return HttpResponseBadRequest("Error: n parameter not found")
+    try:
+        list_idx_neuron = list(dict.fromkeys(parse_list_idx_neuron(neuron_str)))
+        dtype = get_binary_dtype(request)
+        params = parse_downsample_params(request)
+        method = parse_downsample_method(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(f"Invalid request: {e}")
+
+    list_idx_neuron, missing = split_missing_neurons(dataset_id, list_idx_neuron)
+    if not list_idx_neuron:
+        raise Http404
+    if dtype is not None:
+        return neural_traces_binary_response(dataset_id, list_idx_neuron, dtype, params, method, missing)
+
+    if params:
+        traces = get_neural_trace_data_downsampled(dataset_id, list_idx_neuron, params, method)
+    else:
+        traces = get_neural_trace_data_bulk(dataset_id, list_idx_neuron)
+
+    return JsonResponse({"dataset_id": dataset_id, "traces": traces, "missing": missing})
+
+
 """
 get all encoding from 
 """
-@cache_page(60*60*24*30)
+@cache_control(public=True, max_age=60*60*24*30)
+@catalog_etag()
 def get_all_dataset_encoding(request):
-    data = get_object_or_404(JSONCache, name="atanas_kim_2023_all_encoding_dict").json
-
-    return JsonResponse(json.loads(data))
+    encoding = get_content_encoding(request)
+    return JSONBytesResponse(get_json_cache_json("atanas_kim_2023_all_encoding_dict", encoding), encoding=encoding)
 
 
 def get_dataset_encoding(dataset):
@@ -196,24 +465,109 @@ def get_dataset_encoding(dataset):
 
 
 def get_encoding_data(dataset_id):
-    encoding = cache.get(f"{dataset_id}_encoding")
+    encoding = cache.get(get_dataset_cache_key(dataset_id, "encoding"))
     if encoding is None:
         dataset = get_object_or_404(GCaMPDataset, dataset_id=dataset_id)
         encoding = get_dataset_encoding(dataset)
-        cache.set(f"{dataset_id}_encoding", encoding, timeout=None)
+        cache.set(get_dataset_cache_key(dataset_id, "encoding"), encoding, timeout=None)
 
     return encoding
 
 
+def get_encoding_json(dataset_id, encoding=None):
+    return get_json_bytes(get_dataset_cache_key(dataset_id, "encoding"), lambda: get_encoding_data(dataset_id),
+                          encoding=encoding)
+
+
 """
 get encoding data of a dataset
 """
 @cache_control(public=True, max_age=60*60*24*7)
+@dataset_etag(GCaMPDataset)
 def get_encoding(request, dataset_id):
-    return JsonResponse(get_encoding_data(dataset_id))
+    encoding = get_content_encoding(request)
+    return JSONBytesResponse(get_encoding_json(dataset_id, encoding), encoding=encoding)
+
+
+def get_correlation_data(dataset_id):
+    """
+    Neuron-pair correlation as the packed upper triangle (see correlation.get_packed_index)
+    and neuron-behavior correlation as {idx_neuron: {behavior: cor}}
+    """
+    data = cache.get(get_dataset_cache_key(dataset_id, "correlation"))
+    if data is None:
+        dataset = get_object_or_404(GCaMPDataset.objects.only("neuron_cor", "n_neuron"), dataset_id=dataset_id)
+        data = {
+            "dataset_id": dataset_id,
+            "n_neuron": dataset.n_neuron,
+            "neuron": unpack_correlation(dataset.neuron_cor.get("neuron", {}), dataset.n_neuron),
+            "behavior": dataset.neuron_cor.get("behavior", {})
+        }
+        cache.set(get_dataset_cache_key(dataset_id, "correlation"), data, timeout=None)
+
+    return data
+
+
+def get_correlation_json(dataset_id, encoding=None):
+    def build():
+        data = get_correlation_data(dataset_id)
+        return dict(data, neuron=correlation_to_list(data["neuron"]))
+
+    return get_json_bytes(get_dataset_cache_key(dataset_id, "correlation"), build, encoding=encoding)
+
+
+def correlation_to_list(array):
+    # NaN (constant traces) is not valid JSON
+    return np.where(np.isnan(array), None, np.round(array.astype(np.float64), 3)).tolist()
+
+
+"""
+get correlation data of a dataset
+"""
+@cache_control(public=True, max_age=60*60*24*7)
+@vary_on_headers("Accept")
+@dataset_etag(GCaMPDataset)
+def get_correlation(request, dataset_id):
+    """
+    Without n, "neuron" is the packed upper triangle of the neuron-pair correlation matrix
+    (row-major, pairs (1,2), (1,3), ..., (2,3), ...).
+    With n (e.g. ?n=1-5-12 or ?n=1:30), "neuron" holds the full matrix rows of those neurons
+    and "behavior" is restricted to them.
+    Optional GET parameters: format/dtype (binary encoding of "neuron", see wire_format)
+    """
+    try:
+        dtype = get_binary_dtype(request)
+        neuron_str = request.GET.get("n")
+        list_idx_neuron = list(dict.fromkeys(parse_list_idx_neuron(neuron_str))) if neuron_str else None
+    except ValueError as e:
+        return HttpResponseBadRequest(f"Invalid request: {e}")
+
+    if list_idx_neuron is None and dtype is None:
+        encoding = get_content_encoding(request)
+        return JSONBytesResponse(get_correlation_json(dataset_id, encoding), encoding=encoding)
+
+    data = get_correlation_data(dataset_id)
+    header = {"dataset_id": dataset_id, "n_neuron": data["n_neuron"]}
+    if list_idx_neuron is None:
+        header["behavior"] = data["behavior"]
+        array = data["neuron"]
+    else:
+        if any(not 1 <= idx <= data["n_neuron"] for idx in list_idx_neuron):
+            raise Http404
+        header["idx_neuron"] = list_idx_neuron
+        header["behavior"] = {
+            str(idx): data["behavior"][str(idx)] for idx in list_idx_neuron if str(idx) in data["behavior"]
+        }
+        array = get_correlation_rows(data["neuron"], data["n_neuron"], list_idx_neuron)
+
+    if dtype is not None:
+        return BinaryResponse(header, array, dtype)
+
+    return JsonResponse(dict(header, neuron=correlation_to_list(array)))
+
 
 def get_behavior_data(dataset_id):
-    data = cache.get(f"{dataset_id}_behavior")
+    data = cache.get(get_dataset_cache_key(dataset_id, "behavior"))
     if data is None:
         dataset = get_object_or_404(
             GCaMPDataset.objects.only("truncated_behavior", "events", "avg_timestep", "max_t"),
@@ -228,22 +582,109 @@ def get_behavior_data(dataset_id):
             "avg_timestep": dataset.avg_timestep,
             "max_t": dataset.max_t
         }
-        cache.set(f"{dataset_id}_behavior", data, timeout=None)
+        cache.set(get_dataset_cache_key(dataset_id, "behavior"), data, timeout=None)
 
     return data
 
 
+def get_behavior_json(dataset_id, encoding=None):
+    return get_json_bytes(get_dataset_cache_key(dataset_id, "behavior"), lambda: get_behavior_data(dataset_id),
+                          encoding=encoding)
+
+
+def get_behavior_channels(data):
+    return sorted(data["data"]["behavior"].get("traces", {}).values(), key=lambda trace: trace["i"])
+
+
+def downsample_behavior(data, params, method="auto"):
+    """
+    Apply the window/downsampling parameters to every behavior channel. Adds "t" to each channel.
+    Uses the precomputed pyramid level when available (mean as "data", plus "data_min", "data_max"
+    and "level"), otherwise LTTB.
+    """
+    channels = get_behavior_channels(data)
+    if not params or not channels:
+        return data
+
+    window = None
+    if method == "auto":
+        window = get_pyramid_window(data["dataset_id"], [trace["i"] for trace in channels], name="behavior", **params)
+    if window is not None:
+        t = window["t"].tolist()
+        traces = {
+            trace["name_short"]: dict(
+                trace, data=row_to_list(window["mean"][i]), data_min=row_to_list(window["min"][i]),
+                data_max=row_to_list(window["max"][i]), t=t, level=window["level"]
+            )
+            for i, trace in enumerate(channels)
+        }
+    else:
+        t, values = slice_and_downsample([trace["data"] for trace in channels], **params)
+        traces = {
+            trace["name_short"]: dict(trace, data=values[i].tolist(), t=t[i].tolist())
+            for i, trace in enumerate(channels)
+        }
+    behavior = dict(data["data"]["behavior"], traces=traces)
+
+    return dict(data, data=dict(data["data"], behavior=behavior))
+
+
+def behavior_binary_response(data, dtype, params, method="auto"):
+    """Binary (wire_format) response with one row per behavior channel. Metadata goes in the header."""
+    behavior = data["data"]["behavior"]
+    channels = get_behavior_channels(data)
+    header = {
+        "dataset_id": data["dataset_id"],
+        "avg_timestep": data["avg_timestep"],
+        "max_t": data["max_t"],
+        "events": data["data"]["events"],
+        "reversal_events": behavior.get("reversal_events", []),
+        "channels": [{k: v for k, v in trace.items() if k != "data"} for trace in channels],
+    }
+
+    window = None
+    if params and channels and method == "auto":
+        window = get_pyramid_window(data["dataset_id"], [trace["i"] for trace in channels], name="behavior", **params)
+    if window is not None:
+        header.update(t=window["t"].tolist(), level=window["level"], stats=PYRAMID_STATS)
+        return BinaryResponse(header, [window[stat] for stat in PYRAMID_STATS], dtype)
+
+    array = [trace["data"] for trace in channels]
+    if params and channels:
+        t, array = slice_and_downsample(array, **params)
+        header["t"] = t.tolist()
+
+    return BinaryResponse(header, array, dtype)
+
+
 @cache_control(public=True, max_age=60*60*24*7)
+@vary_on_headers("Accept")
+@dataset_etag(GCaMPDataset)
 def get_behavior(request, dataset_id):
+    """
+    Optional GET parameters: t_start, t_end, max_points, method (window and downsampling),
+    format/dtype (binary encoding, see wire_format)
+    """
+    try:
+        dtype = get_binary_dtype(request)
+        params = parse_downsample_params(request)
+        method = parse_downsample_method(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if dtype is not None:
+        return behavior_binary_response(get_behavior_data(dataset_id), dtype, params, method)
 
-    return JsonResponse(get_behavior_data(dataset_id))
+    if not params:
+        encoding = get_content_encoding(request)
+        return JSONBytesResponse(get_behavior_json(dataset_id, encoding), encoding=encoding)
+
+    return JsonResponse(downsample_behavior(get_behavior_data(dataset_id), params, method))
 
 
 def get_dataset_neuron_data(dataset):
-    neuron_data = cache.get(f"{dataset.dataset_id}_dataset_neuron_data")
-    if neuron_data is None:
+    def build():
         qs = dataset.neurons.select_related("neuron_class").all()
-        neuron_data = {
+        return {
             neuron.idx_neuron: {
                 "name": f"{neuron.idx_neuron} ({neuron.neuron_name})" if neuron.neuron_name else str(neuron.idx_neuron),
                 "label": neuron.neuron_name,
@@ -252,15 +693,14 @@ def get_dataset_neuron_data(dataset):
             }
             for neuron in qs
         }
-        cache.set(f"{dataset.dataset_id}_dataset_neuron_data", neuron_data, timeout=None)
 
-    return neuron_data
+    return get_or_fill(get_dataset_cache_key(dataset.dataset_id, "dataset_neuron_data"), build)
 
 
 def plot_dataset(request, dataset_id):
     # Fetch dataset with related objects
     dataset_fields = (
-        'dataset_id', 'dataset_name', 'avg_timestep', 'max_t', 'neuron_cor', 'encoding', 'events', 'paper', 'dataset_meta'
+        'dataset_id', 'dataset_name', 'avg_timestep', 'max_t', 'encoding', 'events', 'paper', 'dataset_meta'
     )
     dataset_type_fields = ('type_id', 'description', 'name', 'color_background')
 
@@ -283,54 +723,19 @@ def plot_dataset(request, dataset_id):
     neuron_str = request.GET.get("n")
     if neuron_str:
         try:
-            list_idx_neuron = [int(x) for x in neuron_str.split('-')]
+            list_idx_neuron = list(dict.fromkeys(parse_list_idx_neuron(neuron_str)))
+            params = parse_downsample_params(request)
+            method = parse_downsample_method(request)
         except ValueError:
             return HttpResponseBadRequest("Invalid neurons or error loading neurons.")
 
-        # Map each neuron index to its cache key.
-        cache_key_map = {f"{dataset_id}_{idx}": idx for idx in list_idx_neuron}
-        
-        # Retrieve cached traces.
-        cached_traces = cache.get_many(list(cache_key_map.keys()))
-        
-        # Identify indices that were not found in cache.
-        missing_indices = [
-            idx for key, idx in cache_key_map.items() if key not in cached_traces
-        ]
-        
-        new_traces = {}
-        if missing_indices:
-            # Batch query to fetch missing neurons with only the needed fields.
-            neurons = list(
-                GCaMPNeuron.objects.filter(dataset=dataset, idx_neuron__in=missing_indices)
-                .only('idx_neuron', 'trace')
-            )
-            # Validate that all requested neurons were returned.
-            if len(neurons) != len(missing_indices):
-                return HttpResponseBadRequest("Invalid neurons or error loading neurons.")
-            
-            # Create a mapping of neuron index to its trace data.
-            new_traces = {
-                neuron.idx_neuron: {
-                    "trace": neuron.trace,
-                    "idx_neuron": neuron.idx_neuron,
-                    "dataset_id": dataset_id
-                }
-                for neuron in neurons
-            }
-            # Cache the new traces in bulk.
-            cache.set_many({
-                f"{dataset_id}_{neuron.idx_neuron}": trace_data for neuron_idx,
-                trace_data in new_traces.items() for neuron in neurons if neuron.idx_neuron == neuron_idx
-            }, timeout=3600*24*14)
-
-        # Convert cached keys back to neuron indices.
-        cached_traces_parsed = {
-            int(key.split("_")[-1]): value for key, value in cached_traces.items()
-        }
-
-        # Merge cached and newly fetched traces.
-        trace_init = {**cached_traces_parsed, **new_traces}
+        if params:
+            trace_init = get_neural_trace_data_downsampled(dataset_id, list_idx_neuron, params, method)
+        else:
+            trace_init = get_neural_trace_data_bulk(dataset_id, list_idx_neuron)
+        # Validate that all requested neurons were returned.
+        if len(trace_init) != len(list_idx_neuron):
+            return HttpResponseBadRequest("Invalid neurons or error loading neurons.")
 
     # Build the main data structure.
     data = {
@@ -339,7 +744,6 @@ def plot_dataset(request, dataset_id):
         "dataset_name": dataset.dataset_name,
         "avg_timestep": dataset.avg_timestep,
         "max_t": dataset.max_t,
-        "cor": dataset.neuron_cor,
         "encoding_data_exists": bool(encoding),
         "dataset_type": {
             dtype.type_id: {
@@ -407,22 +811,6 @@ def plot_multiple(request):
     # Map dataset_id to dataset instance.
     dataset_map = {ds.dataset_id: ds for ds in datasets_qs}
     
-    # Batch query neurons across all requested datasets.
-    all_required_idx = {idx for idx_list in data.values() for idx in idx_list}
-    neurons_qs = (
-        GCaMPNeuron.objects.filter(
-            dataset__dataset_id__in=dataset_ids,
-            idx_neuron__in=all_required_idx
-        )
-        .select_related('dataset')
-        .only('dataset__dataset_id', 'idx_neuron', 'neuron_name', 'trace')
-    )
-    # Group neurons by dataset_id and their index.
-    neurons_grouped = defaultdict(dict)
-    for neuron in neurons_qs:
-        ds_id = neuron.dataset.dataset_id
-        neurons_grouped[ds_id][neuron.idx_neuron] = neuron
-
     plots = []
     colors = {}
     list_dataset_meta = []
@@ -445,17 +833,17 @@ def plot_multiple(request):
                     "background-color": dtype.color_background,
                 }
 
-        # Retrieve neurons for this dataset.
-        neuron_map = neurons_grouped.get(dataset_id, {})
+        # Retrieve neurons for this dataset with the shared bulk loader.
+        traces = get_neural_trace_data_bulk(dataset_id, list_idx_neuron)
+        neuron_data = get_dataset_neuron_data(dataset)  # cached
         trace_data = []
         for idx_neuron in list_idx_neuron:
-            neuron = neuron_map.get(idx_neuron)
-            if not neuron:
+            if idx_neuron not in traces or idx_neuron not in neuron_data:
                 continue  # Optionally handle missing neurons.
-            neuron_name = neuron.neuron_name
+            neuron_name = neuron_data[idx_neuron]["label"]
             trace_data.append({
                 "idx_neuron": idx_neuron,
-                "trace": neuron.trace,
+                "trace": traces[idx_neuron]["trace"],
                 "name": neuron_name
             })
             if neuron_name not in colors:
@@ -0,0 +1,76 @@
+"""
+Compact binary wire format for traces and behavior.
+
+Layout (all little-endian):
+    4 bytes     magic b"WWWB"
+    uint32      length of the JSON header in bytes (including padding)
+    header      UTF-8 JSON (dataset_id, idx list, dtype, shape, ...) padded with spaces so the
+                array starts on an 8-byte boundary and can be viewed as a typed array directly
+    array       raw C-ordered array with the dtype and shape given in the header
+"""
+
+import json
+import struct
+import numpy as np
+from django.http import HttpResponse
+
+BINARY_MAGIC = b"WWWB"
+BINARY_CONTENT_TYPE = "application/octet-stream"
+BINARY_DTYPES = {
+    "f32": np.dtype("<f4"),
+    "f16": np.dtype("<f2"),
+}
+BINARY_DTYPE_DEFAULT = "f32"
+
+
+def get_binary_dtype(request):
+    """
+    Return the numpy dtype of the binary encoding requested by the client, or None for JSON.
+    The binary format is selected with ?format=bin or with "Accept: application/octet-stream".
+    The dtype is selected with ?dtype=f32 (default) or ?dtype=f16.
+    Raises ValueError for an unknown format or dtype.
+    """
+    fmt = request.GET.get("format")
+    if fmt is None:
+        accept = request.headers.get("Accept", "")
+        fmt = "bin" if BINARY_CONTENT_TYPE in accept else "json"
+
+    if fmt == "json":
+        return None
+    if fmt != "bin":
+        raise ValueError(f"Unknown format: {fmt}")
+
+    dtype = request.GET.get("dtype", BINARY_DTYPE_DEFAULT)
+    if dtype not in BINARY_DTYPES:
+        raise ValueError(f"Unknown dtype: {dtype}")
+
+    return BINARY_DTYPES[dtype]
+
+
+def encode_binary(header, array, dtype):
+    array = np.ascontiguousarray(array, dtype=dtype)
+    header = dict(header, dtype=array.dtype.name, shape=list(array.shape))
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    # pad so that the array offset (magic + length + header) is a multiple of 8
+    header_bytes += b" " * (-(len(BINARY_MAGIC) + 4 + len(header_bytes)) % 8)
+
+    return b"".join([BINARY_MAGIC, struct.pack("<I", len(header_bytes)), header_bytes, array.tobytes()])
+
+
+def decode_binary(content):
+    """Inverse of encode_binary. Returns (header, array)."""
+    if content[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Invalid binary payload")
+    offset = len(BINARY_MAGIC) + 4
+    (n_header,) = struct.unpack("<I", content[len(BINARY_MAGIC):offset])
+    header = json.loads(content[offset:offset + n_header])
+    array = np.frombuffer(content, dtype=np.dtype(header["dtype"]).newbyteorder("<"), offset=offset + n_header)
+
+    return header, array.reshape(header["shape"])
+
+
+class BinaryResponse(HttpResponse):
+    def __init__(self, header, array, dtype, **kwargs):
+        kwargs.setdefault("content_type", BINARY_CONTENT_TYPE)
+        super().__init__(content=encode_binary(header, array, dtype), **kwargs)
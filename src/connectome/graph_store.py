@@ -0,0 +1,565 @@
+import json
+import os
+import time
+from heapq import heappush, heappop
+from itertools import count
+import numpy as np
+from django.conf import settings
+
+GRAPH_LEVELS = ("neuron", "class")
+GRAPH_VARIANTS = ("all", "chemical_only")
+GRAPH_ARRAYS = {
+    "indptr": np.int32,  # CSR offsets of the out-edges, n_node + 1 per graph
+    "indices": np.int32,  # post node id of each edge
+    "weight": np.int32,  # synapse count of each edge
+    "synapse_type": "S1",  # synapse type of each edge
+    "in_indptr": np.int32,  # CSR offsets of the in-edges, n_node + 1 per graph
+    "in_indices": np.int32,  # pre node id of each in-edge
+    "in_weight": np.int32,  # synapse count of each in-edge
+}
+# all-pairs shortest-path tables, n_node x n_node per graph for weighted and then unweighted
+TABLE_ARRAYS = {
+    "dist": np.float64,  # distance from the source (row) to each node, inf if not reachable
+    "rank": np.int32,  # order in which the search from the source reached each node, -1 if not reachable
+}
+GRAPH_INDEX_FILE = "index.json"
+
+# caps of a path query, so that a single request cannot stall a worker
+MAX_PATHS = 100
+SEARCH_TIMEOUT = 2.0  # seconds
+
+
+class NodeNotFound(Exception):
+    pass
+
+
+class NoPath(Exception):
+    pass
+
+
+def get_graph_store_path(name):
+    return os.path.join(settings.GRAPH_STORE_DIR, name)
+
+
+def get_edge_costs(weight, weighted):
+    """The cost of an edge is 1 / synapse count if weighted, else 1."""
+    if weighted:
+        return 1 / weight.astype(np.float64)
+    return np.ones(len(weight))
+
+
+class CSRGraph:
+    """
+    Read-only directed graph in CSR format (integer node ids). The node and neighbor orders
+    are the insertion orders of the networkx graph it was built from, so that the path
+    search returns the same paths, in the same order, as networkx.
+
+    tables ({weighted: (dist, rank)}, see compute_path_tables) turns the path search into a
+    lookup of the tied predecessors of each node on the path.
+    """
+    def __init__(self, nodes, arrays, tables=None):
+        self.nodes = nodes
+        self.node_index = {name: i for i, name in enumerate(nodes)}
+        self.arrays = arrays
+        self.tables = tables
+
+    def __contains__(self, node):
+        return node in self.node_index
+
+    def get_edge_data(self, u, v):
+        """Return {"weight", "synapse_type"} of the edge u -> v, or None."""
+        i_u = self.node_index[u]
+        start, end = self.arrays["indptr"][i_u], self.arrays["indptr"][i_u + 1]
+        match = np.flatnonzero(self.arrays["indices"][start:end] == self.node_index[v])
+        if len(match) == 0:
+            return None
+        i = start + match[0]
+
+        return {"weight": int(self.arrays["weight"][i]), "synapse_type": self.arrays["synapse_type"][i].decode()}
+
+    def get_edge_cost(self, i_u, i_v, weighted):
+        start, end = self.arrays["indptr"][i_u], self.arrays["indptr"][i_u + 1]
+        i = start + np.flatnonzero(self.arrays["indices"][start:end] == i_v)[0]
+        return 1 / float(self.arrays["weight"][i]) if weighted else 1
+
+    def get_path_cost(self, path, weighted):
+        return sum(self.get_edge_cost(u, v, weighted) for u, v in zip(path[:-1], path[1:]))
+
+    def get_neighbors(self, i_node, weighted):
+        """Return [(neighbor id, cost)] of the out-edges."""
+        start, end = self.arrays["indptr"][i_node], self.arrays["indptr"][i_node + 1]
+        indices = self.arrays["indices"][start:end].tolist()
+        costs = get_edge_costs(self.arrays["weight"][start:end], weighted).tolist()
+
+        return zip(indices, costs)
+
+    def get_in_neighbors(self, i_node, weighted):
+        """Return [(neighbor id, cost)] of the in-edges."""
+        start, end = self.arrays["in_indptr"][i_node], self.arrays["in_indptr"][i_node + 1]
+        indices = self.arrays["in_indices"][start:end].tolist()
+        costs = get_edge_costs(self.arrays["in_weight"][start:end], weighted).tolist()
+
+        return zip(indices, costs)
+
+    def search_unweighted(self, source):
+        """
+        Breadth-first search, same as networkx.predecessor.
+        Returns (pred, level), level in the order the nodes were reached.
+        """
+        level = 0
+        nextlevel = [source]
+        seen = {source: level}
+        pred = {source: []}
+        while nextlevel:
+            level += 1
+            thislevel = nextlevel
+            nextlevel = []
+            for v in thislevel:
+                for w, _ in self.get_neighbors(v, False):
+                    if w not in seen:
+                        pred[w] = [v]
+                        seen[w] = level
+                        nextlevel.append(w)
+                    elif seen[w] == level:
+                        pred[w].append(v)
+
+        return pred, seen
+
+    def search_dijkstra(self, source):
+        """
+        Dijkstra keeping all tied predecessors, same as networkx.dijkstra_predecessor_and_distance.
+        Returns (pred, dist), dist in the order the nodes were reached.
+        """
+        dist = {}
+        seen = {source: 0}
+        pred = {source: []}
+        c = count()
+        fringe = [(0, next(c), source)]
+        while fringe:
+            dist_v, _, v = heappop(fringe)
+            if v in dist:
+                continue
+            dist[v] = dist_v
+            for u, cost in self.get_neighbors(v, True):
+                vu_dist = dist_v + cost
+                if u in dist:
+                    if vu_dist == dist[u]:
+                        pred[u].append(v)
+                elif u not in seen or vu_dist < seen[u]:
+                    seen[u] = vu_dist
+                    heappush(fringe, (vu_dist, next(c), u))
+                    pred[u] = [v]
+                elif vu_dist == seen[u]:
+                    pred[u].append(v)
+
+        return pred, dist
+
+    def shortest_path(self, source, target, weighted, removed_nodes=(), removed_edges=(), max_hops=None):
+        """
+        Return one shortest path (node ids) from source to target with at most max_hops edges
+        avoiding removed_nodes and removed_edges ({(u, v)}), or None.
+        """
+        if max_hops is not None:
+            return self.shortest_path_bounded(source, target, weighted, removed_nodes, removed_edges, max_hops)
+
+        dist = {}
+        seen = {source: 0}
+        pred = {source: None}
+        c = count()
+        fringe = [(0, next(c), source)]
+        while fringe:
+            dist_v, _, v = heappop(fringe)
+            if v in dist:
+                continue
+            dist[v] = dist_v
+            if v == target:
+                break
+            for u, cost in self.get_neighbors(v, weighted):
+                if u in dist or u in removed_nodes or (v, u) in removed_edges:
+                    continue
+                vu_dist = dist_v + cost
+                if u not in seen or vu_dist < seen[u]:
+                    seen[u] = vu_dist
+                    pred[u] = v
+                    heappush(fringe, (vu_dist, next(c), u))
+        if target not in dist:
+            return None
+
+        path = [target]
+        while pred[path[-1]] is not None:
+            path.append(pred[path[-1]])
+        path.reverse()
+
+        return path
+
+    def relax_bounded(self, source, weighted, removed_nodes, removed_edges, max_hops):
+        """
+        One relaxation round per hop (Bellman-Ford), up to max_hops rounds or until no cost improves.
+        Yields (best, pred) after each round: best {node: lowest cost with at most that many edges}
+        (updated in place) and pred {node: predecessor} of the nodes improved in the round.
+        """
+        best = {source: 0}  # lowest cost found with any number of hops
+        frontier = {source: 0}  # nodes improved in the last round
+        for _ in range(max_hops):
+            improved = {}
+            pred = {}
+            for v, dist_v in frontier.items():
+                for u, cost in self.get_neighbors(v, weighted):
+                    if u in removed_nodes or (v, u) in removed_edges:
+                        continue
+                    vu_dist = dist_v + cost
+                    if vu_dist < best.get(u, np.inf) and vu_dist < improved.get(u, np.inf):
+                        improved[u] = vu_dist
+                        pred[u] = v
+            if not improved:
+                break
+            best.update(improved)
+            yield best, pred
+            frontier = improved
+
+    def shortest_path_bounded(self, source, target, weighted, removed_nodes, removed_edges, max_hops):
+        """
+        shortest_path with at most max_hops edges, see relax_bounded.
+        With positive costs the shortest path is simple.
+        """
+        best = {source: 0}
+        preds = []  # {node: predecessor} of each round
+        for best, pred in self.relax_bounded(source, weighted, removed_nodes, removed_edges, max_hops):
+            preds.append(pred)
+        if target not in best or target == source:
+            return [source] if target == source else None
+
+        # the round in which the target got its lowest cost
+        n_hop = max(i for i, pred in enumerate(preds, 1) if target in pred)
+        path = [target]
+        for pred in reversed(preds[:n_hop]):
+            path.append(pred[path[-1]])
+        path.reverse()
+
+        return path
+
+    def search(self, source, weighted):
+        return self.search_dijkstra(source) if weighted else self.search_unweighted(source)
+
+    def get_table_predecessors(self, source, weighted):
+        """
+        Return get_pred(node) of the precomputed tables. The tied predecessors of a node are
+        the pre nodes v of its in-edges with dist[v] + cost == dist[node], which are the
+        predecessors appended by the search, in the order the search reached them.
+        """
+        dist_table, rank_table = self.tables[weighted]
+        dist = dist_table[source]
+        rank = rank_table[source]
+        in_indptr = self.arrays["in_indptr"]
+
+        def get_pred(node):
+            start, end = in_indptr[node], in_indptr[node + 1]
+            pre = self.arrays["in_indices"][start:end]
+            costs = get_edge_costs(self.arrays["in_weight"][start:end], weighted)
+            pre = pre[dist[pre] + costs == dist[node]]
+            return pre[np.argsort(rank[pre], kind="stable")].tolist()
+
+        return dist, get_pred
+
+    def get_node_ids(self, source, target):
+        if source not in self.node_index:
+            raise NodeNotFound(f"Source {source} not in the graph")
+        return self.node_index[source], self.node_index.get(target)
+
+    def all_shortest_paths(self, source, target, weighted=True, max_hops=None, max_paths=None, deadline=None):
+        """
+        Return (paths, truncated): all shortest paths (lists of node names) from source to target
+        among the paths with at most max_hops edges. The cost of an edge is 1 / synapse count if
+        weighted, else 1. truncated is True if the enumeration stopped at max_paths paths or at
+        deadline (time.monotonic()). If none of the shortest paths without the hop limit fits in
+        max_hops, the costlier paths within max_hops are searched (see get_bounded_predecessors).
+        Raises NodeNotFound if source is not in the graph and NoPath if target cannot be reached.
+        """
+        i_source, i_target = self.get_node_ids(source, target)
+
+        if self.tables is not None:
+            dist, get_pred = self.get_table_predecessors(i_source, weighted)
+            if i_target is None or np.isinf(dist[i_target]):
+                raise NoPath(f"Target {target} cannot be reached from {source}")
+        else:
+            pred, _ = self.search(i_source, weighted)
+            if i_target not in pred:
+                raise NoPath(f"Target {target} cannot be reached from {source}")
+            get_pred = pred.__getitem__
+
+        preds = {}
+
+        def get_pred_depth(node, depth):
+            if node not in preds:
+                preds[node] = get_pred(node)
+            return preds[node]
+
+        paths, truncated = self.walk_predecessors(i_source, i_target, get_pred_depth, max_hops, max_paths, deadline)
+        if max_hops is not None and not paths and not truncated:
+            get_pred_depth, n_hop = self.get_bounded_predecessors(i_source, i_target, weighted, max_hops)
+            if get_pred_depth is None:
+                return [], False
+            paths, truncated = self.walk_predecessors(i_source, i_target, get_pred_depth, n_hop, max_paths, deadline)
+
+        return paths, truncated
+
+    def get_bounded_predecessors(self, source, target, weighted, max_hops):
+        """
+        Return (get_pred(node, depth), n_hop) of the shortest paths with at most max_hops edges, or
+        (None, None) if there is none. costs[h] (see relax_bounded) is the lowest cost of each node
+        with at most h edges; a node at depth d (hops from the target) on a shortest path has the cost
+        costs[n_hop - d], and its tied predecessors are the pre nodes u of its in-edges with
+        costs[n_hop - d - 1][u] + cost == costs[n_hop - d][node]. With positive costs the paths are simple.
+        """
+        costs = [{source: 0}]
+        for best, _ in self.relax_bounded(source, weighted, (), (), max_hops):
+            costs.append(dict(best))
+        n_hop = len(costs) - 1
+        if target not in costs[n_hop]:
+            return None, None
+
+        def get_pred(node, depth):
+            h = n_hop - depth
+            if h == 0:
+                return []
+            return [
+                pre for pre, cost in self.get_in_neighbors(node, weighted)
+                if pre in costs[h - 1] and costs[h - 1][pre] + cost == costs[h][node]
+            ]
+
+        return get_pred, n_hop
+
+    def walk_predecessors(self, i_source, i_target, get_pred, max_hops, max_paths, deadline):
+        """
+        Return (paths, truncated): the paths from i_source to i_target walking back the predecessors
+        get_pred(node, depth) depth-first (same order as networkx), with at most max_hops edges.
+        """
+        # (the stack depth is the number of hops from the target)
+        paths = []
+        truncated = False
+        seen = {i_target}
+        stack = [[i_target, 0, None]]
+        top = 0
+        while top >= 0:
+            # (one path more than max_paths tells that the result is truncated)
+            if (max_paths is not None and len(paths) > max_paths) or \
+                    (deadline is not None and time.monotonic() > deadline):
+                truncated = True
+                break
+            node, i, node_preds = stack[top]
+            if node_preds is None:
+                if node == i_source:
+                    paths.append([self.nodes[p] for p, _, _ in reversed(stack[:top + 1])])
+                node_preds = stack[top][2] = get_pred(node, top)
+            if len(node_preds) > i and (max_hops is None or top < max_hops):
+                stack[top][1] = i + 1
+                next_node = node_preds[i]
+                if next_node in seen:
+                    continue
+                seen.add(next_node)
+                top += 1
+                if top == len(stack):
+                    stack.append([next_node, 0, None])
+                else:
+                    stack[top][:] = [next_node, 0, None]
+            else:
+                seen.discard(node)
+                top -= 1
+        if max_paths is not None and len(paths) > max_paths:
+            truncated = True
+            del paths[max_paths:]
+
+        return paths, truncated
+
+    def k_shortest_paths(self, source, target, k, weighted=True, max_hops=None, deadline=None):
+        """
+        Return (paths, truncated): the k shortest simple paths (lists of node names) from source to
+        target with at most max_hops edges, in order of cost (Yen's algorithm).
+        truncated is True if the enumeration stopped at deadline (time.monotonic()).
+        Raises NodeNotFound if source is not in the graph and NoPath if target cannot be reached.
+        """
+        i_source, i_target = self.get_node_ids(source, target)
+        path = None
+        if i_target is not None:
+            path = self.shortest_path(i_source, i_target, weighted, max_hops=max_hops)
+        if path is None:
+            raise NoPath(f"Target {target} cannot be reached from {source}")
+
+        paths = [path]
+        candidates = []
+        candidate_set = {tuple(path)}
+        c = count()
+        truncated = False
+        while len(paths) < k and not truncated:
+            prev = paths[-1]
+            for j in range(len(prev) - 1):
+                if deadline is not None and time.monotonic() > deadline:
+                    truncated = True
+                    break
+                root = prev[:j + 1]
+                removed_edges = {(p[j], p[j + 1]) for p in paths if p[:j + 1] == root}
+                spur = self.shortest_path(
+                    root[-1], i_target, weighted, set(root[:-1]), removed_edges,
+                    max_hops=None if max_hops is None else max_hops - j
+                )
+                if spur is None:
+                    continue
+                path = tuple(root[:-1] + spur)
+                if path not in candidate_set:
+                    candidate_set.add(path)
+                    heappush(candidates, (self.get_path_cost(path, weighted), next(c), path))
+            if truncated or not candidates:
+                break
+
+            _, _, path = heappop(candidates)
+            paths.append(list(path))
+
+        return [[self.nodes[p] for p in path] for path in paths], truncated
+
+
+def compute_path_tables(graph, weighted):
+    """Return the (dist, rank) n_node x n_node tables of a graph, one search per source node."""
+    n = len(graph.nodes)
+    dist = np.full((n, n), np.inf, dtype=TABLE_ARRAYS["dist"])
+    rank = np.full((n, n), -1, dtype=TABLE_ARRAYS["rank"])
+    for source in range(n):
+        _, dist_source = graph.search(source, weighted)
+        nodes = list(dist_source)
+        dist[source, nodes] = list(dist_source.values())
+        rank[source, nodes] = np.arange(len(nodes))
+
+    return dist, rank
+
+
+def graph_to_csr(g):
+    """Return (nodes, {array name: array}) of a networkx DiGraph with weight/synapse_type edges."""
+    nodes = list(g.nodes)
+    node_index = {name: i for i, name in enumerate(nodes)}
+    indptr = [0]
+    indices = []
+    weight = []
+    synapse_type = []
+    for name in nodes:
+        for post, data in g.adj[name].items():
+            indices.append(node_index[post])
+            weight.append(data["weight"])
+            synapse_type.append(data["synapse_type"])
+        indptr.append(len(indices))
+
+    in_indptr = [0]
+    in_indices = []
+    in_weight = []
+    for name in nodes:
+        for pre, data in g.pred[name].items():
+            in_indices.append(node_index[pre])
+            in_weight.append(data["weight"])
+        in_indptr.append(len(in_indices))
+
+    arrays = {
+        "indptr": indptr, "indices": indices, "weight": weight, "synapse_type": synapse_type,
+        "in_indptr": in_indptr, "in_indices": in_indices, "in_weight": in_weight
+    }
+    return nodes, {name: np.array(arrays[name], dtype=dtype) for name, dtype in GRAPH_ARRAYS.items()}
+
+
+def save_arrays(arrays, dtypes):
+    for name, dtype in dtypes.items():
+        path = get_graph_store_path(f"{name}.npy")
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, np.concatenate(arrays[name]) if arrays[name] else np.array([], dtype=dtype))
+        os.replace(path + ".tmp", path)
+
+
+def write_graph_store(dataset_graphs):
+    """
+    Write the graphs ({dataset_id: {level: {variant: DiGraph}}}, see initialize_graphs) and their
+    all-pairs shortest-path tables as one concatenated .npy file per array and an index of the
+    node names and offsets of each graph. The index is written last so that readers never see
+    a partially written store.
+    """
+    os.makedirs(settings.GRAPH_STORE_DIR, exist_ok=True)
+
+    index = {}
+    arrays = {name: [] for name in GRAPH_ARRAYS}
+    tables = {name: [] for name in TABLE_ARRAYS}
+    node_offset = 0
+    edge_offset = 0
+    table_offset = 0
+    for dataset_id, graphs in dataset_graphs.items():
+        index[dataset_id] = {}
+        for level in GRAPH_LEVELS:
+            index[dataset_id][level] = {}
+            for variant in GRAPH_VARIANTS:
+                nodes, graph_arrays = graph_to_csr(graphs[level][variant])
+                index[dataset_id][level][variant] = {
+                    "nodes": nodes, "node_offset": node_offset, "edge_offset": edge_offset,
+                    "table_offset": table_offset
+                }
+                for name, array in graph_arrays.items():
+                    arrays[name].append(array)
+                node_offset += len(nodes) + 1
+                edge_offset += len(graph_arrays["indices"])
+
+                graph = CSRGraph(nodes, graph_arrays)
+                for weighted in (True, False):
+                    dist, rank = compute_path_tables(graph, weighted)
+                    tables["dist"].append(dist.ravel())
+                    tables["rank"].append(rank.ravel())
+                    table_offset += len(nodes) ** 2
+
+    save_arrays(arrays, GRAPH_ARRAYS)
+    save_arrays(tables, TABLE_ARRAYS)
+
+    path = get_graph_store_path(GRAPH_INDEX_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+
+    return settings.GRAPH_STORE_DIR
+
+
+def load_graph_store():
+    """
+    Return {dataset_id: {level: {variant: CSRGraph}}} with the arrays memory-mapped read-only,
+    or None if the store does not exist. The OS page cache shares the mapped pages across all
+    workers on the host.
+    """
+    t1 = time.time_ns()
+    path_index = get_graph_store_path(GRAPH_INDEX_FILE)
+    if not os.path.exists(path_index):
+        return None
+    with open(path_index) as f:
+        index = json.load(f)
+    arrays = {
+        name: np.load(get_graph_store_path(f"{name}.npy"), mmap_mode="r")
+        for name in list(GRAPH_ARRAYS) + list(TABLE_ARRAYS)
+    }
+
+    dataset_graphs = {}
+    for dataset_id, levels in index.items():
+        dataset_graphs[dataset_id] = {}
+        for level, variants in levels.items():
+            dataset_graphs[dataset_id][level] = {}
+            for variant, entry in variants.items():
+                nodes = entry["nodes"]
+                n = len(nodes)
+                node_slice = slice(entry["node_offset"], entry["node_offset"] + n + 1)
+                n_edge = int(arrays["indptr"][node_slice][-1])
+                edge_slice = slice(entry["edge_offset"], entry["edge_offset"] + n_edge)
+                graph_arrays = {
+                    name: arrays[name][node_slice if name.endswith("indptr") else edge_slice]
+                    for name in GRAPH_ARRAYS
+                }
+
+                tables = {}
+                for i, weighted in enumerate((True, False)):
+                    start = entry["table_offset"] + i * n ** 2
+                    tables[weighted] = tuple(
+                        arrays[name][start:start + n ** 2].reshape(n, n) for name in TABLE_ARRAYS
+                    )
+
+                dataset_graphs[dataset_id][level][variant] = CSRGraph(nodes, graph_arrays, tables)
+    t2 = time.time_ns()
+    print(f"graph loading done. elapsed: {(t2-t1)/1e9} seconds")
+
+    return dataset_graphs
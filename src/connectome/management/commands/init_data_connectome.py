@@ -5,7 +5,7 @@ import json
 import csv
 import os
 import time
-from core.utility import sha256, load_csv
+from core.utility import sha256, load_csv, iter_json_array
 
 PATH_DATSETS = ["connectome", "connectome_datasets.json"]
 PATH_NEURONS = ["connectome", "connectome_neurons.csv"]
@@ -163,15 +163,13 @@ class Command(BaseCommand):
             # Process each connectome dataset
             for json_name in json_files:
                 path_json = os.path.join(path_connectome_dir, json_name)
-                with open(path_json, 'r') as file:
-                    json_data = json.load(file)
 
                 dataset_name = os.path.splitext(json_name)[0]
                 assert sha256(path_json) == dict_checksum[json_name], "Checksum error for " + dataset_name
 
-                # Get synapse data
+                # Get synapse data (streamed one synapse at a time)
                 new_synapse_dict = {}
-                for syn in json_data:
+                for syn in iter_json_array(path_json):
                     syn_type = "c" if syn["typ"] == 0 else "e" if syn["typ"] == 2 else None
                     assert syn_type is not None, f"Invalid synapse type: {syn['typ']}"
                     
@@ -1,11 +1,11 @@
 from django.core.management.base import BaseCommand
 from connectome.graph_init import initialize_graphs
-import pickle
+from connectome.graph_store import write_graph_store
+
 class Command(BaseCommand):
-    help = 'Pre-compute and pickle graph data'
+    help = 'Pre-compute the graph data (CSR arrays memory-mapped by the workers)'
 
     def handle(self, *args, **options):
         dataset_graphs = initialize_graphs()
-        with open("connectome_graphs.pkl", "wb") as f:
-            pickle.dump(dataset_graphs, f)
-        self.stdout.write(self.style.SUCCESS("graph pre-compute success"))
+        path = write_graph_store(dataset_graphs)
+        self.stdout.write(self.style.SUCCESS(f"graph pre-compute success: {path}"))
@@ -1,3 +1,418 @@
-from django.test import TestCase
+import io
+import itertools
+import random
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+import networkx as nx
+import numpy as np
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+import connectome.graph_data
+from connectome.models import Dataset
+from connectome.views import (
+    PATHS_MAX_AGE, get_edge_response_data, find_dataset_paths, get_paths_cache_key, get_paths_cache_keys
+)
+from core.caching import dataset_key, get_dataset_versions, reset_dataset_versions
+from connectome.graph_store import (
+    CSRGraph, NodeNotFound, NoPath, graph_to_csr, compute_path_tables, write_graph_store, load_graph_store
+)
+
+
+'''
+
+Reference (networkx) implementations of the path search
+
+'''
+def get_weight_reference(weighted):
+    # same edge cost as the networkx graphs of the find paths feature before the CSR store
+    return (lambda u, v, data: 1 / data["weight"]) if weighted else None
+
+def all_shortest_paths_reference(g, source, target, weighted):
+    return list(nx.all_shortest_paths(g, source, target, method="dijkstra", weight=get_weight_reference(weighted)))
+
+def get_path_cost_reference(g, path, weighted):
+    return sum(1 / g[u][v]["weight"] if weighted else 1 for u, v in zip(path[:-1], path[1:]))
+
+def k_shortest_paths_reference(g, source, target, k, weighted, max_hops=None):
+    if max_hops is None:
+        return list(itertools.islice(nx.shortest_simple_paths(g, source, target, weight=get_weight_reference(weighted)), k))
+    if not nx.has_path(g, source, target):
+        raise nx.NetworkXNoPath
+    paths = nx.all_simple_paths(g, source, target, cutoff=max_hops)
+
+    return sorted(paths, key=lambda path: get_path_cost_reference(g, path, weighted))[:k]
+
+def all_shortest_paths_bounded_reference(g, source, target, weighted, max_hops):
+    # the cheapest of the simple paths with at most max_hops edges, and their ties
+    paths = list(nx.all_simple_paths(g, source, target, cutoff=max_hops))
+    if not paths:
+        return []
+    costs = [get_path_cost_reference(g, path, weighted) for path in paths]
+    min_cost = min(costs)
+
+    return [path for path, cost in zip(paths, costs) if abs(cost - min_cost) < 1e-12]
+
+def get_table_graph(g):
+    nodes, arrays = graph_to_csr(g)
+    graph = CSRGraph(nodes, arrays)
+
+    return CSRGraph(nodes, arrays, {weighted: compute_path_tables(graph, weighted) for weighted in (True, False)})
+
+def random_graph(seed, n_node=30, n_edge=120):
+    rng = random.Random(seed)
+    g = nx.DiGraph()
+    names = [f"N{i}" for i in range(n_node)]
+    g.add_nodes_from(names)
+    for _ in range(n_edge):
+        pre, post = rng.sample(names, 2)
+        g.add_edge(pre, post, weight=rng.randint(1, 3), synapse_type=rng.choice("ce"))
+
+    return g
+
+
+class CSRGraphTest(SimpleTestCase):
+    def setUp(self):
+        self.graphs = [random_graph(seed) for seed in range(3)]
+
+    def test_all_shortest_paths(self):
+        for g in self.graphs:
+            graph = CSRGraph(*graph_to_csr(g))
+            for source, target in itertools.permutations(list(g.nodes)[:12], 2):
+                for weighted in (True, False):
+                    try:
+                        reference = all_shortest_paths_reference(g, source, target, weighted)
+                    except nx.NetworkXNoPath:
+                        with self.assertRaises(NoPath):
+                            graph.all_shortest_paths(source, target, weighted=weighted)
+                        continue
+                    # same paths in the same order as networkx
+                    self.assertEqual(graph.all_shortest_paths(source, target, weighted=weighted), (reference, False))
+
+    def test_node_not_found(self):
+        graph = CSRGraph(*graph_to_csr(self.graphs[0]))
+        with self.assertRaises(NodeNotFound):
+            graph.all_shortest_paths("XX", "N1")
+        # an unknown target is not reachable
+        with self.assertRaises(NoPath):
+            graph.all_shortest_paths("N1", "XX")
+
+    def test_get_edge_data(self):
+        g = self.graphs[0]
+        graph = CSRGraph(*graph_to_csr(g))
+        for pre, post, data in g.edges(data=True):
+            self.assertEqual(graph.get_edge_data(pre, post), data)
+        self.assertIsNone(graph.get_edge_data("N0", "N0"))
+
+    def test_truncated(self):
+        # many tied paths: each layer is fully connected to the next one
+        g = nx.DiGraph()
+        layers = [["S"]] + [[f"L{i}_{j}" for j in range(4)] for i in range(4)] + [["T"]]
+        for layer, next_layer in zip(layers[:-1], layers[1:]):
+            for pre, post in itertools.product(layer, next_layer):
+                g.add_edge(pre, post, weight=1, synapse_type="c")
+        graph = CSRGraph(*graph_to_csr(g))
+        reference = all_shortest_paths_reference(g, "S", "T", True)
+
+        paths, truncated = graph.all_shortest_paths("S", "T", max_paths=10)
+        self.assertEqual((paths, truncated), (reference[:10], True))
+        paths, truncated = graph.all_shortest_paths("S", "T", max_paths=len(reference))
+        self.assertEqual((paths, truncated), (reference, False))
+
+        # the enumeration stops at the deadline
+        paths, truncated = graph.all_shortest_paths("S", "T", deadline=time.monotonic() - 1)
+        self.assertEqual((paths, truncated), ([], True))
+
+    def test_graph_store(self):
+        dataset_graphs = {
+            f"d{i}": {level: {"all": g, "chemical_only": g} for level in ("neuron", "class")}
+            for i, g in enumerate(self.graphs)
+        }
+        with tempfile.TemporaryDirectory() as path, override_settings(GRAPH_STORE_DIR=path):
+            write_graph_store(dataset_graphs)
+            loaded = load_graph_store()
+
+            for dataset_id, g in zip(dataset_graphs, self.graphs):
+                graph = loaded[dataset_id]["neuron"]["all"]
+                self.assertEqual(graph.nodes, list(g.nodes))
+                for pre, post, data in g.edges(data=True):
+                    self.assertEqual(graph.get_edge_data(pre, post), data)
+
+
+class PathTablesTest(SimpleTestCase):
+    def setUp(self):
+        self.graphs = [random_graph(seed) for seed in range(3)]
+
+    def test_compute_path_tables(self):
+        g = self.graphs[0]
+        graph = get_table_graph(g)
+        for weighted in (True, False):
+            dist, rank = graph.tables[weighted]
+            for i, source in enumerate(g.nodes):
+                reference = nx.single_source_dijkstra_path_length(
+                    g, source, weight=get_weight_reference(weighted) or (lambda u, v, data: 1)
+                )
+                for j, target in enumerate(g.nodes):
+                    if target in reference:
+                        self.assertAlmostEqual(dist[i, j], reference[target], places=12)
+                        self.assertGreaterEqual(rank[i, j], 0)
+                    else:
+                        self.assertEqual(dist[i, j], np.inf)
+                        self.assertEqual(rank[i, j], -1)
+
+    def test_all_shortest_paths(self):
+        for g in self.graphs:
+            graph = get_table_graph(g)
+            for source, target in itertools.permutations(list(g.nodes)[:12], 2):
+                for weighted in (True, False):
+                    try:
+                        reference = all_shortest_paths_reference(g, source, target, weighted)
+                    except nx.NetworkXNoPath:
+                        with self.assertRaises(NoPath):
+                            graph.all_shortest_paths(source, target, weighted=weighted)
+                        continue
+                    # the lookup of the tied predecessors gives the paths of the search, in the same order
+                    self.assertEqual(graph.all_shortest_paths(source, target, weighted=weighted), (reference, False))
+
+    def test_graph_store_tables(self):
+        g = self.graphs[1]
+        dataset_graphs = {"d": {level: {"all": g, "chemical_only": g} for level in ("neuron", "class")}}
+        with tempfile.TemporaryDirectory() as path, override_settings(GRAPH_STORE_DIR=path):
+            write_graph_store(dataset_graphs)
+            graph = load_graph_store()["d"]["class"]["chemical_only"]
+
+            for weighted in (True, False):
+                for table, reference in zip(graph.tables[weighted], get_table_graph(g).tables[weighted]):
+                    np.testing.assert_array_equal(table, reference)
+
+
+class KShortestPathsTest(SimpleTestCase):
+    def setUp(self):
+        self.g = random_graph(0)
+        self.graph = get_table_graph(self.g)
+
+    def assertSamePaths(self, paths, reference, weighted):
+        # ties may be in another order, the costs are the same
+        self.assertEqual(len(paths), len(reference))
+        self.assertEqual(len(set(map(tuple, paths))), len(paths))
+        for path, path_reference in zip(paths, reference):
+            self.assertEqual(len(set(path)), len(path))
+            self.assertTrue(all(self.g.has_edge(u, v) for u, v in zip(path[:-1], path[1:])))
+            self.assertAlmostEqual(get_path_cost_reference(self.g, path, weighted),
+                                   get_path_cost_reference(self.g, path_reference, weighted), places=12)
+
+    def test_k_shortest_paths(self):
+        for source, target in itertools.permutations(list(self.g.nodes)[:10], 2):
+            for weighted in (True, False):
+                for max_hops in (None, 3):
+                    try:
+                        reference = k_shortest_paths_reference(self.g, source, target, 8, weighted, max_hops)
+                    except nx.NetworkXNoPath:
+                        reference = []
+                    if not reference:
+                        with self.assertRaises(NoPath):
+                            self.graph.k_shortest_paths(source, target, 8, weighted=weighted, max_hops=max_hops)
+                        continue
+                    paths, truncated = self.graph.k_shortest_paths(source, target, 8, weighted=weighted, max_hops=max_hops)
+                    self.assertFalse(truncated)
+                    self.assertSamePaths(paths, reference, weighted)
+
+    def test_all_shortest_paths_max_hops(self):
+        for source, target in itertools.permutations(list(self.g.nodes)[:10], 2):
+            for weighted in (True, False):
+                try:
+                    reference = all_shortest_paths_reference(self.g, source, target, weighted)
+                except nx.NetworkXNoPath:
+                    continue
+                paths, truncated = self.graph.all_shortest_paths(source, target, weighted=weighted, max_hops=2)
+                self.assertFalse(truncated)
+                bounded = [path for path in reference if len(path) - 1 <= 2]
+                if bounded:
+                    # a shortest path fits in max_hops: same paths in the same order as networkx
+                    self.assertEqual(paths, bounded)
+                else:
+                    self.assertCountEqual(paths, all_shortest_paths_bounded_reference(self.g, source, target, weighted, 2))
+
+    def test_all_shortest_paths_max_hops_costlier(self):
+        # the cheapest path S-A-B-C-T has 4 edges, the ones within 2 edges cost more
+        g = nx.DiGraph()
+        for pre, post, weight in [("S", "A", 10), ("A", "B", 10), ("B", "C", 10), ("C", "T", 10),
+                                  ("S", "D", 4), ("D", "T", 4), ("S", "E", 4), ("E", "T", 4), ("S", "T", 1)]:
+            g.add_edge(pre, post, weight=weight, synapse_type="c")
+        for graph in (CSRGraph(*graph_to_csr(g)), get_table_graph(g)):
+            self.assertEqual(graph.all_shortest_paths("S", "T")[0], [["S", "A", "B", "C", "T"]])
+            # S-D-T and S-E-T tie at 1/4 + 1/4, S-T costs 1/1 and S-A-B-C-T 4/10
+            paths, truncated = graph.all_shortest_paths("S", "T", max_hops=2)
+            self.assertCountEqual(paths, [["S", "D", "T"], ["S", "E", "T"]])
+            self.assertFalse(truncated)
+            self.assertEqual(graph.all_shortest_paths("S", "T", max_hops=1), ([["S", "T"]], False))
+            self.assertEqual(graph.all_shortest_paths("S", "C", max_hops=2), ([], False))
+            # unweighted, the hop bound doesn't change the shortest path
+            self.assertEqual(graph.all_shortest_paths("S", "T", weighted=False, max_hops=2), ([["S", "T"]], False))
+
+    def test_deadline(self):
+        source, target = next(
+            (source, target) for source, target in itertools.permutations(self.g.nodes, 2)
+            if nx.has_path(self.g, source, target) and len(k_shortest_paths_reference(self.g, source, target, 2, True)) == 2
+        )
+        # the first path is always found, the enumeration of the next ones stops at the deadline
+        paths, truncated = self.graph.k_shortest_paths(source, target, 5, deadline=time.monotonic() - 1)
+        self.assertEqual(len(paths), 1)
+        self.assertTrue(truncated)
+
+
+class EdgesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Dataset.objects.create(dataset_id="d", name="d", dataset_type="x", dataset_sha256="d" * 64,
+                               animal_time=1, animal_visual_time=1)
+        reset_dataset_versions()
+
+    def tearDown(self):
+        reset_dataset_versions()
+
+    def test_fill_locks_released_on_error(self):
+        data = {"datasets": ["d"], "neurons": ["AVAL"], "classes": ["AVA"],
+                "show_individual_neuron": True, "show_connected_neuron": True}
+        with mock.patch("connectome.views.Synapse.objects.filter", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                get_edge_response_data(data)
+        for name in ("AVAL", "AVA"):
+            self.assertIsNone(cache.get(dataset_key(Dataset, "d", f"d!{name}") + "!fill"))
+
+        # the next request fills the keys without waiting for the lease
+        get_edge_response_data(data)
+        self.assertEqual(cache.get(dataset_key(Dataset, "d", "d!AVAL")), [])
+
+
+class FindPathsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.g = {f"d{i}": random_graph(i) for i in range(2)}
+        for dataset_id in self.g:
+            Dataset.objects.create(dataset_id=dataset_id, name=dataset_id, dataset_type="x",
+                                   dataset_sha256=dataset_id * 32, animal_time=1, animal_visual_time=1)
+        reset_dataset_versions()
+        self.addCleanup(reset_dataset_versions)
+        graphs = {}
+        for dataset_id, g in self.g.items():
+            graph = CSRGraph(*graph_to_csr(g))
+            graphs[dataset_id] = {level: {"all": graph, "chemical_only": graph} for level in ("neuron", "class")}
+        self.enterContext(mock.patch.object(connectome.graph_data, "GRAPH_OBJECTS", graphs))
+        self.search = self.enterContext(mock.patch("connectome.views.find_dataset_paths", side_effect=find_dataset_paths))
+        # a pair of neurons connected in both datasets
+        self.start, self.end = next(
+            (source, target) for source, target in itertools.permutations(self.g["d0"].nodes, 2)
+            if all(nx.has_path(g, source, target) for g in self.g.values())
+        )
+        self.query = [self.start, self.end, True, True, False, None, None]
+
+    def get(self, headers=None, **query):
+        return self.client.get("/connectome/api/find-paths/", dict(query, start=self.start, end=self.end),
+                               headers=headers)
+
+    def time_out(self, dataset_ids):
+        # the searches of the graphs of dataset_ids stop at the deadline
+        timed_out = [connectome.graph_data.GRAPH_OBJECTS[dataset_id]["neuron"]["all"] for dataset_id in dataset_ids]
+
+        def search(graph, *args):
+            result = find_dataset_paths(graph, *args)
+            if graph in timed_out:
+                result.update(truncated=True, timed_out=True)
+            return result
+
+        self.search.side_effect = search
+
+    def get_cached(self, dataset_id):
+        return cache.get(get_paths_cache_key(dataset_id, self.query))
+
+    def test_complete(self):
+        response = self.get(dataset="d0")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], f"public, max-age={PATHS_MAX_AGE}")
+        self.assertIn("ETag", response)
+        self.assertEqual(response.json()["paths"], self.get_cached("d0")["paths"])
+        self.assertEqual(response.json()["paths"][0]["path"][0], self.start)
+        # registered in the index of the path results of the dataset version
+        version = get_dataset_versions(Dataset)["d0"]
+        self.assertIn(get_paths_cache_key("d0", self.query), get_paths_cache_keys("d0", version))
+
+        # served from the cache, and 304 with the ETag
+        self.assertEqual(self.get(dataset="d0").content, response.content)
+        self.assertEqual(self.search.call_count, 1)
+        response_304 = self.get(dataset="d0", headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response_304.status_code, 304)
+        self.assertEqual(response_304["Cache-Control"], f"public, max-age={PATHS_MAX_AGE}")
+
+    def test_timed_out(self):
+        self.time_out(["d0"])
+        response = self.get(dataset="d0")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["truncated"])
+        self.assertNotIn("ETag", response)
+        self.assertNotIn("Cache-Control", response)
+        self.assertIsNone(self.get_cached("d0"))
+        self.assertEqual(get_paths_cache_keys("d0", get_dataset_versions(Dataset)["d0"])[1:], [])
+        # searched again by the next request
+        self.get(dataset="d0")
+        self.assertEqual(self.search.call_count, 2)
+
+    def test_errors(self):
+        for query in ({"dataset": "xx"}, {"dataset": "d0", "k": "x"}, {"dataset": "d0", "max_hops": "0"}):
+            response = self.get(**query)
+            self.assertEqual(response.status_code, 400)
+            self.assertNotIn("ETag", response)
+            self.assertNotIn("Cache-Control", response)
+
+    def test_datasets(self):
+        responses = {dataset_id: self.get(dataset=dataset_id).json() for dataset_id in self.g}
+        cache.clear()
+        response = self.get(datasets="d1,d0,d1")
+        self.assertIn("ETag", response)
+        data = response.json()
+        self.assertEqual(data["datasets"], ["d1", "d0"])
+        for dataset_id, response_dataset in responses.items():
+            self.assertEqual(data["results"][dataset_id]["paths"], response_dataset["paths"])
+        self.assertCountEqual(data["nodes"], set(responses["d0"]["nodes"]) | set(responses["d1"]["nodes"]))
+
+        # one dataset cut short by the deadline: only the other one is cached
+        cache.clear()
+        self.time_out(["d1"])
+        response = self.get(datasets="d0,d1")
+        self.assertNotIn("ETag", response)
+        self.assertNotIn("Cache-Control", response)
+        self.assertTrue(response.json()["results"]["d1"]["truncated"])
+        self.assertIsNotNone(self.get_cached("d0"))
+        self.assertIsNone(self.get_cached("d1"))
+
+    def test_deadline_per_dataset(self):
+        # the deadline starts when the search of the dataset starts, not with the request
+        graph = mock.Mock()
+        graph.all_shortest_paths.return_value = ([], True)
+        with mock.patch("connectome.views.time") as views_time:
+            views_time.monotonic.side_effect = [100, 101]
+            result = find_dataset_paths(graph, "a", "b", True, None, None, timeout=2)
+            self.assertEqual(graph.all_shortest_paths.call_args.kwargs["deadline"], 102)
+            self.assertFalse(result["timed_out"])
+            views_time.monotonic.side_effect = [200, 203]
+            result = find_dataset_paths(graph, "a", "b", True, None, None, timeout=2)
+            self.assertEqual(graph.all_shortest_paths.call_args.kwargs["deadline"], 202)
+            self.assertTrue(result["timed_out"])
+
+    def test_invalidate_cache(self):
+        call_command("invalidate_cache", stdout=io.StringIO())
+        self.get(dataset="d0")
+        self.get(dataset="d1")
+        version = get_dataset_versions(Dataset)["d0"]
+        keys = get_paths_cache_keys("d0", version)
+        self.assertEqual(len(keys), 3)  # index, entry and result
+        self.assertTrue(all(cache.get(key) is not None for key in keys))
+
+        # d0 is rebuilt: the path results of its old version are deleted, the ones of d1 are kept
+        Dataset.objects.filter(dataset_id="d0").update(dataset_sha256="e" * 64)
+        call_command("invalidate_cache", stdout=io.StringIO())
+        self.assertEqual(cache.get_many(keys), {})
+        self.assertIsNotNone(self.get_cached("d1"))
@@ -1,17 +1,46 @@
 import json
-import networkx as nx
+import time
+from concurrent.futures import ThreadPoolExecutor
 from django.shortcuts import render
 from django.http import JsonResponse, HttpResponse
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core.cache import cache
-from django.views.decorators.cache import cache_page, cache_control
+from django.views.decorators.cache import cache_control
+from django.utils.cache import patch_cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.db.models import Q, Prefetch
 from .models import Neuron, NeuronClass, Dataset, Synapse
 from collections import defaultdict
-import connectome.graph_data 
+from hashlib import sha256
+import connectome.graph_data
+from connectome.graph_store import NodeNotFound, NoPath, MAX_PATHS, SEARCH_TIMEOUT
+from core.caching import (
+    make_etag, get_dataset_versions, dataset_key, catalog_key, versioned_key, acquire_fill_lock, release_fill_lock,
+    wait_for_fill, get_or_fill, cache_page_swr
+)
+
+# cache keys (without version) of data built from all datasets, see core.caching.catalog_key
+CATALOG_CACHE_KEYS = ["connectome_datasets_json"]
+
+# threads of the multi-dataset path searches (started on demand, shared by the requests of a worker)
+PATH_SEARCH_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="find-paths")
+
+# the path results are cached per dataset version and query. Their keys are hashed, so they are
+# listed for invalidate_cache in an index per dataset version (see register_paths_cache_key)
+PATHS_CACHE_TIMEOUT = 60*60*24*30
+PATHS_MAX_AGE = 60*60*24*90
+
+
+def get_dataset_cache_keys(dataset_id):
+    """All cache keys (without version) of the data of a dataset, see core.caching.dataset_key."""
+    names = [*Neuron.objects.values_list('name', flat=True), *NeuronClass.objects.values_list('name', flat=True)]
+
+    return [f"available_neurons_{dataset_id}"] + [f"{dataset_id}!{name}" for name in names]
+
 
 def connectome_datasets(cache_key="connectome_datasets_json"):
+    cache_key = catalog_key(cache_key)
     datasets_json = cache.get(cache_key)
     if datasets_json is None:
         datasets = Dataset.objects.all()
@@ -22,28 +51,38 @@ def connectome_datasets(cache_key="connectome_datasets_json"):
     return datasets_json
 
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def index(request):
     context = {}
     
     return render(request, "connectome/index.html", context)
 
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def explore(request):
     context = {'datasets_json': connectome_datasets()}
 
     return render(request, "connectome/explore.html", context)
 
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def path(request):
     context = {'datasets_json': connectome_datasets()}
 
     return render(request, "connectome/path.html", context)
 
 
+def available_neurons_etag(request):
+    datasets_str = request.GET.get('datasets')
+    if not datasets_str:
+        return None
+    versions = get_dataset_versions(Dataset)
+
+    return make_etag(request, *(versions.get(dataset_id, "") for dataset_id in datasets_str.split(',')))
+
+
 @cache_control(public=True, max_age=60*60*24*90)
+@condition(etag_func=available_neurons_etag)
 def available_neurons(request):
     """
     Return a JSON response with available neurons and neuron classes for each dataset
@@ -63,7 +102,7 @@ def available_neurons(request):
 
     # For each dataset, try to get its available neurons from cache; if not, query and cache.
     for dataset_id in dataset_ids:
-        cache_key = f"available_neurons_{dataset_id}"
+        cache_key = dataset_key(Dataset, dataset_id, f"available_neurons_{dataset_id}")
         dataset_result = cache.get(cache_key)
         if dataset_result is None:
             # Prepare querysets with only needed fields.
@@ -157,11 +196,11 @@ def get_edge_response_data(data):
     key_mapping = {}  # key -> (dataset, type, neuron_or_class)
     for dataset in datasets:
         for n in neurons_input:
-            key = f"{dataset}!{n}"
+            key = dataset_key(Dataset, dataset, f"{dataset}!{n}")
             keys_needed.append(key)
             key_mapping[key] = (dataset, "neuron", n)
         for c in classes_input:
-            key = f"{dataset}!{c}"
+            key = dataset_key(Dataset, dataset, f"{dataset}!{c}")
             keys_needed.append(key)
             key_mapping[key] = (dataset, "class", c)
 
@@ -176,61 +215,74 @@ def get_edge_response_data(data):
         else:
             missing_keys.append(key)
 
-    # Group missing keys by (dataset, type) for bulk database queries.
-    missing_group = defaultdict(list)
-    for key in missing_keys:
-        dataset, typ, value = key_mapping[key]
-        missing_group[(dataset, typ)].append(value)
-
-    # For each group, fetch synapses in one query and then split results.
-    for (dataset, typ), values in missing_group.items():
-        if typ == "neuron":
-            qs = Synapse.objects.filter(
-                dataset__dataset_id=dataset,
-            ).filter(
-                Q(pre__name__in=values) | Q(post__name__in=values)
-            ).values_list(
-                'pre__name', 'pre__neuron_class__name',
-                'post__name', 'post__neuron_class__name',
-                'synapse_type', 'synapse_count'
-            )
-        else:  # typ == "class"
-            qs = Synapse.objects.filter(
-                dataset__dataset_id=dataset,
-            ).filter(
-                Q(pre__neuron_class__name__in=values) | Q(post__neuron_class__name__in=values)
-            ).values_list(
-                'pre__name', 'pre__neuron_class__name',
-                'post__name', 'post__neuron_class__name',
-                'synapse_type', 'synapse_count'
-            )
+    # Single flight: fill the missing keys not being filled by another request, wait for the others.
+    fill_tokens = {key: acquire_fill_lock(key) for key in missing_keys}
+    filled = wait_for_fill([key for key, token in fill_tokens.items() if token is None])
+    for key, syn_list in filled.items():
+        k_dataset, _, k_neuron_or_class = key_mapping[key]
+        all_synapses[k_dataset][k_neuron_or_class] = syn_list
+    missing_keys = [key for key in missing_keys if key not in filled]
 
-        # Prepare a dictionary to collect results per value.
-        result_mapping = {val: [] for val in values}
-        value_set = set(values)
-        for syn in qs:
-            pre_name, pre_class, post_name, post_class, syn_type, syn_count = syn
+    # the locks taken are released even if the queries fail, so other requests don't wait for the lease
+    try:
+        # Group missing keys by (dataset, type) for bulk database queries.
+        missing_group = defaultdict(list)
+        for key in missing_keys:
+            dataset, typ, value = key_mapping[key]
+            missing_group[(dataset, typ)].append(value)
+
+        # For each group, fetch synapses in one query and then split results.
+        for (dataset, typ), values in missing_group.items():
             if typ == "neuron":
-                matches = []
-                if pre_name in value_set:
-                    matches.append(pre_name)
-                if post_name in value_set and post_name not in matches:
-                    matches.append(post_name)
-            else:  # type "class"
-                matches = []
-                if pre_class in value_set:
-                    matches.append(pre_class)
-                if post_class in value_set and post_class not in matches:
-                    matches.append(post_class)
-
-            for match in matches:
-                result_mapping[match].append(syn)
-
-        # Cache each result and update all_synapses.
-        for val, syn_list in result_mapping.items():
-            key = f"{dataset}!{val}"
-            cache.set(key, syn_list, timeout=None)
-            all_synapses[dataset][val] = syn_list
+                qs = Synapse.objects.filter(
+                    dataset__dataset_id=dataset,
+                ).filter(
+                    Q(pre__name__in=values) | Q(post__name__in=values)
+                ).values_list(
+                    'pre__name', 'pre__neuron_class__name',
+                    'post__name', 'post__neuron_class__name',
+                    'synapse_type', 'synapse_count'
+                )
+            else:  # typ == "class"
+                qs = Synapse.objects.filter(
+                    dataset__dataset_id=dataset,
+                ).filter(
+                    Q(pre__neuron_class__name__in=values) | Q(post__neuron_class__name__in=values)
+                ).values_list(
+                    'pre__name', 'pre__neuron_class__name',
+                    'post__name', 'post__neuron_class__name',
+                    'synapse_type', 'synapse_count'
+                )
+
+            # Prepare a dictionary to collect results per value.
+            result_mapping = {val: [] for val in values}
+            value_set = set(values)
+            for syn in qs:
+                pre_name, pre_class, post_name, post_class, syn_type, syn_count = syn
+                if typ == "neuron":
+                    matches = []
+                    if pre_name in value_set:
+                        matches.append(pre_name)
+                    if post_name in value_set and post_name not in matches:
+                        matches.append(post_name)
+                else:  # type "class"
+                    matches = []
+                    if pre_class in value_set:
+                        matches.append(pre_class)
+                    if post_class in value_set and post_class not in matches:
+                        matches.append(post_class)
+
+                for match in matches:
+                    result_mapping[match].append(syn)
+
+            # Cache each result and update all_synapses.
+            for val, syn_list in result_mapping.items():
+                key = dataset_key(Dataset, dataset, f"{dataset}!{val}")
+                cache.set(key, syn_list, timeout=None)
+                all_synapses[dataset][val] = syn_list
+    finally:
+        for key, token in fill_tokens.items():
+            release_fill_lock(key, token)
 
     # Helper functions.
     def select_label(neuron, neuron_class):
@@ -329,41 +381,36 @@ def get_edges(request):
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'}, status=405)
 
 
-def find_paths(request):
+def find_dataset_paths(graph, start_neuron, end_neuron, weighted, k, max_hops, timeout=SEARCH_TIMEOUT):
     """
-    Find paths between two neurons within a dataset. 
-    Higher edge count means shorter path. Option to exclude electrical synapses.
-    Return paths with edge details.
+    Find the paths of find_paths in one graph, searching for at most timeout seconds from the call
+    (so the datasets queued in PATH_SEARCH_POOL get the same budget). Returns {'paths', 'nodes',
+    'truncated', 'timed_out'}, with 'message' if no path was found or 'error' if a neuron is not in
+    the graph. timed_out tells that the search stopped at the deadline (truncated may also be set by
+    MAX_PATHS, which is a complete result).
     """
-    if connectome.graph_data.GRAPH_OBJECTS is None:
-        # Handle the case where initialization failed
-        return JsonResponse({'error': 'Graph precompute data is not available'}, status=400)
-
-    dataset_graphs = connectome.graph_data.GRAPH_OBJECTS
-
-    # try:
-    # parse query parameters
-    dataset = request.GET.get('dataset')
-    start_neuron = request.GET.get('start')
-    end_neuron = request.GET.get('end')
-    weighted = request.GET.get('weighted', 'true').lower() == 'true'
-    gap_junction = request.GET.get('gap_junction', 'true').lower() == 'true'
-    use_class = request.GET.get('class', 'false').lower() == 'true'
-
-    # validate dataset
-    if dataset not in dataset_graphs:
-        return JsonResponse({'error': 'Invalid dataset'}, status=400)
-    
-    # get graph
-    graph = dataset_graphs[dataset]["class" if use_class else "neuron"]["all" if gap_junction else "chemical_only"]
-
-    # find all shortest paths
+    deadline = time.monotonic() + timeout
     try:
-        paths = list(nx.all_shortest_paths(graph, source=start_neuron, target=end_neuron, method="dijkstra", weight=(lambda u, v, data: 1 / data['weight']) if weighted else None))
-    except nx.NetworkXNoPath:
-        return JsonResponse({'paths': [], 'message': 'No path found'})
-    except nx.NodeNotFound:
-        return JsonResponse({'error': 'Start or end neuron not found in the dataset'}, status=400)
+        if k is None:
+            paths, truncated = graph.all_shortest_paths(
+                start_neuron, end_neuron, weighted=weighted, max_hops=max_hops, max_paths=MAX_PATHS,
+                deadline=deadline
+            )
+        else:
+            paths, truncated = graph.k_shortest_paths(
+                start_neuron, end_neuron, min(k, MAX_PATHS), weighted=weighted, max_hops=max_hops,
+                deadline=deadline
+            )
+            truncated = truncated or (k > MAX_PATHS and len(paths) == MAX_PATHS)
+    except NoPath:
+        return {'paths': [], 'message': 'No path found', 'truncated': False, 'timed_out': False}
+    except NodeNotFound:
+        return {'paths': [], 'error': 'Start or end neuron not found in the dataset', 'truncated': False,
+                'timed_out': False}
+    timed_out = truncated and time.monotonic() > deadline
+
+    if not paths:
+        return {'paths': [], 'message': 'No path found', 'truncated': truncated, 'timed_out': timed_out}
 
     # add edge information for each path
     node_set = set()
@@ -388,14 +435,185 @@ def find_paths(request):
             'total_weight': total_weight
         })
 
+    return {'paths': paths_with_details, 'nodes': list(node_set), 'truncated': truncated, 'timed_out': timed_out}
+
+
+def get_paths_cache_key(dataset_id, query):
+    """Cache key of the find_dataset_paths result of query (the normalized parameters) in a dataset."""
+    digest = sha256(json.dumps(query).encode("utf-8")).hexdigest()[:32]
+
+    return dataset_key(Dataset, dataset_id, f"{dataset_id}!paths!{digest}")
+
+
+def register_paths_cache_key(dataset_id, key):
+    """
+    Add key (see get_paths_cache_key) to the index of the path results of the current version of a
+    dataset: a counter (incremented atomically across workers) and one entry per result.
+    """
+    index_key = dataset_key(Dataset, dataset_id, f"{dataset_id}!paths_index")
+    cache.add(index_key, 0, timeout=None)
+    try:
+        n = cache.incr(index_key)
+    except ValueError:
+        # deleted by invalidate_cache in the meantime
+        return
+    cache.set(dataset_key(Dataset, dataset_id, f"{dataset_id}!paths_index!{n}"), key, timeout=PATHS_CACHE_TIMEOUT)
+
+
+def get_paths_cache_keys(dataset_id, version):
+    """Cache keys of the path results of a version of a dataset and of their index, see register_paths_cache_key."""
+    index_key = versioned_key(f"{dataset_id}!paths_index", version)
+    entry_keys = [
+        versioned_key(f"{dataset_id}!paths_index!{i}", version) for i in range(1, (cache.get(index_key) or 0) + 1)
+    ]
+
+    return [index_key, *entry_keys, *cache.get_many(entry_keys).values()]
+
+
+def get_find_paths_dataset_ids(request):
+    datasets_str = request.GET.get('datasets')
+    if datasets_str:
+        return list(dict.fromkeys(datasets_str.split(',')))
+
+    return [request.GET.get('dataset')]
+
+
+def find_paths_etag(request):
+    if connectome.graph_data.GRAPH_OBJECTS is None:
+        return None
+    versions = get_dataset_versions(Dataset)
+
+    return make_etag(request, *(versions.get(dataset_id, "") for dataset_id in get_find_paths_dataset_ids(request)))
+
+
+def find_paths(request):
+    """
+    find_paths_response with ETags. The complete results (and their 304s) are cacheable by browsers
+    and CDNs for PATHS_MAX_AGE as the graphs only change when the datasets are rebuilt. The errors
+    and the results cut short by the search deadline get neither an ETag nor Cache-Control.
+    """
+    response = find_paths_response(request)
+    if response.status_code == 304 or (response.status_code == 200 and not getattr(response, "timed_out", False)):
+        patch_cache_control(response, public=True, max_age=PATHS_MAX_AGE)
+    elif "ETag" in response:
+        del response["ETag"]
+
+    return response
+
+
+@condition(etag_func=find_paths_etag)
+def find_paths_response(request):
+    """
+    Find paths between two neurons within a dataset, or within each of the datasets of
+    datasets=id1,id2,... (searched concurrently, with the nodes of all datasets merged).
+    Higher edge count means shorter path. Option to exclude electrical synapses.
+    Return all shortest paths, or the k shortest paths if k is given, with at most max_hops edges
+    and with edge details. The number of paths and the search time are capped (truncated flag).
+    The results are cached per dataset, except the ones cut short by the search deadline (the
+    response is then flagged with a timed_out attribute, see find_paths).
+    """
+    if connectome.graph_data.GRAPH_OBJECTS is None:
+        # Handle the case where initialization failed
+        return JsonResponse({'error': 'Graph precompute data is not available'}, status=400)
+
+    dataset_graphs = connectome.graph_data.GRAPH_OBJECTS
+
+    # try:
+    # parse query parameters
+    dataset = request.GET.get('dataset')
+    datasets_str = request.GET.get('datasets')
+    start_neuron = request.GET.get('start')
+    end_neuron = request.GET.get('end')
+    weighted = request.GET.get('weighted', 'true').lower() == 'true'
+    gap_junction = request.GET.get('gap_junction', 'true').lower() == 'true'
+    use_class = request.GET.get('class', 'false').lower() == 'true'
+    try:
+        k = int(request.GET['k']) if request.GET.get('k') else None
+        max_hops = int(request.GET['max_hops']) if request.GET.get('max_hops') else None
+    except ValueError:
+        return JsonResponse({'error': 'k and max_hops must be integers'}, status=400)
+    if (k is not None and k < 1) or (max_hops is not None and max_hops < 1):
+        return JsonResponse({'error': 'k and max_hops must be positive'}, status=400)
+
+    # validate dataset
+    dataset_ids = get_find_paths_dataset_ids(request)
+    if any(dataset_id not in dataset_graphs for dataset_id in dataset_ids):
+        return JsonResponse({'error': 'Invalid dataset'}, status=400)
+
+    # get graph
+    graphs = {
+        dataset_id: dataset_graphs[dataset_id]["class" if use_class else "neuron"]["all" if gap_junction else "chemical_only"]
+        for dataset_id in dataset_ids
+    }
+
+    # find all shortest paths, or the k shortest paths (cached per dataset)
+    query = [start_neuron, end_neuron, weighted, gap_junction, use_class, k, max_hops]
+    cache_keys = {dataset_id: get_paths_cache_key(dataset_id, query) for dataset_id in dataset_ids}
+
+    def find_in_dataset(dataset_id):
+        """Return (result, timed_out)."""
+        searched = {}
+
+        def build():
+            result = find_dataset_paths(graphs[dataset_id], start_neuron, end_neuron, weighted, k, max_hops)
+            if result.pop('timed_out'):
+                searched['result'] = result
+                return None
+            register_paths_cache_key(dataset_id, cache_keys[dataset_id])
+            return result
+
+        result = get_or_fill(cache_keys[dataset_id], build, timeout=PATHS_CACHE_TIMEOUT)
+        if result is None:
+            return searched['result'], True
+        return result, False
+
+    if not datasets_str:
+        result, timed_out = find_in_dataset(dataset)
+        if 'error' in result:
+            return JsonResponse({'error': result['error']}, status=400)
+        if not result['paths']:
+            response = JsonResponse(result)
+            response.timed_out = timed_out
+            return response
+
+        # Format response
+        response = {
+            'dataset_id': dataset,
+            'start_neuron': start_neuron,
+            'end_neuron': end_neuron,
+            'use_weights': weighted,
+            'use_gap_junction': gap_junction,
+            'k': k,
+            'max_hops': max_hops,
+            'truncated': result['truncated'],
+            'nodes': result['nodes'],
+            'paths': result['paths']
+        }
+        response = JsonResponse(response)
+        response.timed_out = timed_out
+        return response
+
+    results = {}
+    timed_out = False
+    node_set = set()
+    for dataset_id, (result, dataset_timed_out) in zip(dataset_ids, PATH_SEARCH_POOL.map(find_in_dataset, dataset_ids)):
+        timed_out = timed_out or dataset_timed_out
+        node_set.update(result.get('nodes', []))
+        results[dataset_id] = {key: value for key, value in result.items() if key != 'nodes'}
+
     # Format response
     response = {
-        'dataset_id': dataset,
+        'datasets': dataset_ids,
         'start_neuron': start_neuron,
         'end_neuron': end_neuron,
         'use_weights': weighted,
         'use_gap_junction': gap_junction,
+        'k': k,
+        'max_hops': max_hops,
+        'truncated': any(result['truncated'] for result in results.values()),
         'nodes': list(node_set),
-        'paths': paths_with_details
+        'results': results
     }
-    return JsonResponse(response)
+    response = JsonResponse(response)
+    response.timed_out = timed_out
+    return response
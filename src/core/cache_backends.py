@@ -0,0 +1,493 @@
+"""
+Cache backends.
+
+LocalLRUCache is an in-memory cache bounded by bytes, and SQLiteCache a cache file shared by the
+workers of a host, for the deployments without Redis. TwoTierCache keeps a bounded per-process copy
+of the values of selected key prefixes in front of the shared cache (Redis), for the small and
+effectively immutable values read on nearly every page render (e.g. the connectome dataset list).
+A hit costs no network round trip and no unpickling.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+_MISSING = object()
+
+
+class LRUStore:
+    """
+    Thread-safe LRU mapping bounded by the total size (bytes) of its values, with an expiry time
+    (time.time()) per entry. The caller provides the size of each value.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        self._data = OrderedDict()  # key -> (expire_at or None, size, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, value, size, expire_at=None):
+        """Store value until expire_at (None: no expiry). Values larger than max_bytes are not stored."""
+        with self.lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return False
+            self._data[key] = (expire_at, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+            return True
+
+    def get_expiry(self, key):
+        with self.lock:
+            entry = self._data.get(key)
+            return None if entry is None else entry[0]
+
+    def touch(self, key, expire_at=None):
+        with self.lock:
+            if self.get(key, _MISSING) is _MISSING:
+                return False
+            _, size, value = self._data[key]
+            self._data[key] = (expire_at, size, value)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self._data), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions
+            }
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        return True
+
+
+# stores shared by the instances (one per thread) of a cache, by name
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(name, max_bytes):
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = LRUStore(max_bytes)
+        return _stores[name]
+
+
+class LocalLRUCache(BaseCache):
+    """
+    In-memory cache of the process bounded by the total size of the (pickled) values instead of the
+    number of entries, with LRU eviction. Replaces LocMemCache, whose default MAX_ENTRIES (300) and
+    culling of a third of the entries can't hold the cache_activity warm-up.
+
+    LOCATION names the store (shared by the threads of the process). OPTIONS:
+    - MAX_BYTES: byte budget, default 256 MB
+    """
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, name, params):
+        options = dict(params.get("OPTIONS", {}))
+        max_bytes = int(options.pop("MAX_BYTES", 256 * 1024 * 1024))
+        super().__init__(dict(params, OPTIONS=options))
+        self._store = get_store(f"local:{name}", max_bytes)
+
+    def get_stats(self):
+        """{"entries", "bytes", "max_bytes", "hits", "misses", "evictions"} of the store."""
+        return self._store.get_stats()
+
+    def _set(self, key, value, timeout):
+        expire_at = self.get_backend_timeout(timeout)
+        if expire_at is not None and expire_at <= time.time():
+            self._store.delete(key)
+            return
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        self._store.set(key, pickled, len(pickled), expire_at)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        pickled = self._store.get(key)
+        if pickled is None:
+            return default
+        return pickle.loads(pickled)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._set(key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._store.lock:
+            if self._store.get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._store.touch(key, self.get_backend_timeout(timeout))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._store.lock:
+            pickled = self._store.get(key)
+            if pickled is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = pickle.loads(pickled) + delta
+            pickled = pickle.dumps(new_value, self.pickle_protocol)
+            self._store.set(key, pickled, len(pickled), self._store.get_expiry(key))
+        return new_value
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._store.get(key) is not None
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._store.delete(key)
+
+    def clear(self):
+        self._store.clear()
+
+
+class TwoTierCache(BaseCache):
+    """
+    Per-process LRU (byte budget, short TTL, shared by the threads) in front of another cache, for the
+    keys starting with one of the configured prefixes. All other keys go to the shared cache only.
+
+    LOCATION is the alias of the shared cache in CACHES. OPTIONS:
+    - LOCAL_PREFIXES: {key prefix: TTL (s) of the local copy}
+    - LOCAL_MAX_BYTES: byte budget of the local copies (pickled size), default 16 MB
+
+    The local copies are shared by the threads of the process and must not be mutated by the caller.
+    An entry deleted from the shared cache by another process may be served locally until its TTL.
+    """
+    def __init__(self, location, params):
+        options = dict(params.get("OPTIONS", {}))
+        self._prefixes = sorted(options.pop("LOCAL_PREFIXES", {}).items(), key=lambda item: -len(item[0]))
+        max_bytes = int(options.pop("LOCAL_MAX_BYTES", 16 * 1024 * 1024))
+        super().__init__(dict(params, OPTIONS=options))
+        self._location = location
+        self._local = get_store(f"two-tier:{location}", max_bytes)
+
+    @property
+    def remote(self):
+        return caches[self._location]
+
+    def get_stats(self):
+        """Stats of the local copies, see LRUStore.get_stats."""
+        return self._local.get_stats()
+
+    def get_local_ttl(self, key):
+        """TTL of the local copy of key, or None if the key is not kept locally."""
+        for prefix, ttl in self._prefixes:
+            if key.startswith(prefix):
+                return ttl
+        return None
+
+    def _set_local(self, key, value, version):
+        ttl = self.get_local_ttl(key)
+        if ttl is not None:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            self._local.set(self.make_key(key, version), value, size, time.time() + ttl)
+
+    def get(self, key, default=None, version=None):
+        if self.get_local_ttl(key) is None:
+            return self.remote.get(key, default, version=version)
+
+        value = self._local.get(self.make_key(key, version), _MISSING)
+        if value is _MISSING:
+            value = self.remote.get(key, _MISSING, version=version)
+            if value is _MISSING:
+                return default
+            self._set_local(key, value, version)
+
+        return value
+
+    def get_many(self, keys, version=None):
+        result = {}
+        keys_remote = []
+        for key in keys:
+            value = _MISSING
+            if self.get_local_ttl(key) is not None:
+                value = self._local.get(self.make_key(key, version), _MISSING)
+            if value is _MISSING:
+                keys_remote.append(key)
+            else:
+                result[key] = value
+
+        if keys_remote:
+            result_remote = self.remote.get_many(keys_remote, version=version)
+            for key, value in result_remote.items():
+                self._set_local(key, value, version)
+            result.update(result_remote)
+
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.remote.set(key, value, timeout, version=version)
+        self._set_local(key, value, version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.remote.add(key, value, timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.remote.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._set_local(key, value, version)
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.remote.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        self._local.delete(self.make_key(key, version))
+        return self.remote.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._local.delete(self.make_key(key, version))
+        self.remote.delete_many(keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self.remote.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self._local.delete(self.make_key(key, version))
+        return self.remote.incr(key, delta, version=version)
+
+    def clear(self):
+        self._local.clear()
+        return self.remote.clear()
+
+    def close(self, **kwargs):
+        self.remote.close(**kwargs)
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache in a SQLite file (WAL mode) shared by all workers (processes) of a host, for the deployments
+    without Redis. It can be warmed once per host (e.g. init_cache_data.sh at build time), so the
+    workers start hot and don't each keep a copy of the traces and edge lists.
+
+    LOCATION is the path of the file. OPTIONS:
+    - MAX_BYTES: byte budget of the (pickled) values, the oldest entries are culled above it.
+      default None (no limit)
+    """
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+    # check the budget every CULL_EVERY writes
+    CULL_EVERY = 100
+    # max. number of keys per query
+    CHUNK_SIZE = 500
+
+    def __init__(self, path, params):
+        options = dict(params.get("OPTIONS", {}))
+        max_bytes = options.pop("MAX_BYTES", None)
+        super().__init__(dict(params, OPTIONS=options))
+        self._path = path
+        self._max_bytes = None if max_bytes is None else int(max_bytes)
+        self._connection = None
+        self._pid = None
+        self._n_write = 0
+
+    @property
+    def connection(self):
+        # one connection per instance (thread), reopened in a forked worker
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, expires REAL, created REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+            self._connection = connection
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def _write(self, rows):
+        """rows: [(key, value, timeout)]. Must be called in a transaction."""
+        now = time.time()
+        list_insert = []
+        list_delete = []
+        for key, value, timeout in rows:
+            expires = self.get_backend_timeout(timeout)
+            if expires is not None and expires <= now:
+                list_delete.append((key,))
+                continue
+            pickled = pickle.dumps(value, self.pickle_protocol)
+            list_insert.append((key, pickled, len(pickled), expires, now))
+
+        self.connection.executemany("DELETE FROM cache WHERE key = ?", list_delete)
+        self.connection.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", list_insert)
+        self._n_write += len(list_insert)
+
+    def _get_many(self, keys):
+        now = time.time()
+        result = {}
+        keys = list(keys)
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i + self.CHUNK_SIZE]
+            rows = self.connection.execute(
+                f"SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(chunk))}) "
+                "AND (expires IS NULL OR expires > ?)", (*chunk, now)
+            )
+            result.update(rows)
+
+        return result
+
+    def _cull(self):
+        self._n_write = 0
+        if self._max_bytes is None:
+            return
+        connection = self.connection
+        connection.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        # free down to 90% of the budget, oldest first
+        excess = total - int(self._max_bytes * 0.9)
+        list_key = []
+        for key, size in connection.execute("SELECT key, size FROM cache ORDER BY created"):
+            list_key.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM cache WHERE key = ?", list_key)
+
+    def _commit_write(self, rows):
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._write(rows)
+            if self._n_write >= self.CULL_EVERY:
+                self._cull()
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        pickled = self._get_many([key]).get(key)
+        if pickled is None:
+            return default
+        return pickle.loads(pickled)
+
+    def get_many(self, keys, version=None):
+        key_map = {self.make_and_validate_key(key, version=version): key for key in keys}
+
+        return {key_map[key]: pickle.loads(pickled) for key, pickled in self._get_many(key_map).items()}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._commit_write([(key, value, timeout)])
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        rows = [(self.make_and_validate_key(key, version=version), value, timeout) for key, value in data.items()]
+        if rows:
+            self._commit_write(rows)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            added = key not in self._get_many([key])
+            if added:
+                self._write([(key, value, timeout)])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return added
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+            ).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = pickle.loads(row[0]) + delta
+            pickled = pickle.dumps(new_value, self.pickle_protocol)
+            connection.execute("UPDATE cache SET value = ?, size = ? WHERE key = ?", (pickled, len(pickled), key))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return new_value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self.connection.execute(
+            "UPDATE cache SET expires = ? WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (self.get_backend_timeout(timeout), key, time.time())
+        )
+        return cursor.rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return key in self._get_many([key])
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self.connection.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount > 0
+
+    def delete_many(self, keys, version=None):
+        rows = [(self.make_and_validate_key(key, version=version),) for key in keys]
+        self.connection.executemany("DELETE FROM cache WHERE key = ?", rows)
+
+    def clear(self):
+        self.connection.execute("DELETE FROM cache")
+
+    def get_stats(self):
+        """{"entries", "bytes", "max_bytes"} of the cache file."""
+        entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return {"entries": entries, "bytes": size, "max_bytes": self._max_bytes}
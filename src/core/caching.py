@@ -0,0 +1,432 @@
+"""
+Cache of encoded JSON response bodies and ETags of the data endpoints.
+
+The data endpoints cache the final bytes of their response instead of the Python objects, so a
+cache hit costs one cache fetch and no pickling/JSON encoding. orjson is used for the encoding when
+it is installed, otherwise json with DjangoJSONEncoder. The gzip and brotli (if installed) encoded
+variants of the bodies are cached the same way, so each body is compressed once (at warm-up or on the
+first request that accepts the encoding) and served as per the Accept-Encoding of the request.
+
+The datasets are immutable once imported and carry a dataset_sha256 of their source file. The cache
+keys of the data of a dataset include a version derived from it (and the keys of data built from all
+datasets a version of the whole catalog), so a data refresh only changes the keys of the changed
+datasets (see the invalidate_cache command), and the ETag of a data response is derived from the
+same versions plus the request (endpoint, query and Accept header), without building the response.
+
+The pages are cached with a soft expiry (cache_page_swr): once it passes, the stale page is still
+served while a background thread of the worker renders it again.
+"""
+
+import gzip
+import io
+import json
+import logging
+import threading
+import time
+import uuid
+from functools import wraps
+from hashlib import sha256
+from urllib.parse import urlencode
+from django.apps import apps
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers, patch_response_headers
+from django.views.decorators.http import condition
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+JSON_CONTENT_TYPE = "application/json"
+JSON_BYTES_PREFIX = "json!"
+
+# content codings in order of preference; moderate levels, the encodings are built on the first request
+# (and by cache_activity for every dataset), the maximum levels cost several times the time for a few % less
+COMPRESSORS = {"gzip": lambda content: gzip.compress(content, compresslevel=6, mtime=0)}
+if brotli is not None:
+    COMPRESSORS = {"br": lambda content: brotli.compress(content, quality=5), **COMPRESSORS}
+CONTENT_ENCODINGS = list(COMPRESSORS)
+# all content codings that may be cached (e.g. by a worker with brotli installed)
+CACHED_ENCODINGS = ["br", "gzip"]
+
+# models of the datasets the catalog version is derived from
+CATALOG_MODELS = ["activity.GCaMPDataset", "connectome.Dataset"]
+
+
+def dumps_json(data):
+    """Encode data (dicts may have int keys, values may be numpy types) as compact JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":")).encode("utf-8")
+
+
+"""
+Single flight
+"""
+# lifetime (s) of the lock of a filling caller, after which another caller may fill the key
+FILL_LEASE = 30
+# max. time (s) to wait for the value filled by another caller before building it anyway
+FILL_WAIT = 10
+FILL_POLL_INTERVAL = 0.05
+
+
+def acquire_fill_lock(key, lease=FILL_LEASE):
+    """Take the lock to fill key (shared by all workers). Returns the lock token, or None if held by another caller."""
+    token = uuid.uuid4().hex
+    return token if cache.add(f"{key}!fill", token, timeout=lease) else None
+
+
+def release_fill_lock(key, token):
+    if token is not None and cache.get(f"{key}!fill") == token:
+        cache.delete(f"{key}!fill")
+
+
+def wait_for_fill(keys, wait=FILL_WAIT):
+    """Wait (up to wait seconds) for keys filled by other callers. Returns {key: value} of the filled ones."""
+    result = {}
+    keys = list(keys)
+    deadline = time.monotonic() + wait
+    while keys and time.monotonic() < deadline:
+        time.sleep(FILL_POLL_INTERVAL)
+        result.update(cache.get_many(keys))
+        keys = [key for key in keys if key not in result]
+
+    return result
+
+
+def get_or_fill(key, build, timeout=None, lease=FILL_LEASE, wait=FILL_WAIT):
+    """
+    Return the value cached under key, or build() and cache it. Only one caller at a time (across
+    threads and workers) builds a missing key: the others wait for the filled value, and build it
+    themselves only if it isn't filled within wait.
+    build() may return None for a value that must not be cached, which is then returned as None.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    token = acquire_fill_lock(key, lease)
+    if token is None:
+        value = wait_for_fill([key], wait).get(key)
+        if value is not None:
+            return value
+
+    try:
+        value = build()
+        if value is not None:
+            cache.set(key, value, timeout=timeout)
+    finally:
+        release_fill_lock(key, token)
+
+    return value
+
+
+def get_json_bytes(key, build, timeout=None, encoding=None):
+    """
+    Return the encoded JSON cached under key. On a miss, build() returns the data to encode
+    (or a str/bytes that is already JSON, which is stored as is).
+    With encoding (one of CONTENT_ENCODINGS), return the body compressed with that content coding.
+    """
+    if encoding is not None:
+        return get_or_fill(f"{JSON_BYTES_PREFIX}{encoding}!{key}",
+                           lambda: COMPRESSORS[encoding](get_json_bytes(key, build, timeout)), timeout)
+
+    return get_or_fill(JSON_BYTES_PREFIX + key, lambda: encode_json(build()), timeout)
+
+
+def encode_json(data):
+    """JSON body of data, or data itself if it is a str/bytes that is already JSON."""
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    if isinstance(data, bytes):
+        return data
+    return dumps_json(data)
+
+
+def get_json_bytes_items(key, data, encodings=CONTENT_ENCODINGS):
+    """
+    {cache key: body} of the JSON body of data under key and its compressed variants, i.e. what
+    get_json_bytes caches, to fill many keys at once with cache.set_many.
+    """
+    content = encode_json(data)
+    items = {JSON_BYTES_PREFIX + key: content}
+    for encoding in encodings:
+        items[f"{JSON_BYTES_PREFIX}{encoding}!{key}"] = COMPRESSORS[encoding](content)
+
+    return items
+
+
+def get_content_encoding(request):
+    """The preferred content coding of CONTENT_ENCODINGS accepted by the request, or None (identity)."""
+    accepted = {}
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding.strip():
+            accepted[coding.strip().lower()] = q
+
+    for encoding in CONTENT_ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+def get_json_bytes_keys(key):
+    """All cache keys get_json_bytes may store under key (identity and compressed variants)."""
+    return [JSON_BYTES_PREFIX + key] + [f"{JSON_BYTES_PREFIX}{encoding}!{key}" for encoding in CACHED_ENCODINGS]
+
+
+class JSONBytesResponse(HttpResponse):
+    """
+    Response with an already encoded JSON body (see get_json_bytes), compressed with encoding
+    (see get_content_encoding) if given.
+    """
+    def __init__(self, content, encoding=None, **kwargs):
+        kwargs.setdefault("content_type", JSON_CONTENT_TYPE)
+        super().__init__(content=content, **kwargs)
+        if encoding is not None:
+            self.headers["Content-Encoding"] = encoding
+        patch_vary_headers(self, ("Accept-Encoding",))
+
+
+"""
+Versioned cache keys
+"""
+_DATASET_VERSIONS = {}  # model label -> {dataset_id: version}, and CATALOG_VERSION_KEY -> catalog version
+CATALOG_VERSION_KEY = "catalog"
+
+
+def get_dataset_versions(model):
+    """
+    Return {dataset_id: version} of all datasets of model (GCaMPDataset or connectome Dataset), where
+    the version is a prefix of the dataset_sha256. Read from the database once per process (the
+    database of a deployment is read-only), so workers of a new deployment use the new versions.
+    """
+    label = model._meta.label_lower
+    versions = _DATASET_VERSIONS.get(label)
+    if versions is None:
+        versions = {
+            dataset_id: dataset_sha256[:16]
+            for dataset_id, dataset_sha256 in model.objects.values_list("dataset_id", "dataset_sha256")
+        }
+        _DATASET_VERSIONS[label] = versions
+
+    return versions
+
+
+def reset_dataset_versions():
+    """Forget the versions read by get_dataset_versions and get_catalog_version (e.g. after the database is updated)."""
+    _DATASET_VERSIONS.clear()
+
+
+def get_catalog_version():
+    """
+    Version of the whole catalog (CATALOG_MODELS): changes if any dataset is added, removed or changed.
+    Computed once per process, like the dataset versions.
+    """
+    version = _DATASET_VERSIONS.get(CATALOG_VERSION_KEY)
+    if version is None:
+        catalog = [sorted(get_dataset_versions(apps.get_model(label)).items()) for label in CATALOG_MODELS]
+        version = sha256(json.dumps(catalog).encode("utf-8")).hexdigest()[:16]
+        _DATASET_VERSIONS[CATALOG_VERSION_KEY] = version
+
+    return version
+
+
+def versioned_key(key, version):
+    return f"{key}@{version}"
+
+
+def dataset_key(model, dataset_id, key):
+    """Cache key of data of the dataset dataset_id (of model), e.g. dataset_key(GCaMPDataset, "x", "x_behavior")."""
+    return versioned_key(key, get_dataset_versions(model).get(dataset_id, ""))
+
+
+def catalog_key(key):
+    """Cache key of data built from all datasets, e.g. the dataset list."""
+    return versioned_key(key, get_catalog_version())
+
+
+"""
+ETags
+"""
+# bump when the content of the data responses changes for the same datasets (e.g. new fields)
+ETAG_VERSION = "1"
+
+
+def make_etag(request, *versions):
+    """
+    Strong ETag of a response built from data with the given versions (see get_dataset_versions), for the
+    endpoint, query parameters (in any order), Accept header (JSON vs binary) and content coding of request.
+    """
+    query = urlencode(sorted((key, value) for key, values in request.GET.lists() for value in values))
+    parts = [ETAG_VERSION, request.path, query, request.headers.get("Accept", ""),
+             get_content_encoding(request) or "identity", *versions]
+
+    return sha256("\n".join(parts).encode("utf-8")).hexdigest()[:32]
+
+
+def dataset_etag(model):
+    """
+    Conditional GET (ETag / If-None-Match -> 304) for a view of a single dataset given by its
+    dataset_id URL parameter. Unknown datasets get no ETag (the view returns 404).
+    """
+    def etag_func(request, dataset_id, *args, **kwargs):
+        version = get_dataset_versions(model).get(dataset_id)
+        return make_etag(request, version) if version else None
+
+    return condition(etag_func=etag_func)
+
+
+def catalog_etag():
+    """Conditional GET for a view built from all datasets (e.g. the dataset list)."""
+    def etag_func(request, *args, **kwargs):
+        return make_etag(request, get_catalog_version())
+
+    return condition(etag_func=etag_func)
+
+
+"""
+Stale-while-revalidate
+"""
+# how long (s) an expired page is still served while rendered again, after which its entry is deleted
+SWR_STALE_TIMEOUT = 60*60*24*7
+# max-age of a stale page, the page rendered again in the background is served soon after
+SWR_STALE_MAX_AGE = 60
+# the WSGI environ of the request a page is rendered again from in the background
+SWR_REFRESH_ENVIRON_KEYS = [
+    "SCRIPT_NAME", "PATH_INFO", "QUERY_STRING", "SERVER_NAME", "SERVER_PORT", "HTTP_HOST",
+    "HTTP_X_FORWARDED_HOST", "HTTP_X_FORWARDED_PROTO", "HTTPS", "HTTP_ACCEPT", "wsgi.url_scheme",
+]
+
+def refresh_in_background(key, build, soft_timeout, timeout, token):
+    def refresh():
+        try:
+            value = build()
+            if value is not None:
+                cache.set(key, (value, time.time() + soft_timeout), timeout=timeout)
+        except Exception:
+            logger.exception("Refreshing the cache key %s failed", key)
+        finally:
+            release_fill_lock(key, token)
+            connections.close_all()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_or_refresh(key, build, soft_timeout, timeout=None, refresh=None):
+    """
+    Return (value, stale): the value cached under key, or build() and cache it (single flight, see
+    get_or_fill). The value is fresh for soft_timeout seconds. After that it is still returned (until
+    timeout, None: no expiry) as stale while one background thread (across workers) builds it again
+    with refresh() (default build), which must not use objects of the current request.
+    build() may return None for a value that must not be cached, which is then not returned either.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        value, soft_expire = entry
+        stale = soft_expire <= time.time()
+        if stale:
+            token = acquire_fill_lock(key)
+            if token is not None:
+                refresh_in_background(key, refresh or build, soft_timeout, timeout, token)
+        return value, stale
+
+    token = acquire_fill_lock(key)
+    if token is None:
+        entry = wait_for_fill([key]).get(key)
+        if entry is not None:
+            return entry[0], False
+
+    try:
+        value = build()
+        if value is not None:
+            cache.set(key, (value, time.time() + soft_timeout), timeout=timeout)
+    finally:
+        release_fill_lock(key, token)
+
+    return value, False
+
+
+def is_response_cacheable(response):
+    # like cache_page, don't share the responses that are user-specific (cookies)
+    return (
+        response.status_code == 200 and not response.streaming and not response.cookies
+        and "cookie" not in response.get("Vary", "").lower()
+    )
+
+
+def get_refresh_request(request):
+    """
+    Return a GET request for the same URL (and resolver match) as request, with none of its other
+    state (body, cookies, session, middleware attributes), to render a shared page again in another thread.
+    """
+    environ = {key: request.META[key] for key in SWR_REFRESH_ENVIRON_KEYS if key in request.META}
+    environ.update({"REQUEST_METHOD": "GET", "wsgi.input": io.BytesIO()})
+    refresh_request = WSGIRequest(environ)
+    refresh_request.resolver_match = request.resolver_match
+
+    return refresh_request
+
+
+def cache_page_swr(timeout, stale_timeout=SWR_STALE_TIMEOUT):
+    """
+    Drop-in for cache_page(timeout) with stale-while-revalidate: the page is fresh for timeout seconds,
+    then served stale (for stale_timeout more seconds, with a max-age of SWR_STALE_MAX_AGE) while it is
+    rendered again in the background from a copy of the request (see get_refresh_request).
+    The key includes the catalog version, so a data refresh renders the pages again, and the entries
+    of the old versions (and of the query strings not requested again) expire after timeout + stale_timeout.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(request, *args, **kwargs)
+
+            key = catalog_key("swr_page!" + sha256(request.build_absolute_uri().encode("utf-8")).hexdigest())
+            rendered = {}
+            # copied here, the background thread doesn't read the request
+            refresh_request = get_refresh_request(request)
+
+            def get_page(response):
+                if not is_response_cacheable(response):
+                    return None
+                return {"content": response.content, "content_type": response["Content-Type"]}
+
+            def build():
+                rendered["response"] = view(request, *args, **kwargs)
+                return get_page(rendered["response"])
+
+            def refresh():
+                return get_page(view(refresh_request, *args, **kwargs))
+
+            page, stale = get_or_refresh(key, build, timeout, timeout + stale_timeout, refresh=refresh)
+            if page is None:
+                return rendered["response"]
+            response = HttpResponse(page["content"], content_type=page["content_type"])
+            patch_response_headers(response, SWR_STALE_MAX_AGE if stale else timeout)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,105 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from activity.models import GCaMPDataset
+from activity.views import CATALOG_CACHE_KEYS as ACTIVITY_CATALOG_CACHE_KEYS
+from activity.views import get_dataset_cache_keys as get_activity_dataset_cache_keys
+from connectome.models import Dataset
+from connectome.views import CATALOG_CACHE_KEYS as CONNECTOME_CATALOG_CACHE_KEYS
+from connectome.views import get_dataset_cache_keys as get_connectome_dataset_cache_keys
+from connectome.views import get_paths_cache_keys
+from core.caching import (
+    get_dataset_versions, get_catalog_version, reset_dataset_versions, versioned_key, get_json_bytes_keys
+)
+
+# versions of the datasets whose entries may be in the cache, written by the last run
+MANIFEST_KEY = "cache_manifest"
+
+
+def get_manifest():
+    """{"catalog": version, "activity": {dataset_id: [version, n_neuron]}, "connectome": {dataset_id: [version]}}"""
+    reset_dataset_versions()
+    versions_activity = get_dataset_versions(GCaMPDataset)
+    versions_connectome = get_dataset_versions(Dataset)
+    n_neuron = dict(GCaMPDataset.objects.values_list("dataset_id", "n_neuron"))
+
+    return {
+        "catalog": get_catalog_version(),
+        "activity": {dataset_id: [version, n_neuron[dataset_id]] for dataset_id, version in versions_activity.items()},
+        "connectome": {dataset_id: [version] for dataset_id, version in versions_connectome.items()},
+    }
+
+
+def get_entry_keys(keys, version):
+    """
+    Cache keys of the entries of keys (without version) at version, including the JSON bytes.
+    With version None, the unversioned keys written before the keys were versioned.
+    """
+    list_key = []
+    for key in keys:
+        if version is not None:
+            key = versioned_key(key, version)
+        list_key.append(key)
+        list_key.extend(get_json_bytes_keys(key))
+
+    return list_key
+
+
+class Command(BaseCommand):
+    help = ('Delete the cache entries of the datasets changed or removed since the last run (their keys '
+            'are versioned, so the workers already use the new entries) and of the given datasets')
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dataset", nargs="+", default=[],
+                            help="dataset_id(s) to invalidate even if unchanged (e.g. after a code change)")
+        parser.add_argument("--catalog", action="store_true",
+                            help="invalidate the data built from all datasets (e.g. after updating the JSONCache)")
+        parser.add_argument("--all", action="store_true", help="invalidate all datasets and the catalog")
+        parser.add_argument("--dry-run", action="store_true", help="only report what would be invalidated")
+
+    def handle(self, *args, **options):
+        manifest_old = cache.get(MANIFEST_KEY)
+        manifest = get_manifest()
+        forced = set(options["dataset"])
+
+        list_key = []
+        list_invalidated = []
+        if manifest_old is None:
+            # first run: the versioned entries written so far are of the current versions, but the
+            # unversioned entries of the current datasets written before the keys were versioned never
+            # expire. (The pages cached by cache_page before cache_page_swr are no longer read and
+            # expire with their timeout.)
+            list_key.extend(get_entry_keys(
+                [key for dataset_id, (_, n_neuron) in manifest["activity"].items()
+                 for key in get_activity_dataset_cache_keys(dataset_id, n_neuron)]
+                + [key for dataset_id in manifest["connectome"] for key in get_connectome_dataset_cache_keys(dataset_id)]
+                + ACTIVITY_CATALOG_CACHE_KEYS + CONNECTOME_CATALOG_CACHE_KEYS,
+                None
+            ))
+            list_invalidated.append("unversioned keys")
+            manifest_old = manifest
+
+        for app, get_keys, get_versioned_keys in (
+            ("activity", get_activity_dataset_cache_keys, None),
+            ("connectome", get_connectome_dataset_cache_keys, get_paths_cache_keys),
+        ):
+            for dataset_id, (version, *info) in manifest_old.get(app, {}).items():
+                current = manifest[app].get(dataset_id)
+                if options["all"] or dataset_id in forced or current is None or current[0] != version:
+                    list_key.extend(get_entry_keys(get_keys(dataset_id, *info), version))
+                    if get_versioned_keys is not None:
+                        list_key.extend(get_versioned_keys(dataset_id, version))
+                    list_invalidated.append(dataset_id)
+
+        if options["all"] or options["catalog"] or manifest_old["catalog"] != manifest["catalog"]:
+            list_key.extend(get_entry_keys(ACTIVITY_CATALOG_CACHE_KEYS + CONNECTOME_CATALOG_CACHE_KEYS,
+                                           manifest_old["catalog"]))
+            list_invalidated.append("catalog")
+
+        if options["dry_run"]:
+            self.stdout.write(f"Would invalidate {len(list_key)} cache keys of: {', '.join(list_invalidated) or '-'}")
+            return
+
+        cache.delete_many(list_key)
+        cache.set(MANIFEST_KEY, manifest, timeout=None)
+        self.stdout.write(self.style.SUCCESS(
+            f"Invalidated {len(list_key)} cache keys of: {', '.join(list_invalidated) or '-'}"))
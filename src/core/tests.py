@@ -1,3 +1,502 @@
-from django.test import TestCase
+import io
+import json
+import os
+import pickle
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache
+from django.forms.models import model_to_dict
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from activity.management.commands.init_data_gcamp import Command, import_all_gcamp
+from activity.models import GCaMPDataset, GCaMPDatasetType, GCaMPPaper
+from connectome.models import Dataset, NeuronClass
+from core.cache_backends import LRUStore, LocalLRUCache, SQLiteCache, TwoTierCache
+from core.caching import (
+    SWR_STALE_MAX_AGE, cache_page_swr, get_catalog_version, reset_dataset_versions, dataset_key, catalog_key,
+    make_etag, dataset_etag, catalog_etag
+)
+from core.utility import JSONStreamReader, iter_json_array, sha256
+
+
+@mock.patch("core.caching.get_catalog_version", return_value="v")
+class CachePageSWRTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.requests = []
+
+        @cache_page_swr(100)
+        def view(request):
+            self.requests.append(request)
+            return HttpResponse(f"page {len(self.requests)}", content_type="text/plain")
+
+        self.view = view
+        self.request = RequestFactory().get("/page/", {"q": "1"}, HTTP_COOKIE="sessionid=x")
+        self.request.resolver_match = "match"
+
+    def get(self, now):
+        with mock.patch("core.caching.time") as time, mock.patch("core.caching.threading.Thread") as thread:
+            time.time.return_value = now
+            response = self.view(self.request)
+        return response, thread
+
+    def test_fresh(self, _):
+        response, thread = self.get(1000)
+        self.assertEqual((response.content, response["Cache-Control"]), (b"page 1", "max-age=100"))
+        response, thread = self.get(1099)
+        self.assertEqual((response.content, response["Cache-Control"]), (b"page 1", "max-age=100"))
+        self.assertEqual(self.requests, [self.request])
+        thread.assert_not_called()
+
+    def test_stale_and_refresh(self, _):
+        self.get(1000)
+        # the stale page is served with a short max-age while a thread renders it again
+        response, thread = self.get(1100)
+        self.assertEqual(response.content, b"page 1")
+        self.assertEqual(response["Cache-Control"], f"max-age={SWR_STALE_MAX_AGE}")
+        thread.assert_called_once()
+        # one refresh at a time
+        _, other_thread = self.get(1101)
+        other_thread.assert_not_called()
+
+        with mock.patch("core.caching.time") as time:
+            time.time.return_value = 1102
+            thread.call_args.kwargs["target"]()
+        # rendered from a copy of the request: same URL and resolver match, none of its other state
+        refresh_request = self.requests[-1]
+        self.assertIsNot(refresh_request, self.request)
+        self.assertEqual(refresh_request.method, "GET")
+        self.assertEqual(refresh_request.get_full_path(), "/page/?q=1")
+        self.assertEqual(refresh_request.build_absolute_uri(), self.request.build_absolute_uri())
+        self.assertEqual(refresh_request.resolver_match, "match")
+        self.assertEqual(refresh_request.COOKIES, {})
+
+        response, thread = self.get(1103)
+        self.assertEqual((response.content, response["Cache-Control"]), (b"page 2", "max-age=100"))
+        thread.assert_not_called()
+
+    def test_not_cacheable(self, _):
+        @cache_page_swr(100)
+        def view(request):
+            response = HttpResponse("page")
+            response.set_cookie("c", "1")
+            return response
+
+        for _ in range(2):
+            response = view(self.request)
+            self.assertIn("c", response.cookies)
+            self.assertFalse(response.has_header("Cache-Control"))
+
+
+class VersionsTest(TestCase):
+    def setUp(self):
+        self.create_dataset("d0")
+        reset_dataset_versions()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        reset_dataset_versions()
+
+    def create_dataset(self, dataset_id):
+        return Dataset.objects.create(dataset_id=dataset_id, name=dataset_id, dataset_type="x",
+                                      dataset_sha256=dataset_id * 32, animal_time=1, animal_visual_time=1)
+
+    def test_catalog_version(self):
+        version = get_catalog_version()
+        # read from the database once per process
+        with self.assertNumQueries(0):
+            self.assertEqual(get_catalog_version(), version)
+            self.assertEqual(catalog_key("k"), f"k@{version}")
+
+        self.create_dataset("d1")
+        self.assertEqual(get_catalog_version(), version)
+        reset_dataset_versions()
+        self.assertNotEqual(get_catalog_version(), version)
+
+    def test_dataset_key(self):
+        self.assertEqual(dataset_key(Dataset, "d0", "d0!x"), "d0!x@" + ("d0" * 8))
+        self.assertEqual(dataset_key(Dataset, "xx", "xx!x"), "xx!x@")
+
+    def test_make_etag(self):
+        request = self.factory.get("/api/", {"a": "1", "b": ["2", "3"]})
+        etag = make_etag(request, "v")
+        # the order of the query parameters doesn't matter
+        self.assertEqual(make_etag(self.factory.get("/api/?b=2&a=1&b=3"), "v"), etag)
+        self.assertEqual(make_etag(self.factory.get("/api/?b=3&b=2&a=1"), "v"), etag)
+        for other in [
+            make_etag(request, "w"),
+            make_etag(self.factory.get("/api2/", {"a": "1", "b": ["2", "3"]}), "v"),
+            make_etag(self.factory.get("/api/", {"a": "1", "b": ["2", "3"]}, HTTP_ACCEPT="application/octet-stream"), "v"),
+            make_etag(self.factory.get("/api/", {"a": "1", "b": ["2", "3"]}, HTTP_ACCEPT_ENCODING="gzip"), "v"),
+        ]:
+            self.assertNotEqual(other, etag)
+
+    def test_dataset_etag(self):
+        @dataset_etag(Dataset)
+        def view(request, dataset_id):
+            return HttpResponse(dataset_id)
+
+        response = view(self.factory.get("/d0/"), "d0")
+        etag = response["ETag"]
+        self.assertEqual(etag, f'"{make_etag(self.factory.get("/d0/"), "d0" * 8)}"')
+        response = view(self.factory.get("/d0/", HTTP_IF_NONE_MATCH=etag), "d0")
+        self.assertEqual((response.status_code, response["ETag"]), (304, etag))
+        # unknown datasets get no ETag
+        response = view(self.factory.get("/xx/", HTTP_IF_NONE_MATCH=etag), "xx")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+
+    def test_catalog_etag(self):
+        @catalog_etag()
+        def view(request):
+            return HttpResponse("catalog")
+
+        etag = view(self.factory.get("/list/"))["ETag"]
+        self.assertEqual(view(self.factory.get("/list/", HTTP_IF_NONE_MATCH=etag)).status_code, 304)
+
+        # a changed catalog changes the ETag
+        self.create_dataset("d1")
+        reset_dataset_versions()
+        response = view(self.factory.get("/list/", HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class JSONStreamReaderTest(SimpleTestCase):
+    values = [
+        0, -12, 3.25, -1.5e-7, 6.02E+23, 123456789012345678901234567890, "", "a \\ \"b\" \\u00e9 \n\t",
+        "\u03b8 \U0001f41b", True, False, None, [], {}, [1, [2.5, "x"], {"k": [True, None]}],
+        {"a": -0.0, "b\\\"": {"c": []}},
+    ]
+
+    def test_chunk_boundaries(self):
+        for indent in (None, 1):
+            text = json.dumps(self.values, indent=indent)
+            # every value split at every position by the reads
+            for chunk_size in range(1, 9):
+                reader = JSONStreamReader(io.StringIO(text), chunk_size)
+                self.assertEqual(list(reader.iter_array()), self.values)
+
+    def test_iter_object(self):
+        data = {"traces": [[1.5, -2], [3, 4e-3]], "uid": "x\\y", "n": 12, "empty": {}}
+        for chunk_size in (1, 3, 1 << 20):
+            reader = JSONStreamReader(io.StringIO(json.dumps(data)), chunk_size)
+            decoded = {}
+            for key in reader.iter_object():
+                decoded[key] = list(reader.iter_array()) if key == "traces" else reader.decode_value()
+            self.assertEqual(decoded, data)
+
+    def test_truncated(self):
+        text = json.dumps(self.values)
+        for end in range(1, len(text)):
+            for chunk_size in (1, 5):
+                reader = JSONStreamReader(io.StringIO(text[:end]), chunk_size)
+                with self.assertRaises(json.JSONDecodeError):
+                    list(reader.iter_array())
+        for text in ["", "{}", "[1 2]", "[1,]", "[-]", "[tru]"]:
+            with self.assertRaises(json.JSONDecodeError):
+                list(JSONStreamReader(io.StringIO(text), 2).iter_array())
+
+    def test_iter_json_array(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+            json.dump(self.values, file)
+        try:
+            self.assertEqual(list(iter_json_array(file.name, chunk_size=4)), self.values)
+        finally:
+            os.remove(file.name)
+
+
+class StreamImportTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.initial_data = os.path.join(self.dir.name, "initial_data")
+        rng = np.random.default_rng(0)
+        t = 30
+        data = {
+            "uid": "2023-01-01-01",
+            "meta": {"note": "a \"quoted\" \u00e9"},
+            "trace_array": rng.normal(size=(5, t)).tolist(),
+            "avg_timestep": 0.6,
+            "max_t": t,
+            "timestamp_confocal": np.cumsum(rng.uniform(0.5, 0.7, t)).tolist(),
+            "num_neurons": 5,
+            "velocity": rng.normal(size=t).tolist(),
+            "head_curvature": rng.normal(size=t).tolist(),
+            "body_curvature": rng.normal(size=t).tolist(),
+            "angular_velocity": rng.normal(size=t).tolist(),
+            "trace_original": rng.normal(scale=100, size=(5, t)).tolist(),
+            "labeled": {"2": {"label": "AVAL", "neuron_class": "AVA", "LR": "L", "DV": "undefined"}},
+            "dataset_type": ["baseline"],
+        }
+        path_data = self.write_json(["activity", "data", "p", "d.json"], data)
+        self.write_json(["config", "gcamp_neuron_name_map_manual.json"], {})
+        self.write_json(["config", "gcamp_neuron_class_name_map_manual.json"], {})
+        self.write_json(["config", "data_checksum.json"], {"p": {"d.json": sha256(path_data)}})
+
+        GCaMPPaper.objects.create(paper_id="p")
+        GCaMPDatasetType.objects.create(type_id="common-baseline", name="baseline", description="")
+        NeuronClass.objects.create(name="AVA")
+
+    def write_json(self, list_part, data):
+        path = os.path.join(self.initial_data, *list_part)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(data, file)
+        return path
+
+    def import_rows(self, stream):
+        command = Command(stdout=io.StringIO())
+        with mock.patch("activity.management.commands.init_data_gcamp.get_dataset_path",
+                        lambda list_part: os.path.join(self.initial_data, *list_part)), \
+                override_settings(TRACE_STORE_DIR=os.path.join(self.dir.name, "traces")):
+            import_all_gcamp(command, stream=stream)
+        dataset = GCaMPDataset.objects.get()
+        neurons = [model_to_dict(neuron, exclude=["id", "dataset"]) for neuron in dataset.neurons.order_by("idx_neuron")]
+
+        return model_to_dict(dataset, exclude=["id"]), neurons
+
+    def test_stream_same_rows(self):
+        dataset, neurons = self.import_rows(stream=False)
+        self.assertEqual(len(neurons), 5)
+        self.assertEqual(neurons[1]["neuron_name"], "AVAL")
+        self.assertEqual(self.import_rows(stream=True), (dataset, neurons))
+        # no work files are left
+        self.assertEqual([f for f in os.listdir(os.path.join(self.dir.name, "traces")) if f.endswith(".work")], [])
+
+
+class LRUStoreTest(SimpleTestCase):
+    def test_eviction_order(self):
+        store = LRUStore(10)
+        for key in "abc":
+            store.set(key, key, 3)
+        # a is used last, b is the least recently used
+        self.assertEqual(store.get("a"), "a")
+        store.set("d", "d", 3)
+        self.assertIsNone(store.get("b"))
+        self.assertEqual([store.get(key) for key in "acd"], ["a", "c", "d"])
+        # one large value evicts as many entries as needed
+        store.set("e", "e", 7)
+        self.assertEqual([store.get(key) for key in "acde"], [None, None, "d", "e"])
+        self.assertEqual(store.get_stats()["evictions"], 3)
+        # values larger than the budget are not stored
+        self.assertFalse(store.set("f", "f", 11))
+        self.assertEqual((len(store), store.size), (2, 10))
+
+    def test_byte_accounting(self):
+        store = LRUStore(100)
+        store.set("a", "a", 10)
+        store.set("b", "b", 20)
+        store.set("a", "a2", 5)
+        self.assertEqual(store.size, 25)
+        self.assertTrue(store.delete("b"))
+        self.assertFalse(store.delete("b"))
+        self.assertEqual(store.size, 5)
+        self.assertFalse(store.set("a", "a3", 101))
+        self.assertEqual((len(store), store.size), (0, 0))
+
+    def test_expiry(self):
+        store = LRUStore(100)
+        with mock.patch("core.cache_backends.time.time", return_value=1000):
+            store.set("a", "a", 10, expire_at=1010)
+            store.set("b", "b", 10)
+            self.assertEqual(store.get("a"), "a")
+        with mock.patch("core.cache_backends.time.time", return_value=1010):
+            self.assertIsNone(store.get("a"))
+            self.assertEqual(store.get("b"), "b")
+            self.assertFalse(store.touch("a", 2000))
+        self.assertEqual(store.size, 10)
+
+
+class LocalLRUCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.cache = LocalLRUCache("test", {"OPTIONS": {"MAX_BYTES": 1000}})
+        self.cache.clear()
+
+    def test_byte_budget(self):
+        self.cache.set("a", b"x" * 400)
+        self.cache.set("b", b"x" * 400)
+        self.cache.get("a")
+        self.cache.set("c", b"x" * 400)
+        self.assertEqual(self.cache.get_many(["a", "b", "c"]).keys(), {"a", "c"})
+        self.assertLessEqual(self.cache.get_stats()["bytes"], 1000)
+        # the same store is shared by the instances of the process
+        self.assertEqual(LocalLRUCache("test", {}).get("a"), b"x" * 400)
+
+    def test_expiry(self):
+        with mock.patch("core.cache_backends.time.time", return_value=1000):
+            self.cache.set("a", 1, timeout=10)
+            self.cache.set("b", 1, timeout=None)
+            self.cache.set("c", 1, timeout=0)
+            self.assertEqual(self.cache.get("a"), 1)
+            self.assertFalse(self.cache.has_key("c"))
+        with mock.patch("core.cache_backends.time.time", return_value=1010):
+            self.assertIsNone(self.cache.get("a"))
+            self.assertEqual(self.cache.get("b"), 1)
+
+    def test_add_incr(self):
+        self.assertTrue(self.cache.add("a", 1))
+        self.assertFalse(self.cache.add("a", 2))
+        self.assertEqual(self.cache.incr("a", 10), 11)
+        self.assertEqual(self.cache.get("a"), 11)
+        with self.assertRaises(ValueError):
+            self.cache.incr("b")
+        # incr keeps the expiry, an expired key can be added again
+        with mock.patch("core.cache_backends.time.time", return_value=1000):
+            self.cache.add("c", 1, timeout=10)
+            self.cache.incr("c")
+        with mock.patch("core.cache_backends.time.time", return_value=1010):
+            with self.assertRaises(ValueError):
+                self.cache.incr("c")
+            self.assertTrue(self.cache.add("c", 5))
+            self.assertEqual(self.cache.get("c"), 5)
+
+    def test_delete(self):
+        self.cache.set("a", b"x" * 100)
+        size = self.cache.get_stats()["bytes"]
+        self.cache.set("b", b"x" * 200)
+        self.assertTrue(self.cache.delete("b"))
+        self.assertFalse(self.cache.delete("b"))
+        self.assertEqual(self.cache.get_stats()["bytes"], size)
+
+
+class SQLiteCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "cache.sqlite3")
+        # two connections (e.g. two workers) to the same file
+        self.cache = self.get_cache()
+        self.other = self.get_cache()
+
+    def get_cache(self, **options):
+        cache = SQLiteCache(self.path, {"OPTIONS": options})
+        self.addCleanup(lambda: cache._connection and cache._connection.close())
+        return cache
+
+    def test_visible_across_connections(self):
+        self.assertEqual(self.cache.connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.cache.set("a", {"x": [1, 2]})
+        self.cache.set_many({"b": 2, "c": 3})
+        self.assertEqual(self.other.get("a"), {"x": [1, 2]})
+        self.assertEqual(self.other.get_many(["a", "b", "c", "d"]), {"a": {"x": [1, 2]}, "b": 2, "c": 3})
+        self.assertTrue(self.other.delete("a"))
+        self.other.delete_many(["b"])
+        self.assertEqual(self.cache.get_many(["a", "b", "c"]), {"c": 3})
+
+    def test_expiry(self):
+        with mock.patch("core.cache_backends.time.time", return_value=1000):
+            self.cache.set("a", 1, timeout=10)
+            self.cache.set("b", 1, timeout=None)
+            self.cache.set("c", 1, timeout=0)
+            self.assertEqual(self.other.get("a"), 1)
+            self.assertFalse(self.other.has_key("c"))
+            self.assertTrue(self.other.touch("b", timeout=20))
+        with mock.patch("core.cache_backends.time.time", return_value=1010):
+            self.assertIsNone(self.other.get("a"))
+            self.assertFalse(self.other.touch("a"))
+            self.assertEqual(self.other.get("b"), 1)
+        with mock.patch("core.cache_backends.time.time", return_value=1020):
+            self.assertIsNone(self.other.get("b"))
+
+    def test_add_incr(self):
+        self.assertTrue(self.cache.add("a", 1))
+        self.assertFalse(self.other.add("a", 2))
+        self.assertEqual(self.other.incr("a", 10), 11)
+        self.assertEqual(self.cache.incr("a"), 12)
+        self.assertEqual(self.other.get("a"), 12)
+        with self.assertRaises(ValueError):
+            self.cache.incr("b")
+
+    def test_add_expired(self):
+        # an expired entry (not deleted yet) doesn't block the add of the other connection
+        with mock.patch("core.cache_backends.time.time", return_value=1000):
+            self.assertTrue(self.cache.add("lock", "token 1", timeout=10))
+        with mock.patch("core.cache_backends.time.time", return_value=1010):
+            with self.assertRaises(ValueError):
+                self.other.incr("lock")
+            self.assertTrue(self.other.add("lock", "token 2", timeout=10))
+            self.assertFalse(self.cache.add("lock", "token 3", timeout=10))
+            self.assertEqual(self.cache.get("lock"), "token 2")
+
+    def test_cull(self):
+        value = b"x" * 100
+        size = len(pickle.dumps(value, SQLiteCache.pickle_protocol))
+        # 3 entries fit, culling the 4th frees down to 90% of the budget: one entry
+        max_bytes = 3 * size + size // 2
+        cache = self.get_cache(MAX_BYTES=max_bytes)
+        cache.CULL_EVERY = 1
+        for t, key in enumerate("abca", 1):
+            with mock.patch("core.cache_backends.time.time", return_value=t):
+                cache.set(key, value, timeout=None)
+        # the oldest entry by creation (b, a was written again) is culled, not the least recently read one
+        with mock.patch("core.cache_backends.time.time", return_value=5):
+            cache.get("b")
+            cache.set("d", value, timeout=None)
+        self.assertEqual(self.other.get_many(["a", "b", "c", "d"]).keys(), {"a", "c", "d"})
+        self.assertEqual(cache.get_stats(), {"entries": 3, "bytes": 3 * size, "max_bytes": max_bytes})
+
+        # expired entries are culled first
+        with mock.patch("core.cache_backends.time.time", return_value=6):
+            cache.set("c", value, timeout=1)
+        with mock.patch("core.cache_backends.time.time", return_value=7):
+            cache.set("e", value, timeout=None)
+        self.assertEqual(self.other.get_many(["a", "c", "d", "e"]).keys(), {"a", "d", "e"})
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "remote": {"BACKEND": "core.cache_backends.LocalLRUCache", "LOCATION": "two-tier-test"},
+})
+class TwoTierCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.cache = TwoTierCache("remote", {"OPTIONS": {"LOCAL_PREFIXES": {"list!": 10}, "LOCAL_MAX_BYTES": 1000}})
+        self.cache.clear()
+        self.remote = self.cache.remote
+
+    def test_local_ttl(self):
+        with mock.patch("core.cache_backends.time.time", return_value=1000):
+            self.cache.set("list!a", [1], timeout=None)
+            # changed in the shared cache (e.g. by another process): the local copy is served until its TTL
+            self.remote.set("list!a", [2], timeout=None)
+            self.assertEqual(self.cache.get("list!a"), [1])
+            self.assertEqual(self.cache.get_many(["list!a"]), {"list!a": [1]})
+        with mock.patch("core.cache_backends.time.time", return_value=1010):
+            self.assertEqual(self.cache.get("list!a"), [2])
+        self.assertEqual(self.cache.get_stats()["entries"], 1)
+
+    def test_remote_only(self):
+        self.cache.set("data!a", [1])
+        self.cache.set_many({"data!b": [2]})
+        self.assertEqual(self.cache.get_stats()["entries"], 0)
+        self.assertEqual(self.remote.get_many(["data!a", "data!b"]), {"data!a": [1], "data!b": [2]})
+        self.remote.set("data!a", [3])
+        self.assertEqual(self.cache.get("data!a"), [3])
+        self.assertTrue(self.cache.add("data!c", 1))
+        self.assertEqual(self.cache.incr("data!c"), 2)
+        self.assertEqual(self.remote.get("data!c"), 2)
+
+    def test_get_many(self):
+        self.remote.set_many({"list!a": 1, "data!b": 2})
+        self.assertEqual(self.cache.get_many(["list!a", "data!b", "list!c"]), {"list!a": 1, "data!b": 2})
+        # only the local prefixes are copied
+        self.remote.delete_many(["list!a", "data!b"])
+        self.assertEqual(self.cache.get_many(["list!a", "data!b"]), {"list!a": 1})
+
+    def test_delete(self):
+        self.cache.set_many({"list!a": 1, "list!b": 2, "list!c": 3, "data!d": 4})
+        self.assertTrue(self.cache.delete("list!a"))
+        self.cache.delete_many(["list!b", "data!d"])
+        # deleted from both tiers
+        self.assertEqual(self.cache.get_many(["list!a", "list!b", "list!c", "data!d"]), {"list!c": 3})
+        self.assertEqual(self.remote.get_many(["list!a", "list!b", "list!c", "data!d"]), {"list!c": 3})
+        self.assertEqual(self.cache.get_stats()["entries"], 1)
+
+    def test_incr(self):
+        self.cache.set("list!n", 1)
+        self.assertEqual(self.cache.incr("list!n"), 2)
+        # the local copy is dropped
+        self.assertEqual(self.cache.get("list!n"), 2)
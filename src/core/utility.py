@@ -1,5 +1,6 @@
 import hashlib
 import csv
+import json
 
 def sha256(file_path, chunk_size=8192):
     sha256 = hashlib.sha256()
@@ -16,4 +17,105 @@ def load_csv(path):
         for row in csv_reader:
             list_read.append(row)
 
-    return list_read
\ No newline at end of file
+    return list_read
+
+class JSONStreamReader:
+    """
+    Incremental reader for large JSON files. Arrays and objects are walked one item at a time and
+    each item is decoded with json.JSONDecoder.raw_decode, so only the item being decoded (and one
+    read chunk) is held in memory instead of the whole file and all of its values.
+    """
+    WHITESPACE = " \t\n\r"
+    NUMBER_CHARS = "0123456789.eE+-"
+
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read(self, size):
+        # drop the consumed part of the buffer
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def _peek(self):
+        # next non-whitespace character, "" at the end of the file
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ""
+            self._read(self.chunk_size)
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def _next_or_end(self, end):
+        # consume "," (returns True) or the closing end character (returns False)
+        char = self._peek()
+        self.pos += 1
+        if char == end:
+            return False
+        if char != ",":
+            raise json.JSONDecodeError(f"Expecting ',' or '{end}'", self.buffer, self.pos - 1)
+        return True
+
+    def decode_value(self):
+        """Decode the value at the current position."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number ending at (or cut by) the end of the buffer may continue in the next chunk
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in self.NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read at least as much as is buffered so large values are decoded in O(size)
+            self._read(max(self.chunk_size, len(self.buffer) - self.pos))
+
+    def iter_array(self):
+        """Yield the items of the array at the current position."""
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if not self._next_or_end("]"):
+                return
+
+    def iter_object(self):
+        """
+        Yield the keys of the object at the current position. The value of each key must be consumed
+        (decode_value, iter_array or iter_object) before the next key is requested.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            if self._peek() != '"':
+                raise json.JSONDecodeError("Expecting property name", self.buffer, self.pos)
+            key = self.decode_value()
+            self._expect(":")
+            yield key
+            if not self._next_or_end("}"):
+                return
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """Yield the items of a JSON file holding a top-level array, one at a time."""
+    with open(path, "r") as file:
+        yield from JSONStreamReader(file, chunk_size).iter_array()
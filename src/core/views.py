@@ -1,18 +1,18 @@
 from django.shortcuts import render
-from django.views.decorators.cache import cache_page
 from django.http import HttpResponse
 from django.db import connection
 from django.views.decorators.http import require_GET
 from connectome.views import connectome_datasets
+from core.caching import cache_page_swr
 import json
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def index(request):
     context = {}
     
     return render(request, "core/index.html",context)
 
-@cache_page(60*60*24*30)
+@cache_page_swr(60*60*24*30)
 def about(request):
     context = {
         "connectome_data": json.loads(connectome_datasets())
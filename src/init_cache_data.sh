@@ -1,2 +1,3 @@
+python manage.py invalidate_cache
 python manage.py cache_connectome
-python manage.py cache_activity
\ No newline at end of file
+python manage.py cache_activity --workers 4
\ No newline at end of file
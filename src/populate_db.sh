@@ -5,7 +5,12 @@ python manage.py migrate --noinput
 python manage.py collectstatic --no-input
 python manage.py init_data_connectome
 python manage.py init_data_graph_precompute
-python manage.py init_data_gcamp
+python manage.py init_data_gcamp --stream
 python manage.py update_encoding_dict_neuron_match
 python manage.py update_encoding_dict
-python manage.py update_neuron_match_dict
\ No newline at end of file
+python manage.py update_neuron_match_dict
+
+# warm the cache file shared by the workers (deployments without Redis, see DJ_CACHE_PATH)
+if [ -n "$DJ_CACHE_PATH" ]; then
+    sh init_cache_data.sh
+fi
@@ -91,16 +91,43 @@ WSGI_APPLICATION = 'wormwideweb.wsgi.application'
 
 if bool(int(os.environ.get("DJ_USE_REDIS", 0))):
     CACHES = {
+        # small values read on nearly every page render are also kept in each worker (core/cache_backends.py)
         "default": {
+            "BACKEND": "core.cache_backends.TwoTierCache",
+            "LOCATION": "redis",
+            "OPTIONS": {
+                "LOCAL_PREFIXES": {
+                    "connectome_datasets_json": 300,
+                    "dataset_data": 300,
+                    "encoding_connectome_data": 300,
+                },
+                "LOCAL_MAX_BYTES": int(os.environ.get("DJ_LOCAL_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+            },
+        },
+        "redis": {
             "BACKEND": "django.core.cache.backends.redis.RedisCache",
             "LOCATION": os.environ.get("DJ_REDIS_URI"),
+        },
+    }
+elif os.environ.get("DJ_CACHE_PATH"):
+    # cache file shared by the workers of the host (core/cache_backends.py), warmed by init_cache_data.sh
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.cache_backends.SQLiteCache',
+            'LOCATION': str(BASE_DIR / os.environ["DJ_CACHE_PATH"]),
+            'OPTIONS': {
+                'MAX_BYTES': int(os.environ["DJ_CACHE_MAX_BYTES"]) if os.environ.get("DJ_CACHE_MAX_BYTES") else None,
+            },
         }
     }
 else:
     CACHES = {
         'default': {
-            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',  # In-memory cache
+            'BACKEND': 'core.cache_backends.LocalLRUCache',  # In-memory cache, bounded by bytes
             'LOCATION': 'unique-snowflake',
+            'OPTIONS': {
+                'MAX_BYTES': int(os.environ.get("DJ_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+            },
         }
     }
 
@@ -128,6 +155,12 @@ else:
         }
     }
 
+# Binary trace store (memory-mapped by the workers), written by init_data_gcamp
+TRACE_STORE_DIR = BASE_DIR / 'trace_store'
+
+# CSR connectome graphs (memory-mapped by the workers), written by init_data_graph_precompute
+GRAPH_STORE_DIR = BASE_DIR / 'graph_store'
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -21,6 +21,6 @@ application = get_wsgi_application()
 get_resolver(settings.ROOT_URLCONF).url_patterns
 
 # Initialize graph computation.
-from connectome.graph_init import load_precomputed_graphs
+from connectome.graph_store import load_graph_store
 import connectome.graph_data
-connectome.graph_data.GRAPH_OBJECTS = load_precomputed_graphs()
+connectome.graph_data.GRAPH_OBJECTS = load_graph_store()